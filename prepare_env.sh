@@ -29,7 +29,10 @@ echo "Installing PyTorch and ONNX Runtime..."
 conda install -c conda-forge pytorch onnxruntime torchaudio -y
 
 echo "Installing Data Science and Machine Learning tools..."
-conda install -c conda-forge numpy pandas joblib scikit-learn lightgbm -y
+conda install -c conda-forge numpy pandas pyarrow joblib scikit-learn lightgbm -y
+
+echo "Installing the test runner..."
+conda install -c conda-forge pytest -y
 
 # Rule of thumb: Always run pip AFTER conda to avoid dependency conflicts
 echo "Installing whisper-timestamped via pip..."
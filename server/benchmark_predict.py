@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# This script measures the two costs of a prediction that predict.py can avoid:
+# - Feature lookup: the local feature store (FEATURE_LOOKUP=local) vs. the /get_integrated_result endpoint of
+#   get_integrated_result.py (FEATURE_LOOKUP=http; only measured when the service is running).
+# - Scoring: one score_subjects() call per participant (as /predict does) vs. one call per age group for all of them
+#   (as /predict_batch does); the predictions and domain scores of both are checked to be the same.
+# Participants are taken from the feature store. With --synthetic (or when the store is empty), random feature vectors
+# within the range of the scalers are scored instead, and the lookup is measured on a temporary SQLite store holding them.
+
+# Usage: python benchmark_predict.py [-n <N_SUBJECTS>] [-r <REPEATS>] [--synthetic]
+
+import os
+import time
+import argparse
+import tempfile
+import statistics
+
+import numpy as np
+import requests
+
+os.environ.setdefault("MODEL_WATCH_INTERVAL", "0") # no watcher thread while benchmarking
+
+import predict
+from model_registry import get_age_group
+from feature_store import HttpFeatureStore, SqliteFeatureStore, make_feature_store
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n_subjects", type=int, default=400,
+                        help="Number of participants (default: 400, about the size of the cohort).")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+                        help="Number of runs of each measurement (the median is reported).")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="Use random feature vectors instead of the participants in the feature store.")
+    return parser.parse_args()
+
+def synthetic_subjects(config, n_subjects, seed=0):
+    '''
+    Returns {subject_id: (age, features)} with features drawn uniformly within the range of the scaler of the age group,
+    and about 5% of them missing.
+    '''
+    rng = np.random.default_rng(seed)
+    subjects = {}
+    for i in range(n_subjects):
+        age = int(rng.integers(20, 80))
+        scaler = predict.registry.get(get_age_group(age)).scaler
+        values = rng.uniform(scaler.data_min_, scaler.data_max_)
+        values[rng.random(len(values)) < 0.05] = config.missing_marker
+        subjects[f"BENCH{i:04d}"] = (age, dict(zip(scaler.feature_names_in_, values.tolist())))
+    return subjects
+
+def measure(func, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+def benchmark_lookup(name, feature_store, subject_ids, repeats):
+    try:
+        feature_store.get(subject_ids[0])
+    except requests.RequestException as e:
+        print(f"{name:>24}: skipped ({type(e).__name__}: {e})")
+        return
+
+    def lookup():
+        for subject_id in subject_ids:
+            feature_store.get(subject_id)
+    total = measure(lookup, repeats)
+    print(f"{name:>24}: {total / len(subject_ids) * 1000:8.2f} ms per participant")
+
+    if not isinstance(feature_store, HttpFeatureStore):
+        total = measure(lambda: feature_store.get_many(subject_ids), repeats)
+        print(f"{name + ' (get_many)':>24}: {total / len(subject_ids) * 1000:8.2f} ms per participant")
+
+def benchmark_scoring(config, subjects, repeats):
+    groups = {}
+    for subject_id, (age, features) in subjects.items():
+        groups.setdefault(get_age_group(age), []).append((subject_id, age, features))
+
+    def one_by_one():
+        return {
+            subject_id: predict.score_subjects(config, predict.registry.get(age_full), [age], [features])[0]
+            for age_full, members in groups.items() for subject_id, age, features in members
+        }
+
+    def batched():
+        scored = {}
+        for age_full, members in groups.items():
+            scored_list = predict.score_subjects(
+                config, predict.registry.get(age_full), [ age for _, age, _ in members ], [ features for _, _, features in members ]
+            )
+            scored.update({ subject_id: s for (subject_id, _, _), s in zip(members, scored_list) })
+        return scored
+
+    single, batch = one_by_one(), batched()
+    max_diff = max(abs(single[subject_id]["prediction"] - batch[subject_id]["prediction"]) for subject_id in subjects)
+    same_scores = all(single[subject_id]["domain_score_list"] == batch[subject_id]["domain_score_list"] for subject_id in subjects)
+    print(f"Same domain scores: {same_scores}, max prediction difference: {max_diff:.3g} years")
+
+    single_seconds = measure(one_by_one, repeats)
+    batch_seconds = measure(batched, repeats)
+    print(f"{'one by one':>24}: {single_seconds:8.3f} s ({single_seconds / len(subjects) * 1000:.2f} ms per participant)")
+    print(f"{'batched':>24}: {batch_seconds:8.3f} s ({batch_seconds / len(subjects) * 1000:.2f} ms per participant)")
+    print(f"{'speedup':>24}: {single_seconds / batch_seconds:8.1f} x")
+
+def main():
+    args = parse_args()
+    config = predict.config
+
+    local_store = make_feature_store(config)
+    subject_ids = [] if args.synthetic else local_store.subject_ids()[:args.n_subjects]
+    tmp_dir = None
+    if subject_ids:
+        features = local_store.get_many(subject_ids)
+        subjects = { subject_id: (40, features[subject_id]) for subject_id in subject_ids } # the age only selects the model
+        http_store = HttpFeatureStore(config.get_integrated_result_url, config.local_headers)
+    else:
+        subjects = synthetic_subjects(config, args.n_subjects)
+        subject_ids = list(subjects)
+        tmp_dir = tempfile.TemporaryDirectory()
+        local_store = SqliteFeatureStore(os.path.join(tmp_dir.name, "integrated_results.db"))
+        local_store.update_many({ subject_id: features for subject_id, (_, features) in subjects.items() }, config.missing_marker)
+        http_store = None
+
+    print(f"Feature lookup ({len(subject_ids)} participants, {config.feature_store_backend if tmp_dir is None else 'temporary sqlite'} store):")
+    benchmark_lookup("local", local_store, subject_ids, args.repeats)
+    if http_store is not None:
+        benchmark_lookup("http", http_store, subject_ids, args.repeats)
+    else:
+        print(f"{'http':>24}: skipped (synthetic participants)")
+
+    print(f"\nScoring ({len(subjects)} participants):")
+    benchmark_scoring(config, subjects, args.repeats)
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+def subject_of(file_path):
+    ## Task data files are named "<subject_id>_<task>_<date>....csv"
+    return os.path.basename(file_path).split('_')[0]
+
+def read_concurrently(read_file, file_paths, max_workers=8, failures=None):
+    '''
+    Calls read_file(file_path) for the (unique) file paths in a thread pool (in the calling thread for a single file),
+    since pandas releases the GIL while parsing CSV files, and returns the (file_path, result) pairs in input order.
+    Missing files and files for which read_file returns None are skipped, and so are the files for which read_file
+    raises: their exception is recorded in failures ({file_path: exception}) when given.
+    '''
+    file_paths = list(dict.fromkeys(file_paths))
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            print(f"File not found: {file_path}")
+    file_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
+    if not file_paths:
+        return []
+
+    def _read_file(file_path):
+        try:
+            return read_file(file_path), None
+        except Exception as e:
+            print(f"Failed to read {file_path}: {type(e).__name__}: {e}")
+            return None, e
+
+    if max_workers <= 1 or len(file_paths) == 1:
+        results = [_read_file(file_path) for file_path in file_paths]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+            results = list(executor.map(_read_file, file_paths))
+
+    if failures is not None:
+        failures.update({ file_path: error for file_path, (_, error) in zip(file_paths, results) if error is not None })
+    return [(file_path, result) for file_path, (result, _) in zip(file_paths, results) if result is not None]
+
+def concat_long(results):
+    '''
+    Stacks the per-file frames returned by read_concurrently() into one long-format frame keyed by a "file" column.
+    '''
+    frames = [df.assign(file=file_path) for file_path, df in results]
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+def split_long(data):
+    return list(data.groupby('file', sort=False))
+
+def compute_by_file(compute, data, failures, split=split_long):
+    '''
+    Calls compute(data) on the data of all files at once (by default, the long-format frame returned by concat_long()),
+    which returns one row per file (indexed by file path). If it raises, calls it again on the data of each file
+    (split(data) returns the (file_path, file data) pairs), so that one bad file does not fail the others;
+    the exception of a file that still fails is recorded in failures ({file_path: exception}).
+    '''
+    if data is None:
+        return None
+    try:
+        return compute(data)
+    except Exception as e:
+        parts = split(data)
+        if len(parts) == 1:
+            failures[parts[0][0]] = e
+            print(f"Failed to process {parts[0][0]}: {type(e).__name__}: {e}")
+            return None
+        print(f"Failed to process {len(parts)} files at once ({type(e).__name__}: {e}), retrying one by one")
+    outputs = [compute_by_file(compute, part, failures, split) for _, part in parts]
+    outputs = [output for output in outputs if output is not None]
+    return pd.concat(outputs) if outputs else None
+
+def by_subject(output, failures):
+    '''
+    Re-indexes the per-file output of a processor by subject ID (from the file names) and returns it,
+    with the exceptions of the files that failed in output.attrs["failures"] ({file_path: exception}).
+    An empty frame is returned when no file could be processed.
+    '''
+    if output is None:
+        output = pd.DataFrame()
+    output = output.set_axis(pd.Index([subject_of(file_path) for file_path in output.index], name='subject_id'))
+    output.attrs['failures'] = dict(failures)
+    return output
+
+def single_subject(output, file_path):
+    '''
+    Turns the process_many() output of a single file into the process_subject() result: the one-row frame,
+    None when the file was not processed (e.g., it does not exist), or the exception of the file raised again.
+    '''
+    if file_path in output.attrs.get('failures', {}):
+        raise output.attrs['failures'][file_path]
+    if output.empty:
+        return None
+    output = output.reset_index(drop=True)
+    output.attrs = {}
+    return output
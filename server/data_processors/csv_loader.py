@@ -0,0 +1,31 @@
+import csv
+
+import pandas as pd
+
+try:
+    import pyarrow # noqa: F401 (only needed as the pandas CSV engine)
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+def load_csv(file_path, columns):
+    '''
+    Reads only the given columns ({name: dtype, or None to infer it}) of a Pavlovia CSV export, with the pyarrow
+    engine when it is installed. Columns the file does not have are skipped; the others are returned in the given order.
+    Values of numeric columns that are not numbers (e.g., "None" or "abc") become NaN instead of failing the read.
+    '''
+    with open(file_path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    usecols = [column for column in columns if column in header]
+    df = pd.read_csv(file_path, usecols=usecols, engine=CSV_ENGINE)[usecols]
+
+    ## The dtypes are applied after reading, since read_csv raises on the first value it cannot convert
+    for column in usecols:
+        dtype = columns[column]
+        if dtype is None:
+            continue
+        if pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(dtype)):
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
@@ -1,132 +1,125 @@
 import os
+import numpy as np
 import pandas as pd
 
+from data_processors.batch import read_concurrently, concat_long, compute_by_file, by_subject, single_subject
+from data_processors.csv_loader import load_csv
+
+## Columns read from the task CSV export (name: dtype, or None to infer it)
+CSV_COLUMNS = {
+    '指定代號': None,
+    'number_of_cue_t': 'float64',
+    'key_resp.keys': None,
+    'key_resp.rt': 'float64',
+    'stimuli_t': 'float64'
+}
+
 class ExclusionProcessor:
     def __init__(self, data_dir):
         self.data_dir = data_dir
         self.trial_n = 18 * 3
+        self.columns = ['number_of_cue_t', 'key_resp_keys', 'key_resp.rt', 'stimuli_t']
 
-    def create_index(self, data, trial_n):
-        output = list(data.index)
-        output.reverse()
-        output = output[:trial_n]
-        output.reverse()
-        return output
+    def read_file(self, file_path):
+        data = load_csv(file_path, CSV_COLUMNS)
+        data.rename(columns={'key_resp.keys': 'key_resp_keys'}, inplace=True)
+
+        if '指定代號' not in data.columns:
+            print(f"Column '指定代號' not found in file: {file_path}")
+            return None
+        if data.empty:
+            raise ValueError(f"No trials in file: {file_path}")
+
+        id = data.loc[0, '指定代號']
+        return data[self.columns].assign(ID=id)
 
     def select_item(self, data, trial_n):
-        output = data.dropna(how='any')
-        index = self.create_index(output, trial_n)
-        return output.loc[index, :]
+        ## Keeps the last trial_n complete trials of each file
+        output = data.dropna(how='any', subset=self.columns)
+        return output.groupby('file', sort=False).tail(trial_n)
 
-    def mean_rt_calculation(self, data):
-        output = []
-        for each in ['s', 'k']:
-            value = data[data.key_resp_keys == each][['key_resp.rt']].values.flatten()
-            mean_rt = value.sum() / data.shape[0] if data.shape[0] > 0 else 0  # Avoid division by zero
-            if mean_rt == 0:
-                mean_rt = -999  # If Mean_RT is zero, recode as NA value (-999)
-            output.append(mean_rt)
-        return output
+    def cell_stats(self, data, files):
+        '''
+        Aggregates the trials of all files in a single groupby over (file, cue, stimulus type, response key) and returns
+        one row per file and (cue, stimulus type) cell of the 3x3 design with the number of trials (n),
+        the number of "yes" responses (n_yes) and the summed RT of the "yes" ('s') and "no" ('k') responses.
+        '''
+        grid = pd.MultiIndex.from_product([files, [1, 2, 3], [1, 2, 3]], names=['file', 'number_of_cue_t', 'stimuli_t'])
+        data = data.astype({'number_of_cue_t': int, 'stimuli_t': int})
+        grouped = data.groupby(['file', 'number_of_cue_t', 'stimuli_t', 'key_resp_keys'])['key_resp.rt'].agg(['size', 'sum'])
+        grouped = grouped.unstack('key_resp_keys', fill_value=0).reindex(grid, fill_value=0)
 
-    def rt_calculation_stimulus(self, data):
-        target = self.mean_rt_calculation(data[data.stimuli_t == 1])
-        non_target = self.mean_rt_calculation(data[data.stimuli_t == 2])
-        new = self.mean_rt_calculation(data[data.stimuli_t == 3])
-        return {'Target': target, 'NonTarget': non_target, 'New': new}
+        stats = pd.DataFrame(index=grid)
+        stats['n'] = grouped['size'].sum(axis=1)
+        for key, name in [('s', 'yes'), ('k', 'no')]:
+            stats[f'n_{name}'] = grouped['size'][key] if key in grouped['size'] else 0
+            stats[f'{name}_rt_sum'] = grouped['sum'][key] if key in grouped['sum'] else 0.0
+        return stats
 
-    def rt_calculation_stimulus_cue(self, data):
-        cue_1 = self.rt_calculation_stimulus(data[data.number_of_cue_t == 1])
-        cue_2 = self.rt_calculation_stimulus(data[data.number_of_cue_t == 2])
-        cue_3 = self.rt_calculation_stimulus(data[data.number_of_cue_t == 3])
-        return {'Cue_1': cue_1, 'Cue_2': cue_2, 'Cue_3': cue_3}
+    def by_file(self, values):
+        ## (file, cue, stimulus type) series -> array with one row per file (in input order) and one column per cell
+        return values.unstack(['number_of_cue_t', 'stimuli_t']).reindex(values.index.unique('file')).to_numpy()
 
-    def rate_calculation_stimulus(self, input_data):
+    def mean_rt_calculation(self, stats):
+        ## Mean RT of the "yes"/"no" responses per cell (summed RT divided by the number of trials of the cell);
+        ## recoded as NA value (-999) when it is zero or the cell is empty
         output = []
-        for each in [1, 2, 3]:  # Target/Non-target/New item
-            data = input_data[input_data.stimuli_t == each]
-            yes_rate = data[data.key_resp_keys == 's'].shape[0] / data.shape[0] # if data.shape[0] > 0 else 0
-            output.append(yes_rate)
+        for name in ['yes', 'no']:
+            mean_rt = (stats[f'{name}_rt_sum'] / stats['n'].where(stats['n'] > 0)).fillna(0)
+            output.append(self.by_file(mean_rt.mask(mean_rt == 0, -999)))
         return output
 
-    def rate_calculation_stimulus_cue(self, input_data):
-        output = []
-        for each in [1, 2, 3]:  # Cue 1/2/3
-            data = input_data[input_data.number_of_cue_t == each]
-            yes_rate = self.rate_calculation_stimulus(data)
-            output.extend(yes_rate)
-        return output
+    def rate_calculation(self, stats, strict=False):
+        ## Rate of "yes" responses per cell (cue 1/2/3 x target/non-target/new item);
+        ## NaN for the empty cells, or ZeroDivisionError when strict
+        empty = stats['n'] == 0
+        if empty.any():
+            files = list(dict.fromkeys(stats.index[empty].get_level_values('file')))
+            if strict:
+                raise ZeroDivisionError(f"No trials for some cue and stimulus type: {files}")
+            print(f"No trials for some cue and stimulus type, rates left empty: {files}")
+        yes_rate = stats['n_yes'] / stats['n'].where(~empty)
+        return self.by_file(yes_rate)
 
-    def process_subject(self, file_path):
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}")
-            return None
+    def compute(self, data, strict=False):
+        '''
+        Computes the metrics of all files of the long-format trial frame (column "file") and returns one row per file.
+        '''
+        files = list(dict.fromkeys(data['file']))
+        ids = data.groupby('file', sort=False)['ID'].first().reindex(files)
+        data = self.select_item(data, self.trial_n)
 
-        data = pd.read_csv(file_path)
-        data.rename(columns={'key_resp.keys': 'key_resp_keys'}, inplace=True)
+        # Calculate rt and Yes rates
+        stats = self.cell_stats(data, files)
+        yes_rt, no_rt = self.mean_rt_calculation(stats)
+        yes_rate = self.rate_calculation(stats, strict=strict)
+        no_rate = 1 - yes_rate
+        non_tar_fa = yes_rate[:, [1, 4, 7]]
+        recollection = yes_rate[:, [0, 3, 6]] - non_tar_fa
+        with np.errstate(divide='ignore', invalid='ignore'):
+            familiarity = np.where(recollection != 1, non_tar_fa / (1 - recollection), non_tar_fa / (1 - 0.999))
 
-        if '指定代號' not in data.columns:
-            print(f"Column '指定代號' not found in file: {file_path}")
-            return None
+        output = { 'ID': ids.to_numpy() }
+        for name, values in [('FAMILIARITY', familiarity), ('RECOLLECTION', recollection)]:
+            for cue in range(3):
+                output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}_{name}'] = values[:, cue]
+        for cue in range(3):
+            for suffix, (yes, no) in [('PROPORTION', (yes_rate, no_rate)), ('RT', (yes_rt, no_rt))]:
+                for stimulus, (yes_name, no_name) in enumerate([('TarHit', 'TarMiss'), ('NonTarFA', 'NonTarCR'), ('NewFA', 'NewCR')]):
+                    output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}{yes_name}_{suffix}'] = yes[:, cue * 3 + stimulus]
+                    output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}{no_name}_{suffix}'] = no[:, cue * 3 + stimulus]
 
-        id = data.loc[0, '指定代號']
-        data = data[['number_of_cue_t', 'key_resp_keys', 'key_resp.rt', 'stimuli_t']]
-        data = self.select_item(data, self.trial_n)
+        return pd.DataFrame(output, index=pd.Index(files, name='file_path'))
 
-        # Calculate rt and Yes rates
-        rt = self.rt_calculation_stimulus_cue(data)
-        yes_rate = self.rate_calculation_stimulus_cue(data)
-        no_rate = [1 - each for each in yes_rate]
-        non_tar_fa = [yes_rate[1], yes_rate[4], yes_rate[7]]
-        recollection = [(yes_rate[0] - non_tar_fa[0]), (yes_rate[3] - non_tar_fa[1]), (yes_rate[6] - non_tar_fa[2])]
-        familiarity = [non_tar_fa[Each]/(1 - recollection[Each]) if recollection[Each] != 1 else non_tar_fa[Each]/(1 - 0.999) for Each in range(3)]
-
-        output = pd.DataFrame({
-            'ID': [id],
-            'MEMORY_EXCLUSION_BEH_C1_FAMILIARITY': [familiarity[0]], 
-            'MEMORY_EXCLUSION_BEH_C2_FAMILIARITY': [familiarity[1]],
-            'MEMORY_EXCLUSION_BEH_C3_FAMILIARITY': [familiarity[2]],
-            'MEMORY_EXCLUSION_BEH_C1_RECOLLECTION': [recollection[0]], 
-            'MEMORY_EXCLUSION_BEH_C2_RECOLLECTION': [recollection[1]],
-            'MEMORY_EXCLUSION_BEH_C3_RECOLLECTION': [recollection[2]],
-    # Cue 1 --------------------------------------
-            'MEMORY_EXCLUSION_BEH_C1TarHit_PROPORTION': [yes_rate[0]],
-            'MEMORY_EXCLUSION_BEH_C1TarMiss_PROPORTION': [no_rate[0]],
-            'MEMORY_EXCLUSION_BEH_C1NonTarFA_PROPORTION': [yes_rate[1]],
-            'MEMORY_EXCLUSION_BEH_C1NonTarCR_PROPORTION': [no_rate[1]],
-            'MEMORY_EXCLUSION_BEH_C1NewFA_PROPORTION': [yes_rate[2]],
-            'MEMORY_EXCLUSION_BEH_C1NewCR_PROPORTION': [no_rate[2]],
-            'MEMORY_EXCLUSION_BEH_C1TarHit_RT': [rt['Cue_1']['Target'][0]],
-            'MEMORY_EXCLUSION_BEH_C1TarMiss_RT': [rt['Cue_1']['Target'][1]],
-            'MEMORY_EXCLUSION_BEH_C1NonTarFA_RT': [rt['Cue_1']['NonTarget'][0]],
-            'MEMORY_EXCLUSION_BEH_C1NonTarCR_RT': [rt['Cue_1']['NonTarget'][1]],
-            'MEMORY_EXCLUSION_BEH_C1NewFA_RT': [rt['Cue_1']['New'][0]],
-            'MEMORY_EXCLUSION_BEH_C1NewCR_RT': [rt['Cue_1']['New'][1]],
-    # Cue 2 --------------------------------------
-            'MEMORY_EXCLUSION_BEH_C2TarHit_PROPORTION': [yes_rate[3]],
-            'MEMORY_EXCLUSION_BEH_C2TarMiss_PROPORTION': [no_rate[3]],
-            'MEMORY_EXCLUSION_BEH_C2NonTarFA_PROPORTION': [yes_rate[4]],
-            'MEMORY_EXCLUSION_BEH_C2NonTarCR_PROPORTION': [no_rate[4]],
-            'MEMORY_EXCLUSION_BEH_C2NewFA_PROPORTION': [yes_rate[5]],
-            'MEMORY_EXCLUSION_BEH_C2NewCR_PROPORTION': [no_rate[5]],
-            'MEMORY_EXCLUSION_BEH_C2TarHit_RT' : [rt['Cue_2']['Target'][0]],
-            'MEMORY_EXCLUSION_BEH_C2TarMiss_RT' : [rt['Cue_2']['Target'][1]],
-            'MEMORY_EXCLUSION_BEH_C2NonTarFA_RT' : [rt['Cue_2']['NonTarget'][0]],
-            'MEMORY_EXCLUSION_BEH_C2NonTarCR_RT' : [rt['Cue_2']['NonTarget'][1]],
-            'MEMORY_EXCLUSION_BEH_C2NewFA_RT' : [rt['Cue_2']['New'][0]],
-            'MEMORY_EXCLUSION_BEH_C2NewCR_RT' : [rt['Cue_2']['New'][1]],
-    # Cue 3 --------------------------------------
-            'MEMORY_EXCLUSION_BEH_C3TarHit_PROPORTION': [yes_rate[6]],
-            'MEMORY_EXCLUSION_BEH_C3TarMiss_PROPORTION': [no_rate[6]],
-            'MEMORY_EXCLUSION_BEH_C3NonTarFA_PROPORTION': [yes_rate[7]],
-            'MEMORY_EXCLUSION_BEH_C3NonTarCR_PROPORTION': [no_rate[7]],
-            'MEMORY_EXCLUSION_BEH_C3NewFA_PROPORTION': [yes_rate[8]],
-            'MEMORY_EXCLUSION_BEH_C3NewCR_PROPORTION': [no_rate[8]],
-            'MEMORY_EXCLUSION_BEH_C3TarHit_RT' : [rt['Cue_3']['Target'][0]],
-            'MEMORY_EXCLUSION_BEH_C3TarMiss_RT' : [rt['Cue_3']['Target'][1]],
-            'MEMORY_EXCLUSION_BEH_C3NonTarFA_RT' : [rt['Cue_3']['NonTarget'][0]],
-            'MEMORY_EXCLUSION_BEH_C3NonTarCR_RT' : [rt['Cue_3']['NonTarget'][1]],
-            'MEMORY_EXCLUSION_BEH_C3NewFA_RT' : [rt['Cue_3']['New'][0]],
-            'MEMORY_EXCLUSION_BEH_C3NewCR_RT' : [rt['Cue_3']['New'][1]]
-        })
-
-        return output
\ No newline at end of file
+    def process_many(self, file_paths, max_workers=8, strict=False):
+        '''
+        Reads the files (one per subject) concurrently and returns one row per subject (indexed by subject ID).
+        A file that cannot be read or processed only leaves out its subject; its exception is kept in
+        output.attrs["failures"] ({file_path: exception}).
+        '''
+        failures = {}
+        data = concat_long(read_concurrently(self.read_file, file_paths, max_workers=max_workers, failures=failures))
+        return by_subject(compute_by_file(lambda data: self.compute(data, strict=strict), data, failures), failures)
+
+    def process_subject(self, file_path):
+        return single_subject(self.process_many([file_path], max_workers=1, strict=True), file_path)
@@ -2,24 +2,67 @@
 # -*- coding: utf-8 -*-
 
 import os
-import ast
 import numpy as np
 import pandas as pd
 
+from data_processors.batch import read_concurrently, compute_by_file, by_subject, single_subject
+from data_processors.csv_loader import load_csv
+
+## Constants of the Throughput class of GoFitts_modified.jar, kept as is so that the native computation matches the JAR
+WE_FACTOR = 4.132731354 # sqrt(2 * pi * e)
+LOG_TWO = 0.693147181
+LEAVE_TIME_MS = 500 # PT = MT - 500
+
+## Columns read from the task CSV export (name: dtype, or None to infer it)
+CSV_COLUMNS = {
+    "指定代號": None,
+    "sequence_loop.thisN": "float64",
+    "trial_loop.thisN": "float64",
+    "from": None,
+    "to": None,
+    "mouse.x": None,
+    "mouse.y": None,
+    "mouse.time": None,
+    "w": "float64",
+    "a": "float64",
+    "leave_time": "float64"
+}
+
+def parse_list_column(column):
+    '''
+    Parses a column of list literals (e.g., "[0.1, 0.25, 0.4]") in one pass into a ragged array:
+    the flat values, and the offsets such that the values of row i are values[offsets[i]:offsets[i + 1]].
+    '''
+    items = column.astype(str).str.strip().str[1:-1].str.split(",")
+    counts = np.fromiter((len(row) if row != [""] else 0 for row in items), dtype=np.int64, count=len(items))
+    offsets = np.r_[0, np.cumsum(counts)]
+    tokens = [token for row in items for token in row if token.strip()]
+    if len(tokens) != offsets[-1]:
+        raise ValueError("Invalid list literal in csv!")
+    values = np.array(tokens, dtype=float) if tokens else np.empty(0)
+    return values, offsets
+
 class GoFittsProcessor:
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, use_jar=True):
         self.data_dir = data_dir
         self.id_column = "指定代號"
         self.half_width = 960
         self.half_height = 540
+        self.use_jar = use_jar
         self.modified_jar_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GoFitts_modified.jar")
 
-    def convert_file(self):
-        df = pd.read_csv(self.file_path)
+    def load_trials(self, file_path):
+        '''
+        Returns the subject ID, one row per trial, the traces (t, x, y as integer arrays in screen coordinates, i.e., ms and pixels,
+        the values written to the .sd3 file) of all trials as a ragged array: the samples of trial i are
+        trace[d][trace["offsets"][i]:trace["offsets"][i + 1]], and the leave time of each trial.
+        '''
+        df = load_csv(file_path, CSV_COLUMNS)
 
         if self.id_column not in df.columns:
             raise ValueError("ID column not found in csv!")
-        self.subject_id = df[self.id_column].iloc[0]
+        subject_id = df[self.id_column].iloc[0]
+        leave_time = df[["sequence_loop.thisN", "leave_time"]]
 
         df = df.loc[:, ["sequence_loop.thisN", "trial_loop.thisN", "from", "to", "mouse.x", "mouse.y", "mouse.time", "w", "a"]]
         df.rename(columns={
@@ -29,29 +72,122 @@ class GoFittsProcessor:
             "mouse.y": "y",
             "mouse.time": "t"
         }, inplace=True)
-        df = df.dropna()
+        df = df.dropna().reset_index(drop=True)
         df["w"] = df["w"].astype(int)
         df["a"] = df["a"].astype(int)
         df["seq"] = df["seq"].astype(int)
         df["trial"] = df["trial"].astype(int)
-        df["x"] = df["x"].apply(lambda str_arr: [str(int(x + self.half_width)) for x in ast.literal_eval(str_arr)])
-        df["y"] = df["y"].apply(lambda str_arr: [str(int(y + self.half_height)) for y in ast.literal_eval(str_arr)])
-        df["t"] = df["t"].apply(lambda str_arr: [str(int(sec * 1000)) for sec in ast.literal_eval(str_arr)])
 
+        x, offsets = parse_list_column(df["x"])
+        y, y_offsets = parse_list_column(df["y"])
+        t, t_offsets = parse_list_column(df["t"])
+        if not (np.array_equal(offsets, y_offsets) and np.array_equal(offsets, t_offsets)):
+            raise ValueError("Mouse traces of different lengths in csv!")
+        if (np.diff(offsets) == 0).any():
+            raise ValueError("Empty mouse trace in csv!")
+        trace = {
+            "t": np.trunc(t * 1000).astype(int),
+            "x": np.trunc(x + self.half_width).astype(int),
+            "y": np.trunc(y + self.half_height).astype(int),
+            "offsets": offsets
+        }
+
+        ## from/to are rounded to 0.1 px (with Python's round, as in the .sd3 file)
+        for column in ["from", "to"]:
+            values, point_offsets = parse_list_column(df[column])
+            if (np.diff(point_offsets) != 2).any():
+                raise ValueError(f"Invalid {column} point in csv!")
+            values = [round(v, 1) for v in values.tolist()]
+            df[f"{column}_x"] = [v + self.half_width for v in values[0::2]]
+            df[f"{column}_y"] = [v + self.half_height for v in values[1::2]]
+
+        return subject_id, df.drop(columns=["from", "to", "x", "y", "t"]), trace, leave_time
+
+    def concat_trials(self, subjects):
+        '''
+        Stacks the (file_path, load_trials() result) pairs into one trial table keyed by a "file" column,
+        one ragged trace array and one leave time table.
+        '''
+        trials = pd.concat([trials.assign(file=file_path) for file_path, (_, trials, _, _) in subjects], ignore_index=True)
+        leave_time = pd.concat([leave_time.assign(file=file_path) for file_path, (_, _, _, leave_time) in subjects], ignore_index=True)
+        traces = [trace for _, (_, _, trace, _) in subjects]
+        trace = { d: np.concatenate([tr[d] for tr in traces]) for d in ["t", "x", "y"] }
+        bases = np.cumsum([0] + [tr["offsets"][-1] for tr in traces[:-1]])
+        trace["offsets"] = np.concatenate([[0]] + [tr["offsets"][1:] + base for tr, base in zip(traces, bases)])
+        return trials, trace, leave_time
+
+    def convert_file(self, file_path, subject_id, trials, trace):
         output_csv_path = os.path.join(
-            os.path.dirname(self.file_path), f"GoFitts-{self.subject_id}.sd3"
-        )        
+            os.path.dirname(file_path), f"GoFitts-{subject_id}.sd3"
+        )
+        offsets = trace["offsets"]
+        samples = { d: trace[d].astype(str) for d in ["t", "x", "y"] }
+        lines = ["TRACE DATA\n", "App,self.subject_id,Condition,Session,Group,TaskType,SelectionMethod,Block,Sequence,A,W,Trial,from_x,from_y,to_x,to_y,{t_x_y}\n"]
+        for i, row in enumerate(trials.itertuples(index=False)):
+            prefix = f"FittsTask,{subject_id},C00,S00,G00,2D,DT0,B00,{row.seq},{row.a},{row.w},{row.trial},{row.from_x},{row.from_y},{row.to_x},{row.to_y}"
+            for d in ["t", "x", "y"]:
+                lines.append(f"{prefix},{d}=,{','.join(samples[d][offsets[i]:offsets[i + 1]])}\n")
         with open(output_csv_path, "w") as f:
-            f.write("TRACE DATA\n")
-            f.write("App,self.subject_id,Condition,Session,Group,TaskType,SelectionMethod,Block,Sequence,A,W,Trial,from_x,from_y,to_x,to_y,{t_x_y}\n")
-            for _, row in df.iterrows():
-                from_x, from_y = [round(_, 1) for _ in ast.literal_eval(row["from"])]
-                to_x, to_y = [round(_, 1) for _ in ast.literal_eval(row["to"])]
-                from_to = ",".join([str(_) for _ in [from_x + self.half_width, from_y + self.half_height, to_x + self.half_width, to_y + self.half_height]])
-                for d in ["t", "x", "y"]:
-                    f.write(f"FittsTask,{self.subject_id},C00,S00,G00,2D,DT0,B00,{row['seq']},{row['a']},{row['w']},{row['trial']},{from_to},{d}=,{','.join(row[d])}\n")
+            f.writelines(lines)
         
         return output_csv_path
+
+    def sequence_summary(self, trials, trace):
+        '''
+        Native equivalent of `java -jar GoFitts_modified.jar -p` (serial 2D task): one row per sequence
+        (run of consecutive trials with the same sequence number) with the mean movement time (MT),
+        the point time (PT) and the effective throughput (TP).
+        When the trials of several files are stacked (column "file"), sequences are split and numbered per file.
+        '''
+        seq = trials["seq"].to_numpy()
+        new_sequence = np.r_[True, seq[1:] != seq[:-1]]
+        if "file" in trials:
+            file = trials["file"].to_numpy()
+            new_sequence |= np.r_[True, file[1:] != file[:-1]]
+        starts = np.flatnonzero(new_sequence)
+        counts = np.diff(np.r_[starts, len(seq)])
+        seq_index = np.repeat(np.arange(len(starts)), counts)
+
+        ## Movement time and selection point (last sample) of each trial
+        first, last = trace["offsets"][:-1], trace["offsets"][1:] - 1
+        mt = (trace["t"][last] - trace["t"][first]).astype(float)
+        select_x = trace["x"][last].astype(float)
+        select_y = trace["y"][last].astype(float)
+        from_x, from_y = trials["from_x"].to_numpy(dtype=float), trials["from_y"].to_numpy(dtype=float)
+        to_x, to_y = trials["to_x"].to_numpy(dtype=float), trials["to_y"].to_numpy(dtype=float)
+
+        ## Deviation of the selection point along the task axis, and effective amplitude
+        a = np.hypot(from_x - to_x, from_y - to_y)
+        b = np.hypot(select_x - to_x, select_y - to_y)
+        c = np.hypot(from_x - select_x, from_y - select_y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dx = (c * c - b * b - a * a) / (2.0 * a)
+        ae = a + dx
+        ## Serial task: each movement starts where the previous selection ended (within a sequence)
+        previous_dx = np.r_[0.0, dx[:-1]]
+        previous_dx[starts] = 0.0
+        ae = ae + previous_dx
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_mt = np.add.reduceat(mt, starts) / counts
+            mean_ae = np.add.reduceat(ae, starts) / counts
+            mean_dx = np.add.reduceat(dx, starts) / counts
+            sd_dx = np.sqrt(np.add.reduceat((dx - mean_dx[seq_index]) ** 2, starts) / (counts - 1))
+            ide = np.log(mean_ae / (WE_FACTOR * sd_dx) + 1) / LOG_TWO
+            tp = ide / (mean_mt / 1000.0)
+
+        seq_df = pd.DataFrame({
+            "Sequence": np.arange(len(starts)),
+            "A": trials["a"].to_numpy()[starts],
+            "W": trials["w"].to_numpy()[starts],
+            "MT": mean_mt,
+            "PT": mean_mt - LEAVE_TIME_MS,
+            "TP": tp
+        })
+        if "file" in trials:
+            seq_df.insert(0, "file", trials["file"].to_numpy()[starts])
+            seq_df["Sequence"] = seq_df.groupby("file", sort=False).cumcount()
+        return seq_df
     
     def parse_with_jar(self, output_csv_path):        
         if not os.path.isfile(self.modified_jar_path):
@@ -60,61 +196,97 @@ class GoFittsProcessor:
             os.system(f"java -jar {self.modified_jar_path} -p {output_csv_path}")
             print("Generated trial and sequence summary!")
 
-    def make_summary(self, seq_summary_path, summary_path):
-        df = pd.read_csv(self.file_path)
-        seq_df = pd.read_csv(seq_summary_path)
-        
-        seq_cnt = len(seq_df)        
-        leave_time = []
-        point_time = []
-        throughput = []
-        
-        for i in range(seq_cnt):
-            leave_time.append(df[df["sequence_loop.thisN"] == i]["leave_time"].dropna().mean() * 1000)
-            point_time.append(seq_df[seq_df["Sequence"] == i]["PT"].item())
-            throughput.append(seq_df[seq_df["Sequence"] == i]["TP"].item())
-        
-        # calculate slope
-        def slope(y):
-            x = np.arange(len(y))
-            A = np.vstack([x, np.ones(len(x))]).T
-            m, _ = np.linalg.lstsq(A, y, rcond=None)[0]
-            return m
-            
-        header = ["ID"]
+    @staticmethod
+    def slope(y):
+        x = np.arange(len(y))
+        A = np.vstack([x, np.ones(len(x))]).T
+        m, _ = np.linalg.lstsq(A, y, rcond=None)[0]
+        return m
+
+    def make_summary(self, seq_df, leave_time, subject_ids):
+        '''
+        Returns one row per file (long-format sequence summary -> wide) with the leave time, point time and throughput
+        of each sequence and their slopes across sequences, and writes each row to GoFitts-<ID>-summary.csv.
+        '''
+        ## Leave time of sequence i: mean leave time of the trials whose sequence number is i
+        leave_time = leave_time.dropna()
+        leave_time = leave_time.groupby(["file", leave_time["sequence_loop.thisN"].astype(int)], sort=False)["leave_time"].mean() * 1000
+        metrics = pd.DataFrame({
+            "file": seq_df["file"],
+            "Sequence": seq_df["Sequence"],
+            "LeaveTime": leave_time.reindex(pd.MultiIndex.from_frame(seq_df[["file", "Sequence"]])).to_numpy(),
+            "PointTime": seq_df["PT"].to_numpy(),
+            "Throughput": seq_df["TP"].to_numpy()
+        })
+
+        files = list(dict.fromkeys(metrics["file"]))
+        wide = metrics.pivot(index="file", columns="Sequence").reindex(files)
+        slopes = metrics.groupby("file", sort=False)[["LeaveTime", "PointTime", "Throughput"]].agg(self.slope).reindex(files)
+        seq_cnt = metrics.groupby("file", sort=False).size().reindex(files)
+
+        summary = { "ID": [subject_ids[file] for file in files] }
         for name in ["LeaveTime", "PointTime", "Throughput"]:
-            for i in range(seq_cnt):
-                header.append(f"GOFITTS_BEH_ID{i}_{name}")
-            header.append(f"GOFITTS_BEH_SLOPE_{name}")
-        
-        data = [self.subject_id]
-        for array in [leave_time, point_time, throughput]:
-            for i in range(seq_cnt):
-                data.append(array[i])
-            data.append(slope(array))
-            
-        with open(summary_path, "w") as file:
-            file.write(",".join(header))
-            file.write('\n')
-            file.write(",".join([str(x) for x in data]))
-            file.write('\n')
-        
-        print("Generated final summary!")    
+            for i in range(seq_cnt.max()):
+                summary[f"GOFITTS_BEH_ID{i}_{name}"] = wide[(name, i)].to_numpy()
+            summary[f"GOFITTS_BEH_SLOPE_{name}"] = slopes[name].to_numpy()
+        summary = pd.DataFrame(summary, index=pd.Index(files, name="file_path"))
 
-    def process_subject(self, file_path):
-        self.file_path = file_path
-        output_csv_path = self.convert_file()
-        self.parse_with_jar(output_csv_path)
-        seq_summary_path = os.path.join(os.path.dirname(self.file_path), f"GoFitts-{self.subject_id}-sequence-summary.csv")
-        summary_path = os.path.join(os.path.dirname(self.file_path), f"GoFitts-{self.subject_id}-summary.csv")
-        self.make_summary(seq_summary_path, summary_path)
-        df = pd.read_csv(summary_path)
-        df = df.rename(columns={'ID': self.id_column})
+        for file_path, row in summary.iterrows():
+            header = ["ID"] + [
+                column for column in summary.columns[1:]
+                if "SLOPE" in column or int(column.split("_")[2][2:]) < seq_cnt[file_path]
+            ]
+            summary_path = os.path.join(os.path.dirname(file_path), f"GoFitts-{row['ID']}-summary.csv")
+            with open(summary_path, "w") as file:
+                file.write(",".join(header))
+                file.write('\n')
+                file.write(",".join([str(row[column]) for column in header]))
+                file.write('\n')
         
-        return df
+        print("Generated final summary!")
+        return summary.rename(columns={'ID': self.id_column})
 
-    
+    def process_many(self, file_paths, max_workers=8):
+        '''
+        Reads and parses the files (one per subject) concurrently, computes the sequence summaries of all subjects at once
+        (or runs the JAR on each file when use_jar) and returns one row per subject (indexed by subject ID).
+        A file that cannot be read or processed only leaves out its subject; its exception is kept in
+        output.attrs["failures"] ({file_path: exception}).
+        '''
+        failures = {}
+        subjects = read_concurrently(self.load_trials, file_paths, max_workers=max_workers, failures=failures)
+        for file_path, (_, trials, _, _) in subjects:
+            if trials.empty:
+                print(f"No trials found in {file_path}")
+        subjects = [(file_path, subject) for file_path, subject in subjects if not subject[1].empty]
+        output = compute_by_file(
+            self.summarize, subjects or None, failures,
+            split=lambda subjects: [(file_path, [(file_path, subject)]) for file_path, subject in subjects]
+        )
+        return by_subject(output, failures)
+
+    def summarize(self, subjects):
+        '''
+        Returns the summary of the (file_path, load_trials() result) pairs, one row per file (indexed by file path).
+        '''
+        subject_ids = { file_path: subject[0] for file_path, subject in subjects }
+        trials, trace, leave_time = self.concat_trials(subjects)
 
+        def seq_summary_path(file_path):
+            return os.path.join(os.path.dirname(file_path), f"GoFitts-{subject_ids[file_path]}-sequence-summary.csv")
 
+        if self.use_jar:
+            seq_dfs = []
+            for file_path, (subject_id, subject_trials, subject_trace, _) in subjects:
+                self.parse_with_jar(self.convert_file(file_path, subject_id, subject_trials, subject_trace))
+                seq_dfs.append(pd.read_csv(seq_summary_path(file_path)).assign(file=file_path))
+            seq_df = pd.concat(seq_dfs, ignore_index=True)
+        else:
+            seq_df = self.sequence_summary(trials, trace)
+            for file_path, file_seq_df in seq_df.groupby("file", sort=False):
+                file_seq_df.drop(columns="file").to_csv(seq_summary_path(file_path), index=False)
+
+        return self.make_summary(seq_df, leave_time, subject_ids)
 
-    
\ No newline at end of file
+    def process_subject(self, file_path):
+        return single_subject(self.process_many([file_path], max_workers=1), file_path)
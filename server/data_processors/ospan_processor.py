@@ -1,47 +1,65 @@
 import os
 import pandas as pd
 
+from data_processors.batch import read_concurrently, concat_long, compute_by_file, by_subject, single_subject
+from data_processors.csv_loader import load_csv
+
+## Columns read from the task CSV export (name: dtype, or None to infer it)
+CSV_COLUMNS = {
+    '指定代號': None,
+    'MathResult': 'float64',
+    'LetterResult': 'float64'
+}
+
 class OspanProcessor:
     def __init__(self, data_dir):
         self.data_dir = data_dir
         self.trial_n = (4*3) + (6*3) # There are 75 trials in the ospan task, but only 30 trials in the online version.
 
-    def create_index(self, data, trial_n):
-        output = list(data.index)
-        output.reverse()
-        output = output[:trial_n]
-        output.reverse()
-        return output
-
-    def select_item(self, data, trial_n):
-        output = data.dropna(how='any')
-        index = self.create_index(output, trial_n)
-        return output.loc[index, :]
+    def read_file(self, file_path):
+        data = load_csv(file_path, CSV_COLUMNS)
+        id = data.loc[0, '指定代號']
+        return data[['MathResult', 'LetterResult']].assign(ID=id)
 
-    def math_analysis(self, data):
-        output = data[['MathResult']]
-        output = self.select_item(output, self.trial_n)
-        return output.mean().values[0]
+    def select_item(self, data, column, trial_n):
+        ## Keeps the last trial_n non-missing values of each file
+        output = data[['file', column]].dropna(how='any')
+        return output.groupby('file', sort=False).tail(trial_n)
 
-    def letter_analysis(self, data):
-        output = data[['LetterResult']]
-        output = self.select_item(output, self.trial_n)
-        return output.mean().values[0]
+    def math_analysis(self, data, files):
+        output = self.select_item(data, 'MathResult', self.trial_n)
+        return output.groupby('file', sort=False)['MathResult'].mean().reindex(files)
 
-    def process_subject(self, file_path):
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}")
-            return None
+    def letter_analysis(self, data, files):
+        output = self.select_item(data, 'LetterResult', self.trial_n)
+        return output.groupby('file', sort=False)['LetterResult'].mean().reindex(files)
 
-        data = pd.read_csv(file_path)
-        id = data.loc[0, '指定代號']
-        math_result = self.math_analysis(data)
-        letter_result = self.letter_analysis(data)
+    def compute(self, data):
+        '''
+        Computes the metrics of all files of the long-format trial frame (column "file") and returns one row per file.
+        '''
+        files = pd.Index(list(dict.fromkeys(data['file'])), name='file_path')
+        ids = data.groupby('file', sort=False)['ID'].first().reindex(files)
+        math_result = self.math_analysis(data, files)
+        letter_result = self.letter_analysis(data, files)
 
         output = pd.DataFrame({
-            'ID': [id],
-            'MEMORY_OSPAN_BEH_MATH_ACCURACY': [math_result],
-            'MEMORY_OSPAN_BEH_LETTER_ACCURACY': [letter_result]
-        }) 
+            'ID': ids.to_numpy(),
+            'MEMORY_OSPAN_BEH_MATH_ACCURACY': math_result.to_numpy(),
+            'MEMORY_OSPAN_BEH_LETTER_ACCURACY': letter_result.to_numpy()
+        }, index=files)
 
         return output
+
+    def process_many(self, file_paths, max_workers=8):
+        '''
+        Reads the files (one per subject) concurrently and returns one row per subject (indexed by subject ID).
+        A file that cannot be read or processed only leaves out its subject; its exception is kept in
+        output.attrs["failures"] ({file_path: exception}).
+        '''
+        failures = {}
+        data = concat_long(read_concurrently(self.read_file, file_paths, max_workers=max_workers, failures=failures))
+        return by_subject(compute_by_file(self.compute, data, failures), failures)
+
+    def process_subject(self, file_path):
+        return single_subject(self.process_many([file_path], max_workers=1), file_path)
@@ -1,42 +1,76 @@
 import os
+import numpy as np
 import pandas as pd
 
+from data_processors.batch import read_concurrently, concat_long, compute_by_file, by_subject, single_subject
+from data_processors.csv_loader import load_csv
+
+## Columns read from the task CSV export (name: dtype, or None to infer it)
+CSV_COLUMNS = {
+    'condition': None,
+    'stim_resp.corr': 'float64',
+    'duration': 'float64'
+}
+
 class SpeechcompProcessor:
     def __init__(self, data_dir):
         self.data_dir = data_dir
 
-    def process_subject(self, file_path):
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}")
-            return None
-
+    def read_file(self, file_path):
         # Read table
-        t = pd.read_csv(file_path)
+        t = load_csv(file_path, CSV_COLUMNS)
 
         # Get subject ID
         subject_id = os.path.basename(file_path).split('_')[0]
 
+        return t[['condition', 'stim_resp.corr', 'duration']].assign(ID=subject_id)
+
+    def compute(self, t):
+        '''
+        Computes the metrics of all files of the long-format trial frame (column "file") and returns one row per file.
+        '''
+        files = pd.Index(list(dict.fromkeys(t['file'])), name='file_path')
+        ids = t.groupby('file', sort=False)['ID'].first().reindex(files)
+
         # Fill NaNs in the 'condition' column with an empty string
-        t['condition'] = t['condition'].fillna('')
+        t = t.assign(condition=t['condition'].fillna(''))
 
         # Get condition index
-        act = t['condition'].str.contains('action')
-        obj = t['condition'].str.contains('object')
+        # act = t['condition'].str.contains('action')
+        # obj = t['condition'].str.contains('object')
         pas = t['condition'].str.contains('passive')
+        pas_corr = pas & (t['stim_resp.corr'] == 1)
 
-        # Calculate accuracies and reaction times with checks for division by zero
-        # action_accuracy = (t.loc[act, 'stim_resp.corr'].sum() * 100 / act.sum()) if act.sum() > 0 else float('nan')
-        # object_accuracy = (t.loc[obj, 'stim_resp.corr'].sum() * 100 / obj.sum()) if obj.sum() > 0 else float('nan')
-        passive_accuracy = (t.loc[pas, 'stim_resp.corr'].sum() * 100 / pas.sum()) if pas.sum() > 0 else float('nan')
-
-        # action_rt = t.loc[act & (t['stim_resp.corr'] == 1), 'duration'].mean() if (act & (t['stim_resp.corr'] == 1)).sum() > 0 else float('nan')
-        # object_rt = t.loc[obj & (t['stim_resp.corr'] == 1), 'duration'].mean() if (obj & (t['stim_resp.corr'] == 1)).sum() > 0 else float('nan')
-        passive_rt = t.loc[pas & (t['stim_resp.corr'] == 1), 'duration'].mean() if (pas & (t['stim_resp.corr'] == 1)).sum() > 0 else float('nan')
+        # Calculate accuracies and reaction times per file (NaN when a file has no passive trials)
+        by_file = pd.DataFrame({
+            'file': t['file'],
+            'pas': pas,
+            'pas_corr_sum': t['stim_resp.corr'].where(pas, 0),
+            'pas_rt': t['duration'].where(pas_corr)
+        }).groupby('file', sort=False).agg(
+            pas_n=('pas', 'sum'),
+            pas_corr_sum=('pas_corr_sum', 'sum'),
+            passive_rt=('pas_rt', 'mean')
+        ).reindex(files)
+        passive_accuracy = (by_file['pas_corr_sum'] * 100 / by_file['pas_n'].where(by_file['pas_n'] > 0))
 
         output = pd.DataFrame({
-            'ID': [subject_id],
-            'SPEECHCOMP_PASSIVE_ACCURACY': [passive_accuracy],
-            'SPEECHCOMP_PASSIVE_RT': [passive_rt]
-        })
+            'ID': ids.to_numpy(),
+            'SPEECHCOMP_PASSIVE_ACCURACY': passive_accuracy.to_numpy(dtype=float),
+            'SPEECHCOMP_PASSIVE_RT': by_file['passive_rt'].to_numpy(dtype=float)
+        }, index=files)
+
+        return output
 
-        return output
\ No newline at end of file
+    def process_many(self, file_paths, max_workers=8):
+        '''
+        Reads the files (one per subject) concurrently and returns one row per subject (indexed by subject ID).
+        A file that cannot be read or processed only leaves out its subject; its exception is kept in
+        output.attrs["failures"] ({file_path: exception}).
+        '''
+        failures = {}
+        data = concat_long(read_concurrently(self.read_file, file_paths, max_workers=max_workers, failures=failures))
+        return by_subject(compute_by_file(self.compute, data, failures), failures)
+
+    def process_subject(self, file_path):
+        return single_subject(self.process_many([file_path], max_workers=1), file_path)
@@ -2,19 +2,175 @@
 
 import os
 import sys
+import time
+import wave
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
 import whisper_timestamped as whisper
 from whisper_timestamped.transcribe import write_csv, flatten
 
+SILENCE_LEN = 150 # ms
+SILENCE_THRESH = -40 # dBFS
+WHISPER_TRANSCRIBE_OPTIONS = {
+    "beam_size": 5, 
+    "best_of": 5,
+    "temperature": (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+    "language": "Chinese", 
+    "remove_empty_words": True,
+    "vad": True, 
+    "detect_disfluencies": True,
+    "remove_punctuation_from_words": True
+}
+
+## Whisper models are loaded once per process and shared by all TextReadingProcessor objects;
+## whisper_timestamped hooks into the model while transcribing, so each model is used by one thread at a time
+_whisper_models = {}
+_whisper_models_lock = threading.Lock()
+
+def get_whisper_model(model_name="base", device=None):
+    '''
+    Returns the cached Whisper model, loading it on first use.
+    device=None lets Whisper pick CUDA when available.
+    '''
+    key = (model_name, device)
+    with _whisper_models_lock:
+        if key not in _whisper_models:
+            start = time.perf_counter()
+            model = whisper.load_model(model_name, device=device)
+            _whisper_models[key] = (model, threading.Lock())
+            print(f"Loaded Whisper model '{model_name}' ({model.device}) in {time.perf_counter() - start:.1f} s")
+        return _whisper_models[key]
+
+## ====================================================================================
+## Vectorized equivalents of pydub.silence.detect_silence() / split_on_silence() on NumPy sample arrays
+## (same min_silence_len / silence_thresh / keep_silence / seek_step semantics, positions in ms);
+## the RMS of every min_silence_len window is computed at once from a cumulative sum of squares.
+
+SAMPLE_DTYPES = { 1: np.int8, 2: np.int16, 4: np.int32 } # sample width (bytes) -> dtype
+
+def _segment_len_ms(samples, frame_rate, channels):
+    return int(round(1000 * (len(samples) // channels) / frame_rate))
+
+def _ms_to_frames(ms, frame_rate):
+    ## same rounding as AudioSegment slicing: int(ms * frame_rate / 1000) frames
+    return (np.asarray(ms) * (frame_rate / 1000.0)).astype(np.int64)
+
+def detect_silence(samples, frame_rate, channels=1, min_silence_len=1000, silence_thresh=-16, seek_step=1, max_amplitude=32768):
+    '''
+    Returns the [start, end] (ms) of the silent ranges of interleaved integer samples.
+    '''
+    seg_len = _segment_len_ms(samples, frame_rate, channels)
+    if seg_len < min_silence_len:
+        return []
+    n_frames = len(samples) // channels
+    thresh = 10 ** (silence_thresh / 20) * max_amplitude
+
+    last_slice_start = seg_len - min_silence_len
+    slice_starts = np.arange(0, last_slice_start + 1, seek_step)
+    if last_slice_start % seek_step:
+        slice_starts = np.append(slice_starts, last_slice_start)
+
+    ## audioop.rms() of every window, truncated to an int as in pydub;
+    ## like AudioSegment slicing, a window running past the end (ms rounding) is padded with zeros
+    acc_dtype = np.int64 if max_amplitude <= 32768 else np.float64
+    squares = np.concatenate([[0], np.cumsum(samples.astype(acc_dtype) ** 2)])
+    a_frames = _ms_to_frames(slice_starts, frame_rate)
+    b_frames = _ms_to_frames(slice_starts + min_silence_len, frame_rate)
+    a = np.minimum(a_frames, n_frames) * channels
+    b = np.minimum(b_frames, n_frames) * channels
+    n_samples = np.where(b > a, (b_frames - a_frames) * channels, 1)
+    rms = np.floor(np.sqrt((squares[b] - squares[a]) / n_samples))
+    silence_starts = slice_starts[rms <= thresh]
+    if len(silence_starts) == 0:
+        return []
+
+    ## Windows are merged into one range unless they are neither continuous nor within min_silence_len
+    gaps = np.diff(silence_starts)
+    breaks = np.flatnonzero((gaps != seek_step) & (gaps > min_silence_len))
+    range_starts = silence_starts[np.concatenate([[0], breaks + 1])]
+    range_ends = silence_starts[np.concatenate([breaks, [len(silence_starts) - 1]])] + min_silence_len
+    return [ [int(start), int(end)] for start, end in zip(range_starts, range_ends) ]
+
+def detect_nonsilent(samples, frame_rate, channels=1, min_silence_len=1000, silence_thresh=-16, seek_step=1, max_amplitude=32768):
+    silent_ranges = detect_silence(samples, frame_rate, channels, min_silence_len, silence_thresh, seek_step, max_amplitude)
+    seg_len = _segment_len_ms(samples, frame_rate, channels)
+    if not silent_ranges:
+        return [[0, seg_len]]
+    if silent_ranges[0] == [0, seg_len]:
+        return []
+
+    nonsilent_ranges = []
+    prev_end = 0
+    for start, end in silent_ranges:
+        nonsilent_ranges.append([prev_end, start])
+        prev_end = end
+    if end != seg_len:
+        nonsilent_ranges.append([prev_end, seg_len])
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+    return nonsilent_ranges
+
+def split_on_silence_ranges(samples, frame_rate, channels=1, min_silence_len=1000, silence_thresh=-16, keep_silence=100, seek_step=1, max_amplitude=32768):
+    '''
+    Returns the [start, end] (ms) of the chunks that pydub.silence.split_on_silence() would return.
+    '''
+    seg_len = _segment_len_ms(samples, frame_rate, channels)
+    if isinstance(keep_silence, bool):
+        keep_silence = seg_len if keep_silence else 0
+
+    output_ranges = [
+        [start - keep_silence, end + keep_silence]
+        for start, end in detect_nonsilent(samples, frame_rate, channels, min_silence_len, silence_thresh, seek_step, max_amplitude)
+    ]
+    ## Overlapping kept silences are split in the middle
+    for range_i, range_ii in zip(output_ranges, output_ranges[1:]):
+        if range_ii[0] < range_i[1]:
+            range_i[1] = (range_i[1] + range_ii[0]) // 2
+            range_ii[0] = range_i[1]
+
+    return [ [max(start, 0), min(end, seg_len)] for start, end in output_ranges ]
+
+def remove_silence(samples, frame_rate, channels=1, min_silence_len=1000, silence_thresh=-16, keep_silence=100, seek_step=1, max_amplitude=32768):
+    '''
+    Concatenates the chunks of split_on_silence_ranges() with a single copy.
+    '''
+    ranges = split_on_silence_ranges(
+        samples, frame_rate, channels, min_silence_len, silence_thresh, keep_silence, seek_step, max_amplitude
+    )
+    if not ranges:
+        return samples[:0]
+    n_frames = len(samples) // channels
+    pieces = []
+    for start_frame, end_frame in _ms_to_frames(ranges, frame_rate):
+        start, end = min(start_frame, n_frames) * channels, min(end_frame, n_frames) * channels
+        pieces.append(samples[start:end])
+        if end > start and end_frame > n_frames: # zero padding of AudioSegment slicing (ms rounding)
+            pieces.append(np.zeros((end_frame - n_frames) * channels, dtype=samples.dtype))
+    return np.concatenate(pieces)
+
+## ====================================================================================
+
 class TextReadingProcessor:
 
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, model_name="base", device=None, streaming=False, keep_intermediate=False, cache=None):
         self.data_dir = data_dir
         self.base_path = os.path.dirname(os.path.abspath(__file__))
+        self.model_name = model_name
+        self.device = device
+        self.streaming = streaming # decode each recording once into memory instead of writing .wav files (changes MeanSR slightly)
+        self.keep_intermediate = keep_intermediate # streaming mode: still write the de-silenced .wav for debugging
+        self.sample_rate = 16000 # Whisper input sample rate (whisper.load_audio() resamples to it)
+        self.cache = cache # TranscriptionCache (see transcription_cache.py) or None
+
+    def warm_up(self):
+        '''
+        Loads the Whisper model ahead of the first request.
+        '''
+        get_whisper_model(self.model_name, self.device)
 
     def webm2wav(self, audio_file):
         if ".webm" in audio_file:
@@ -27,60 +183,162 @@ class TextReadingProcessor:
             raise ValueError("Unsupported audio format. Please provide a .webm or .wav file.")
         return out_file
 
-    def de_silence(self, audio_file, silence_len=150):
+    def de_silence(self, audio_file, silence_len=SILENCE_LEN):
         audio = AudioSegment.from_file(audio_file)
         loudness = audio.dBFS
         print(f"loudness={loudness}")
 
-        chunks = split_on_silence(
-            audio,
+        if audio.sample_width not in SAMPLE_DTYPES: # 24-bit
+            audio = audio.set_sample_width(4)
+        samples = np.frombuffer(audio.raw_data, dtype=SAMPLE_DTYPES[audio.sample_width])
+        samples = remove_silence(
+            samples, audio.frame_rate, audio.channels, 
             min_silence_len=silence_len,
-            silence_thresh=-40
+            silence_thresh=SILENCE_THRESH, 
+            max_amplitude=audio.max_possible_amplitude
+        )
+        processed_audio = AudioSegment(
+            samples.tobytes(), frame_rate=audio.frame_rate, sample_width=audio.sample_width, channels=audio.channels
         )
-        processed_audio = AudioSegment.empty()
-        for chunk in chunks:
-            processed_audio += chunk
 
         out_file = audio_file.replace(".wav", "_ds.wav")
         processed_audio.export(out_file, format="wav")
         print("Successfully removed silence from audio file.")
         return out_file
     
-    def whisper_label(self, audio_file):
+    def de_silence_array(self, audio, silence_len=SILENCE_LEN):
         '''
-        Generate transcription labels using Whisper.
+        Same as de_silence(), on a 16 kHz mono float32 array instead of a .wav file.
         '''
-        audio = whisper.load_audio(audio_file)
-        model = whisper.load_model("base") # , device="cpu"
-        result = whisper.transcribe(
-            model, 
-            audio, 
-            beam_size=5, 
-            best_of=5,
-            temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
-            language="Chinese", 
-            remove_empty_words=True,
-            vad=True, 
-            detect_disfluencies=True,
-            remove_punctuation_from_words=True
+        samples = np.clip(audio * 32768, -32768, 32767).astype(np.int16) # same scale as a 16-bit .wav
+        print(f"loudness={20 * np.log10(max(np.sqrt(np.mean(samples.astype(np.float64) ** 2)), 1e-10) / 32768):.2f}")
+
+        samples = remove_silence(
+            samples, self.sample_rate, 
+            min_silence_len=silence_len,
+            silence_thresh=SILENCE_THRESH
         )
-        csv_file = f"{audio_file}.words.csv"
+        print("Successfully removed silence from audio.")
+        return samples.astype(np.float32) / 32768.0
+
+    def write_wav(self, audio, out_file):
+        samples = np.clip(audio * 32768, -32768, 32767).astype(np.int16)
+        with wave.open(out_file, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+            f.writeframes(samples.tobytes())
+
+    def whisper_label(self, audio, csv_file=None):
+        '''
+        Generate transcription labels using Whisper.
+        audio is either an audio file path (the labels are written to <audio>.words.csv)
+        or a 16 kHz mono float32 array (the labels are written to csv_file).
+        '''
+        if isinstance(audio, str):
+            csv_file = f"{audio}.words.csv"
+            audio = whisper.load_audio(audio)
+        model, model_lock = get_whisper_model(self.model_name, self.device)
+        with model_lock:
+            result = whisper.transcribe(model, audio, **WHISPER_TRANSCRIBE_OPTIONS)
         with open(csv_file, "w", encoding="utf-8") as csv:
             write_csv(flatten(result["segments"], "words"), file=csv)
         print("Successfully generated transcription labels using Whisper.")
         return csv_file
 
-    def generate_csv(self, audio_file):
-        try:
-            audio_file = self.webm2wav(audio_file)
-            audio_file = self.de_silence(audio_file)
-            csv_file = self.whisper_label(audio_file)
-            print(f"CSV generated: {csv_file}")
-            return csv_file
+    def prepare_audio(self, audio_file):
+        '''
+        CPU stages before transcription: decoding/conversion and silence removal.
+        Returns the (audio, csv_file) arguments of whisper_label().
         
-        except Exception as e:
-            print(f"Error processing audio file: {e}")
-            return None
+        In streaming mode, the recording is decoded once by ffmpeg into a 16 kHz float32 array,
+        and silence is removed in memory; no intermediate file is written unless keep_intermediate is set.
+        The labels keep the file name of the file-based mode (<recording>_ds.wav.words.csv).
+        '''
+        if not self.streaming:
+            audio_file = self.webm2wav(audio_file)
+            return self.de_silence(audio_file), None
+
+        if not audio_file.endswith((".webm", ".wav")):
+            raise ValueError("Unsupported audio format. Please provide a .webm or .wav file.")
+        ds_file = f"{os.path.splitext(audio_file)[0]}_ds.wav"
+        audio = whisper.load_audio(audio_file)
+        audio = self.de_silence_array(audio)
+        if self.keep_intermediate:
+            self.write_wav(audio, ds_file)
+        return audio, f"{ds_file}.words.csv"
+
+    def labels_path(self, audio_file):
+        if self.streaming:
+            return f"{os.path.splitext(audio_file)[0]}_ds.wav.words.csv"
+        return audio_file.replace(".webm", ".wav").replace(".wav", "_ds.wav") + ".words.csv"
+
+    def transcription_params(self):
+        '''
+        Everything besides the recording itself that affects the labels (fingerprinted by the cache).
+        '''
+        return {
+            "model": self.model_name,
+            "whisper_timestamped": getattr(whisper, "__version__", None),
+            "options": WHISPER_TRANSCRIBE_OPTIONS,
+            "streaming": self.streaming,
+            "silence_len": SILENCE_LEN,
+            "silence_thresh": SILENCE_THRESH
+        }
+
+    def get_cached_labels(self, audio_file):
+        '''
+        Returns (cache key, labels file); the labels file is None on a cache miss.
+        '''
+        if self.cache is None:
+            return None, None
+        try:
+            key = self.cache.key(audio_file, self.transcription_params())
+        except OSError:
+            return None, None
+        csv_file = self.labels_path(audio_file)
+        return key, csv_file if self.cache.get(key, csv_file) else None
+
+    def generate_csv(self, audio_file):
+        return self.generate_csvs([audio_file], prep_workers=1)[0]
+
+    def generate_csvs(self, audio_files, prep_workers=4):
+        '''
+        Pipelined version of generate_csv() for many files:
+        conversion and silence removal run in a pool of prep_workers threads (ffmpeg runs as a subprocess),
+        while the prepared files are transcribed one by one as they become ready, 
+        so the preparation of the next files overlaps with the transcription of the current one.
+        Returns the CSV files in the order of audio_files (None for a file that failed).
+        '''
+        csv_files = [None] * len(audio_files)
+        cache_keys = [None] * len(audio_files)
+
+        ## Recordings already transcribed with the same parameters are taken from the cache
+        for i, audio_file in enumerate(audio_files):
+            cache_keys[i], csv_files[i] = self.get_cached_labels(audio_file)
+            if csv_files[i] is not None:
+                print(f"CSV taken from the transcription cache: {csv_files[i]}")
+
+        with ThreadPoolExecutor(max_workers=max(1, prep_workers), thread_name_prefix="textreading-prep") as executor:
+            futures = { 
+                i: executor.submit(self.prepare_audio, audio_file) 
+                for i, audio_file in enumerate(audio_files) if csv_files[i] is None 
+            }
+            for i, future in futures.items():
+                try:
+                    csv_files[i] = self.whisper_label(*future.result())
+                    print(f"CSV generated: {csv_files[i]}")
+                except Exception as e:
+                    print(f"Error processing audio file {audio_files[i]}: {e}")
+                    continue
+                if cache_keys[i] is not None:
+                    ## A failed cache write only costs a new transcription next time
+                    try:
+                        self.cache.put(cache_keys[i], csv_files[i], source=audio_files[i], params=self.transcription_params())
+                    except Exception as e:
+                        print(f"Warning: could not cache the transcription of {audio_files[i]}: {e}")
+
+        return csv_files
         
     def calculate_mean_syllable_speech_rate(self, csv_files):
         syllable_speech_rates = []
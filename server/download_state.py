@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# State of the TextReading media downloads per participant, kept in a SQLite database (data/.download_state.db, WAL mode):
+# the path of the CSV file, the session token, the number of media files expected (uploaded) and downloaded,
+# the download status ("awaiting", "downloaded" or "ignored") and whether is_file_ready has been set in the QOCA task.
+# It replaces the subj_webm_downloaded.txt and subj_webm_ignored.txt ledgers, which are migrated
+# automatically when the database is created, or manually with: python download_state.py migrate
+#
+# Usage: python download_state.py {list,stats,migrate} [-s <STATUS>]
+
+import os
+import json
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from contextlib import closing
+
+from dotenv import load_dotenv
+
+FIELDS = ["csv_path", "session_token", "status", "expected_media", "downloaded_media", "is_file_ready"]
+
+class DownloadState:
+    def __init__(self, db_path, migrate_from=None, timeout=30):
+        self.db_path = db_path
+        self.timeout = timeout
+        is_new = not os.path.exists(db_path)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS subjects ("
+                "  subject_id TEXT PRIMARY KEY,"
+                "  csv_path TEXT,"
+                "  session_token TEXT,"
+                "  status TEXT NOT NULL DEFAULT 'awaiting',"
+                "  expected_media INTEGER,"
+                "  downloaded_media INTEGER NOT NULL DEFAULT 0,"
+                "  is_file_ready INTEGER NOT NULL DEFAULT 0,"
+                "  updated_at TEXT NOT NULL"
+                ")"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS subjects_status ON subjects (status)")
+
+        if is_new and migrate_from is not None:
+            n_subjects = self.migrate_from_ledgers(*migrate_from)
+            if n_subjects:
+                print(f"Migrated {n_subjects} subjects from the download ledgers to {db_path}")
+
+    def _connect(self):
+        ## isolation_level=None: each statement is committed on its own (i.e., atomically)
+        return sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+
+    def get(self, subject_id):
+        '''
+        Returns the state of the subject as a dict, or None if it is unknown.
+        '''
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM subjects WHERE subject_id = ?", (subject_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, subject_id, **fields):
+        '''
+        Inserts the subject or updates the given fields (see FIELDS) of its state.
+        '''
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        fields["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in fields)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                f"INSERT INTO subjects (subject_id, {columns}) VALUES (?, {placeholders}) "
+                f"ON CONFLICT (subject_id) DO UPDATE SET {updates}",
+                (subject_id, *fields.values())
+            )
+
+    def statuses(self):
+        '''
+        Returns a dict of {subject_id: status} of all subjects.
+        '''
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT subject_id, status FROM subjects").fetchall())
+
+    def subjects(self, status=None):
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            if status is None:
+                rows = conn.execute("SELECT * FROM subjects ORDER BY subject_id").fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM subjects WHERE status = ? ORDER BY subject_id", (status,)).fetchall()
+        return [ dict(row) for row in rows ]
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM subjects GROUP BY status").fetchall())
+            n_file_ready = conn.execute("SELECT COUNT(*) FROM subjects WHERE is_file_ready = 1").fetchone()[0]
+        return { "subjects": sum(counts.values()), **counts, "is_file_ready": n_file_ready }
+
+    def migrate_from_ledgers(self, downloaded_path, ignored_path):
+        '''
+        Copies the subjects listed in subj_webm_downloaded.txt and subj_webm_ignored.txt into the database.
+        Subjects already in the database are kept.
+        '''
+        updated_at = datetime.now().isoformat(timespec="seconds")
+        rows = {}
+        for path, status in [(ignored_path, "ignored"), (downloaded_path, "downloaded")]: # "downloaded" wins
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        rows[line.strip()] = status
+
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO subjects (subject_id, status, updated_at) VALUES (?, ?, ?)",
+                    [ (subject_id, status, updated_at) for subject_id, status in rows.items() ]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+## States shared per database
+
+_download_states = {}
+_download_states_lock = threading.Lock()
+
+def make_download_state(data_dir):
+    '''
+    Returns the state store of the downloads into data_dir (the TextReading data directory),
+    migrating its ledgers when the database is created.
+    '''
+    db_path = os.path.join(os.path.dirname(os.path.realpath(data_dir)), ".download_state.db")
+    with _download_states_lock:
+        if db_path not in _download_states:
+            _download_states[db_path] = DownloadState(db_path, migrate_from=(
+                os.path.join(data_dir, "subj_webm_downloaded.txt"),
+                os.path.join(data_dir, "subj_webm_ignored.txt")
+            ))
+        return _download_states[db_path]
+
+## ====================================================================================
+
+if __name__ == "__main__":
+    load_dotenv()
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(source_dir, "..", "data", os.getenv("EXPERIMENT_TEXTREADING_NAME"))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["list", "stats", "migrate"])
+    parser.add_argument("-s", "--status", type=str, default=None, choices=["awaiting", "downloaded", "ignored"],
+                        help="list: only the subjects with this status.")
+    args = parser.parse_args()
+
+    state = make_download_state(data_dir)
+
+    if args.command == "list":
+        for s in state.subjects(args.status):
+            print(f"{s['subject_id']}  {s['status']:10s}  {s['downloaded_media']}/{s['expected_media'] if s['expected_media'] is not None else '?'} media"
+                  f"  is_file_ready={s['is_file_ready']}  {os.path.basename(s['csv_path'] or '')}")
+
+    elif args.command == "stats":
+        print(json.dumps(state.stats(), indent=2))
+
+    elif args.command == "migrate":
+        n_subjects = state.migrate_from_ledgers(
+            os.path.join(data_dir, "subj_webm_downloaded.txt"),
+            os.path.join(data_dir, "subj_webm_ignored.txt")
+        )
+        print(f"Migrated {n_subjects} subjects")
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 
 import os
-import glob
+import re
+import json
+import base64
+import hashlib
 import logging
 from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import pandas as pd
 from dotenv import load_dotenv
 
+import http_client
+from file_index import get_file_index
+from download_state import make_download_state
+
 class Config:
     def __init__(self):
         self.source_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,10 +28,11 @@ class Config:
             "oauthToken": self.gitlab_token
         }
         self.data_dir = os.path.join(self.source_dir, "..", "data", self.experiment_name)
-        self.subj_webm_downloaded = os.path.join(self.data_dir, "subj_webm_downloaded.txt")
-        self.subj_webm_ignored = os.path.join(self.data_dir, "subj_webm_ignored.txt")
+        self.media_cache_path = os.path.join(self.source_dir, "..", "data", f".media_{self.experiment_id}.json") # outside data_dir, not to trigger rescans of its file index
         self.log_dir = os.path.join(self.source_dir, "..", "logs")
         self.log_fn_format = "downloadTextReadingFiles_%Y-%m-%d.log"
+        self.download_workers = int(os.getenv("WEBM_DOWNLOAD_WORKERS", 4)) # files downloaded concurrently (at most HTTP_POOL_SIZE connections per host)
+        self.download_chunk_size = int(os.getenv("WEBM_DOWNLOAD_CHUNK_KB", 1024)) * 1024
 
 def setup_logger(config):
     logging.root.handlers = []
@@ -36,61 +45,202 @@ def setup_logger(config):
     return logger
 
 def list_awaiting_files(config, logger):
-    csv_files = glob.glob(os.path.join(config.data_dir, "*Z.csv")) # raw experimental data
-    subj_list = [ os.path.basename(f).split("_")[0] for f in csv_files ]
-    webm_files = glob.glob(os.path.join(config.data_dir, "*.webm")) # raw audio data
-    subj_of_webm = [ os.path.basename(f).split("_")[0] for f in webm_files ]
-    try:
-        subj_webm_downloaded = ( # subjects marked as having downloaded their webm files
-            pd.read_csv(config.subj_webm_downloaded, header=None)
-            .values.flatten().tolist()
-        ) 
-    except:
-        subj_webm_downloaded = []
-    try:
-        subj_webm_ignored = ( # subjects marked as not needing to download their webm files
-            pd.read_csv(config.subj_webm_ignored, header=None)
-            .values.flatten().tolist()
-        ) 
-    except:
-        subj_webm_ignored = []
-
-    subj_awaiting = list(set(subj_list) - set(subj_webm_downloaded) - set(subj_webm_ignored))
+    state = make_download_state(config.data_dir)
+    file_index = get_file_index(config.data_dir)
+    csv_filepaths = {}
+    for f in file_index.glob("*Z.csv"): # raw experimental data
+        csv_filepaths.setdefault(os.path.basename(f).split("_")[0], f)
+    num_of_webm = Counter( # raw audio data
+        os.path.basename(f).split("_")[0] for f in file_index.glob("*.webm")
+    )
+    statuses = state.statuses() # subjects marked as having downloaded (or not needing to download) their webm files
+
     not_ready_csv_filepaths = {}
-    for subj in subj_awaiting:
-        num_of_webm = subj_of_webm.count(subj) # a subject should have at least 8 webm files
-        if num_of_webm < 8: 
-            logger.info(f"Subject {subj} has {num_of_webm} webm files. Need at least 8.")
-            not_ready_csv_filepaths[subj] = next(f for f in csv_files if os.path.basename(f).startswith(subj)) 
+    for subj, csv_filepath in csv_filepaths.items():
+        if statuses.get(subj) in ("downloaded", "ignored"):
+            continue
+        if num_of_webm[subj] < 8: # a subject should have at least 8 webm files
+            logger.info(f"Subject {subj} has {num_of_webm[subj]} webm files. Need at least 8.")
+            not_ready_csv_filepaths[subj] = csv_filepath
+            state.update(subj, csv_path=csv_filepath, downloaded_media=num_of_webm[subj])
         else: 
-            with open(config.subj_webm_downloaded, "a") as f:
-                f.write(f"{subj}\n")
+            state.update(subj, csv_path=csv_filepath, downloaded_media=num_of_webm[subj], status="downloaded")
 
     return not_ready_csv_filepaths
 
+def load_media_cache(config):
+    '''
+    Loads the media listing kept between runs: the validators of the last response (ETag, Last-Modified),
+    the number of uploads already indexed, the URL of the last one, and the { sessionToken: [fileUrl, ...] } index.
+    '''
+    try:
+        with open(config.media_cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return { "etag": None, "last_modified": None, "n_uploads": 0, "last_url": None, "uploads": {} }
+
+def save_media_cache(cache, config):
+    tmp_path = f"{config.media_cache_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, config.media_cache_path)
+
+def index_uploads(uploads, cache):
+    '''
+    Adds the uploads not indexed yet to the cache. The listing is assumed to only grow at its end, 
+    so only the uploads after the last indexed one are read; if it changed otherwise, it is indexed again.
+    '''
+    n_seen = cache["n_uploads"]
+    if n_seen > len(uploads) or (n_seen and uploads[n_seen - 1]["fileUrl"] != cache["last_url"]):
+        cache["uploads"], n_seen = {}, 0
+
+    for upload in uploads[n_seen:]:
+        cache["uploads"].setdefault(upload["sessionToken"], []).append(upload["fileUrl"])
+    cache["n_uploads"] = len(uploads)
+    cache["last_url"] = uploads[-1]["fileUrl"] if uploads else None
+    return len(uploads) - n_seen
+
 def get_uploaded_not_downloaded(not_downloaded_tokens, config, logger):
-    res = requests.get(
+    ## A conditional request: the listing is only sent again if it changed since the last run
+    cache = load_media_cache(config)
+    headers = dict(config.gitlab_header)
+    if cache["etag"]:
+        headers["If-None-Match"] = cache["etag"]
+    if cache["last_modified"]:
+        headers["If-Modified-Since"] = cache["last_modified"]
+
+    res = http_client.get(
         url=config.exp_media_url, 
-        headers=config.gitlab_header
+        headers=headers
     )
-    if res.status_code == 200:
+    if res.status_code == 304:
+        logger.info(f"Media list not modified ({cache['n_uploads']} uploads)")
+    elif res.status_code == 200:
         json_data = res.json()
-        uploads = json_data["uploads"]
-        
-        urls_to_download = []
-        for upload in uploads:
-            session_token = upload["sessionToken"]
-
-            if session_token in not_downloaded_tokens:
-                urls_to_download.append(upload["fileUrl"])
-
-        return urls_to_download
+        n_new = index_uploads(json_data["uploads"], cache)
+        cache["etag"] = res.headers.get("ETag")
+        cache["last_modified"] = res.headers.get("Last-Modified")
+        save_media_cache(cache, config)
+        logger.info(f"Media list: {n_new} new uploads ({cache['n_uploads']} in total)")
     else:
         logger.error(f"Failed to get media list: {res.status_code}")
         return []
 
+    urls_to_download = []
+    for session_token in dict.fromkeys(not_downloaded_tokens):
+        urls_to_download.extend(cache["uploads"].get(session_token, []))
+
+    return urls_to_download
+
+def expected_checksum(res):
+    '''
+    Returns the MD5 digest (hex) announced for the whole file: the Content-MD5 header, 
+    or the ETag if it is a plain MD5 (as for objects served from S3/GCS without multipart upload); None otherwise.
+    '''
+    content_md5 = res.headers.get("Content-MD5")
+    if content_md5:
+        try:
+            return base64.b64decode(content_md5).hex()
+        except ValueError:
+            pass
+    etag = res.headers.get("ETag", "").strip('"')
+    if re.fullmatch(r"[0-9a-fA-F]{32}", etag):
+        return etag.lower()
+    return None
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def download_file(file_url, config, logger):
+    '''
+    Downloads file_url into the data directory through a <FILE_NAME>.part file, which is renamed once its size 
+    (and checksum, if announced by the server) is verified, so that an incomplete file never looks downloaded.
+    An interrupted download is resumed from the end of its .part file (with a Range request) at the next attempt.
+    Returns the file path, or None on failure.
+    '''
+    file_name = os.path.basename(file_url)
+    file_path = os.path.join(config.data_dir, file_name)
+    part_path = f"{file_path}.part"
+    if os.path.exists(file_path):
+        logger.info(f"Already downloaded: {file_url}")
+        return file_path
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = { "Range": f"bytes={offset}-" } if offset else {}
+    try:
+        with http_client.get(file_url, stream=True, headers=headers) as res:
+            if res.status_code == 416: # the .part file is not a prefix of the file (anymore): start over next time
+                os.remove(part_path)
+                logger.warning(f"Failed to resume {file_url}; it will be downloaded again")
+                return None
+            if res.status_code not in (200, 206):
+                logger.error(f"Failed to download {file_url}. Status code: {res.status_code}")
+                return None
+
+            if res.status_code == 206:
+                content_range = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", res.headers.get("Content-Range", ""))
+                if content_range is None or int(content_range.group(1)) != offset:
+                    os.remove(part_path)
+                    logger.warning(f"Unexpected Content-Range for {file_url}; it will be downloaded again")
+                    return None
+                expected_size = int(content_range.group(2)) if content_range.group(2) != "*" else None
+                mode = "ab"
+            else: # the server ignored the Range header (or there is nothing to resume)
+                content_length = res.headers.get("Content-Length")
+                expected_size = int(content_length) if content_length and "Content-Encoding" not in res.headers else None
+                offset, mode = 0, "wb"
+            checksum = expected_checksum(res)
+
+            with open(part_path, mode) as f:
+                for chunk in res.iter_content(chunk_size=config.download_chunk_size):
+                    f.write(chunk)
+    except Exception as e: # e.g., the connection was lost; the .part file is kept to be resumed
+        logger.error(f"Failed to download {file_url}: {e}")
+        return None
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        logger.error(f"Incomplete download of {file_url}: {size} of {expected_size} bytes")
+        if size > expected_size:
+            os.remove(part_path)
+        return None
+    if checksum is not None and file_md5(part_path) != checksum:
+        logger.error(f"Checksum mismatch for {file_url}; it will be downloaded again")
+        os.remove(part_path)
+        return None
+
+    os.replace(part_path, file_path)
+    get_file_index(config.data_dir).add(file_path)
+    logger.info(f"Downloaded: {file_url}" + (f" (resumed at {offset} bytes)" if offset else ""))
+    return file_path
+
+def download_files(file_urls, config, logger):
+    '''
+    Downloads the files concurrently (config.download_workers at a time).
+    Returns the paths of the downloaded files.
+    '''
+    file_urls = list(dict.fromkeys(file_urls))
+    if not file_urls:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(config.download_workers, len(file_urls)))) as executor:
+        file_paths = [ 
+            file_path for file_path in executor.map(lambda file_url: download_file(file_url, config, logger), file_urls) 
+            if file_path is not None 
+        ]
+
+    return file_paths
+
 def update_is_file_ready(csv_filename, logger):
-    res = requests.get(
+    '''
+    Sets is_file_ready to 1 in the report generation task of the CSV file, if the report is not generated yet.
+    Returns True if it was set.
+    '''
+    res = http_client.get(
         url=f"https://qoca-api.chih-he.dev/tasks?csv_filename={csv_filename}"
     )
     if res.status_code == 200:
@@ -101,7 +251,7 @@ def update_is_file_ready(csv_filename, logger):
             status = json_data['items'][-1]['status']
 
             if status == 0: # report is not generated yet 
-                res = requests.put(
+                res = http_client.put(
                     url=f"https://qoca-api.chih-he.dev/tasks/{task_id}", 
                     json={
                         "is_file_ready": 1
@@ -109,12 +259,14 @@ def update_is_file_ready(csv_filename, logger):
                 )
                 if res.status_code == 200:
                     logger.info(f"Successfully updated is_file_ready of task #{task_id} ({csv_filename}) to 1.")
+                    return True
                 else:
                     logger.error(f"Failed to update is_file_ready of task #{task_id} ({csv_filename}): {res.status_code}")
         else:
             logger.error(f"No task found for {csv_filename}")
     else:
         logger.error(f"Failed to assess report task status for {csv_filename}: {res.status_code}")
+    return False
 
 ## ====================================================================================
 
@@ -123,51 +275,53 @@ if __name__ == "__main__":
     config = Config()
     logger = setup_logger(config)
 
+    state = make_download_state(config.data_dir)
     not_ready_csv_filepaths = list_awaiting_files(config, logger)
     logger.info(f"Start downloading .webm files for {len(not_ready_csv_filepaths)} subjects ...")
 
     not_downloaded_tokens = []
-    for subj, csv_filepath in not_ready_csv_filepaths.items():
-        df = pd.read_csv(csv_filepath)
-        try:
-            session_token = df["sessionToken"].values[0]
-            not_downloaded_tokens.append(session_token)
-        except:
-            logger.warning(f"Failed to get sessionToken for {subj}")
-            not_ready_csv_filepaths.pop(subj)
-            with open(config.subj_webm_ignored, "a") as f:
-                f.write(f"{subj}\n")
+    for subj, csv_filepath in list(not_ready_csv_filepaths.items()):
+        ## The session token is read from the CSV file only once
+        session_token = state.get(subj)["session_token"]
+        if session_token is None:
+            try:
+                session_token = str(pd.read_csv(csv_filepath, usecols=["sessionToken"])["sessionToken"].values[0])
+                state.update(subj, session_token=session_token)
+            except:
+                logger.warning(f"Failed to get sessionToken for {subj}")
+                not_ready_csv_filepaths.pop(subj)
+                state.update(subj, status="ignored")
+                continue
+        not_downloaded_tokens.append(session_token)
 
     urls_to_download = get_uploaded_not_downloaded(not_downloaded_tokens, config, logger)
 
     if urls_to_download: # not empty list
-        subjs_to_update = []
+        file_paths = download_files(urls_to_download, config, logger)
+        logger.info(f"Downloaded {len(file_paths)} of {len(urls_to_download)} files")
+        subjs_to_update = [ os.path.basename(file_path).split("_")[0] for file_path in file_paths ]
 
-        for file_url in urls_to_download:
-            res = requests.get(file_url, stream=True)
-
-            if res.status_code == 200:
-                file_name = os.path.basename(file_url)
-                file_path = os.path.join(config.data_dir, file_name)
-                with open(file_path, "wb") as f:
-                    for chunk in res.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                logger.info(f"Downloaded: {file_url}")
-
-                subj = file_name.split("_")[0]
-                subjs_to_update.append(subj)
-
-            else:
-                logger.info("Failed to download. Status code:", res.status_code)
+        ## Expected (uploaded) vs. downloaded media files per subject:
+        expected_media = Counter(os.path.basename(file_url).split("_")[0] for file_url in urls_to_download)
+        file_index = get_file_index(config.data_dir)
+        for subj in set(expected_media) & set(not_ready_csv_filepaths):
+            state.update(
+                subj, 
+                expected_media=expected_media[subj], 
+                downloaded_media=len([ f for f in file_index.subject_files(subj) if f.endswith(".webm") ])
+            )
 
         for subj in list(set(subjs_to_update)):
             try:
                 csv_filename = os.path.basename(not_ready_csv_filepaths[subj])
-                update_is_file_ready(csv_filename, logger)
+                if update_is_file_ready(csv_filename, logger):
+                    state.update(subj, is_file_ready=1)
 
             except:
                 if subj in not_ready_csv_filepaths:
                     logger.warning(f"'{subj}' possibly should be renamed.")
                 logger.warning(f"Failed to update is_file_ready for '{subj}'.")
     else:
-        logger.info(f"No new files to download.")
\ No newline at end of file
+        logger.info(f"No new files to download.")
+
+    logger.info(f"HTTP calls:\n{http_client.format_stats()}")
\ No newline at end of file
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# Feature stores that hold each participant's integrated result (i.e., the platform features).
+# - "sqlite" (default): one row per subject x feature in integrated_results/integrated_results.db (WAL mode),
+#   with the source task and the time of the last update.
+# - "json": one <SUBJECT_ID>_integrated_result.json file per participant (the original layout).
+# - HttpFeatureStore: read-only access through the /get_integrated_result endpoint served by get_integrated_result.py.
+#
+# A one-time migration from the JSON folder to SQLite runs automatically when the database is created,
+# or manually with: python feature_store.py migrate
+
+import os
+import json
+import glob
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from contextlib import closing
+
+import http_client
+
+class FeatureNotFoundError(LookupError):
+    pass
+
+def _to_python(value):
+    ## numpy scalars -> python scalars (sqlite3 and json cannot handle e.g. np.int64)
+    return value.item() if hasattr(value, "item") else value
+
+class FeatureStore:
+    def get(self, subject_id):
+        raise NotImplementedError
+
+    def update(self, subject_id, features, missing_marker, source=None):
+        '''
+        Merges features into the subject's record:
+        values other than missing_marker overwrite the stored ones,
+        while missing_marker is only stored for features that do not exist yet.
+        '''
+        raise NotImplementedError
+
+    def update_many(self, features_by_subject, missing_marker, source=None):
+        for subject_id, features in features_by_subject.items():
+            self.update(subject_id, features, missing_marker, source)
+
+    def subject_ids(self):
+        raise NotImplementedError
+
+    def last_updated(self):
+        '''
+        Returns a dict of {subject_id: time of the latest update of its features (ISO format)}.
+        '''
+        raise NotImplementedError
+
+    def get_many(self, subject_ids):
+        '''
+        Returns a dict of {subject_id: features}; subjects without features are left out.
+        '''
+        features = {}
+        for subject_id in subject_ids:
+            try:
+                features[subject_id] = self.get(subject_id)
+            except FeatureNotFoundError:
+                continue
+        return features
+
+    def get_all(self):
+        return self.get_many(self.subject_ids())
+
+class JsonFeatureStore(FeatureStore):
+    def __init__(self, integrated_results_dir):
+        self.integrated_results_dir = integrated_results_dir
+        self._lock = threading.Lock()
+
+    def _path(self, subject_id):
+        return os.path.join(self.integrated_results_dir, f"{subject_id}_integrated_result.json")
+
+    def get(self, subject_id):
+        try:
+            with open(self._path(subject_id), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise FeatureNotFoundError(f"Integrated result file not found for subject ID: {subject_id}")
+
+    def update(self, subject_id, features, missing_marker, source=None):
+        with self._lock:
+            try:
+                existing_data = self.get(subject_id)
+            except FeatureNotFoundError:
+                existing_data = {}
+
+            for key, value in features.items():
+                if value != missing_marker:
+                    existing_data[key] = value
+                elif key not in existing_data:
+                    existing_data[key] = missing_marker
+
+            json_file_path = self._path(subject_id)
+            tmp_path = f"{json_file_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(existing_data, f, indent=2, default=_to_python)
+            os.replace(tmp_path, json_file_path)
+
+    def subject_ids(self):
+        return sorted(
+            os.path.basename(fp).split("_")[0]
+            for fp in glob.glob(os.path.join(self.integrated_results_dir, "*_integrated_result.json"))
+        )
+
+    def last_updated(self):
+        return {
+            os.path.basename(fp).split("_")[0]: datetime.fromtimestamp(os.path.getmtime(fp)).isoformat(timespec="microseconds")
+            for fp in glob.glob(os.path.join(self.integrated_results_dir, "*_integrated_result.json"))
+        }
+
+class SqliteFeatureStore(FeatureStore):
+    def __init__(self, db_path, migrate_from=None, timeout=30):
+        self.db_path = db_path
+        self.timeout = timeout
+        is_new = not os.path.exists(db_path)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS features ("
+                "  subject_id TEXT NOT NULL,"
+                "  feature TEXT NOT NULL,"
+                "  value,"
+                "  source TEXT,"
+                "  updated_at TEXT NOT NULL,"
+                "  PRIMARY KEY (subject_id, feature)"
+                ")"
+            )
+            conn.commit()
+
+        if is_new and migrate_from is not None and os.path.isdir(migrate_from):
+            n_subjects = self.migrate_from_json(migrate_from)
+            if n_subjects:
+                print(f"Migrated {n_subjects} integrated results from {migrate_from} to {db_path}")
+
+    def _connect(self):
+        ## isolation_level=None: transactions are controlled explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+
+    def get(self, subject_id):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT feature, value FROM features WHERE subject_id = ? ORDER BY rowid", (subject_id,)
+            ).fetchall()
+        if not rows:
+            raise FeatureNotFoundError(f"Integrated result not found for subject ID: {subject_id}")
+        return dict(rows)
+
+    def _update(self, conn, subject_id, features, missing_marker, source, updated_at):
+        conn.executemany(
+            "INSERT OR IGNORE INTO features (subject_id, feature, value, source, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [ (subject_id, key, missing_marker, source, updated_at) for key, value in features.items() if value == missing_marker ]
+        )
+        conn.executemany(
+            "INSERT INTO features (subject_id, feature, value, source, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (subject_id, feature) DO UPDATE SET "
+            "value = excluded.value, source = excluded.source, updated_at = excluded.updated_at",
+            [ (subject_id, key, _to_python(value), source, updated_at) for key, value in features.items() if value != missing_marker ]
+        )
+
+    def update(self, subject_id, features, missing_marker, source=None):
+        self.update_many({subject_id: features}, missing_marker, source)
+
+    def update_many(self, features_by_subject, missing_marker, source=None):
+        '''
+        Updates many subjects in a single transaction.
+        '''
+        updated_at = datetime.now().isoformat(timespec="seconds")
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE") # take the write lock up front, so concurrent updates are serialized
+            try:
+                for subject_id, features in features_by_subject.items():
+                    self._update(conn, subject_id, features, missing_marker, source, updated_at)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def subject_ids(self):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT DISTINCT subject_id FROM features ORDER BY subject_id").fetchall()
+        return [ row[0] for row in rows ]
+
+    def get_all(self):
+        cohort = {}
+        with closing(self._connect()) as conn:
+            for subject_id, feature, value in conn.execute(
+                "SELECT subject_id, feature, value FROM features ORDER BY subject_id, rowid"
+            ):
+                cohort.setdefault(subject_id, {})[feature] = value
+        return cohort
+
+    def last_updated(self):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT subject_id, MAX(updated_at) FROM features GROUP BY subject_id").fetchall()
+        return dict(rows)
+
+    def migrate_from_json(self, json_dir):
+        '''
+        Copies every <SUBJECT_ID>_integrated_result.json in json_dir into the database.
+        Features already in the database are kept.
+        '''
+        json_files = sorted(glob.glob(os.path.join(json_dir, "*_integrated_result.json")))
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for fp in json_files:
+                    subject_id = os.path.basename(fp).split("_")[0]
+                    with open(fp, "r") as f:
+                        data = json.load(f)
+                    updated_at = datetime.fromtimestamp(os.path.getmtime(fp)).isoformat(timespec="seconds")
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO features (subject_id, feature, value, source, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        [ (subject_id, key, value, "json_migration", updated_at) for key, value in data.items() ]
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(json_files)
+
+class HttpFeatureStore(FeatureStore):
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+
+    def get(self, subject_id):
+        res = http_client.post(
+            url=self.url,
+            headers=self.headers,
+            json={
+                "subject_id": subject_id
+            }
+        )
+        if res.status_code == 404:
+            raise FeatureNotFoundError(f"Integrated result file not found for subject ID: {subject_id}")
+        res.raise_for_status()
+        return res.json().get("integrated_result", {})
+
+_feature_stores = {}
+_feature_stores_lock = threading.Lock()
+
+def make_feature_store(config):
+    '''
+    Returns the store selected by config.feature_store_backend ("sqlite" or "json").
+    Stores are shared per location, so they can be requested wherever a config is available.
+    '''
+    backend = config.feature_store_backend
+    with _feature_stores_lock:
+        if backend == "sqlite":
+            key = (backend, config.feature_db_path)
+            if key not in _feature_stores:
+                _feature_stores[key] = SqliteFeatureStore(config.feature_db_path, migrate_from=config.integrated_results_dir)
+        elif backend == "json":
+            key = (backend, config.integrated_results_dir)
+            if key not in _feature_stores:
+                _feature_stores[key] = JsonFeatureStore(config.integrated_results_dir)
+        else:
+            raise ValueError(f"Unknown feature store backend: {backend}")
+        return _feature_stores[key]
+
+## ====================================================================================
+
+if __name__ == "__main__":
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    integrated_results_dir = os.path.join(source_dir, "integrated_results")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["migrate"],
+                        help="migrate: copy the per-subject JSON files into the SQLite database.")
+    parser.add_argument("--json_dir", type=str, default=integrated_results_dir,
+                        help="Folder of the <SUBJECT_ID>_integrated_result.json files.")
+    parser.add_argument("--db", type=str, default=os.path.join(integrated_results_dir, "integrated_results.db"),
+                        help="Path of the SQLite database.")
+    args = parser.parse_args()
+
+    store = SqliteFeatureStore(args.db)
+    n_subjects = store.migrate_from_json(args.json_dir)
+    print(f"Migrated {n_subjects} integrated results from {args.json_dir} to {args.db}")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# Persistent subject -> files index of the experiment data directories (data/<EXPERIMENT_NAME>),
+# so that looking up the files of a participant does not scan the whole directory with glob.
+# - The index of all directories is stored in a SQLite database next to them (data/.file_index.db).
+# - Files written by this code base (fetched CSV files, downloaded .webm files) are added as they are written.
+# - Any change to a directory (e.g., the *_ds.wav.words.csv files written by process_textreading.py or files
+#   copied by hand) changes its mtime, which triggers a rescan of that directory at the next lookup.
+#   A rescan only applies the differences between the listing and the index, and records the mtime taken
+#   before the listing, so that a file written meanwhile triggers another rescan.
+#
+# Usage: python file_index.py {rebuild,stats} [-d <DIRECTORY> ...]
+
+import os
+import sqlite3
+import argparse
+import threading
+from fnmatch import fnmatchcase
+from datetime import datetime
+from contextlib import closing
+
+def subject_of(filename):
+    return filename.split("_")[0]
+
+class FileIndex:
+    def __init__(self, directory, db_path=None, timeout=30):
+        self.directory = os.path.realpath(directory)
+        self.db_path = db_path or os.path.join(os.path.dirname(self.directory), ".file_index.db")
+        self.timeout = timeout
+
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "  directory TEXT PRIMARY KEY,"
+                "  mtime_ns INTEGER,"
+                "  scanned_at TEXT"
+                ")"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "  directory TEXT NOT NULL,"
+                "  filename TEXT NOT NULL,"
+                "  subject_id TEXT NOT NULL,"
+                "  PRIMARY KEY (directory, filename)"
+                ")"
+            )
+            ## Covers the ORDER BY filename of subject_files(), which otherwise makes SQLite walk the whole directory
+            conn.execute("DROP INDEX IF EXISTS files_subject")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_subject_filename ON files (directory, subject_id, filename)")
+
+    def _connect(self):
+        ## isolation_level=None: transactions are controlled explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _indexed_mtime(self, conn):
+        row = conn.execute("SELECT mtime_ns FROM directories WHERE directory = ?", (self.directory,)).fetchone()
+        return row[0] if row else None
+
+    def rebuild(self):
+        '''
+        Rescans the directory (non-hidden files only, like glob) and applies the added and removed files to its index.
+        Returns the number of files.
+        '''
+        mtime = self._dir_mtime() # before the listing: a file written during the scan changes the mtime again
+        filenames = set()
+        if mtime is not None:
+            with os.scandir(self.directory) as entries:
+                filenames = { e.name for e in entries if not e.name.startswith(".") and e.is_file() }
+
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                indexed = { row[0] for row in conn.execute("SELECT filename FROM files WHERE directory = ?", (self.directory,)) }
+                conn.executemany(
+                    "DELETE FROM files WHERE directory = ? AND filename = ?",
+                    [ (self.directory, fn) for fn in indexed - filenames ]
+                )
+                conn.executemany(
+                    "INSERT INTO files (directory, filename, subject_id) VALUES (?, ?, ?)",
+                    [ (self.directory, fn, subject_of(fn)) for fn in filenames - indexed ]
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO directories (directory, mtime_ns, scanned_at) VALUES (?, ?, ?)",
+                    (self.directory, mtime, datetime.now().isoformat(timespec="seconds"))
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(filenames)
+
+    def _query(self, sql, params):
+        ## Rescans first if the directory changed since it was indexed
+        with closing(self._connect()) as conn:
+            indexed_mtime = self._indexed_mtime(conn)
+            if indexed_mtime is None or indexed_mtime != self._dir_mtime():
+                self.rebuild()
+            return conn.execute(sql, params).fetchall()
+
+    def add(self, file_path):
+        '''
+        Adds a file written into the directory. The recorded mtime is not advanced, since another process may have
+        written into the directory meanwhile: the next lookup still rescans, but only applies the changes of other writers.
+        '''
+        filename = os.path.basename(file_path)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO files (directory, filename, subject_id) VALUES (?, ?, ?)",
+                (self.directory, filename, subject_of(filename))
+            )
+
+    def subject_files(self, subject_id):
+        '''
+        Returns the paths of the files of the subject (i.e., named "<subject_id>_..."), sorted by name.
+        '''
+        rows = self._query(
+            "SELECT filename FROM files WHERE directory = ? AND subject_id = ? ORDER BY filename",
+            (self.directory, subject_id)
+        )
+        return [ os.path.join(self.directory, row[0]) for row in rows ]
+
+    def glob(self, pattern):
+        '''
+        Same as glob.glob(os.path.join(directory, pattern)) (sorted by name), answered from the index.
+        Patterns starting with a literal "<subject_id>_" only look at the files of that subject.
+        '''
+        subject_id = subject_of(pattern)
+        if subject_id != pattern and not any(c in subject_id for c in "*?["):
+            candidates = self.subject_files(subject_id)
+        else:
+            rows = self._query("SELECT filename FROM files WHERE directory = ? ORDER BY filename", (self.directory,))
+            candidates = [ os.path.join(self.directory, row[0]) for row in rows ]
+        return [ fp for fp in candidates if fnmatchcase(os.path.basename(fp), pattern) ]
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            n_files, n_subjects = conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT subject_id) FROM files WHERE directory = ?", (self.directory,)
+            ).fetchone()
+            row = conn.execute("SELECT scanned_at FROM directories WHERE directory = ?", (self.directory,)).fetchone()
+        return {
+            "directory": self.directory,
+            "files": n_files,
+            "subjects": n_subjects,
+            "scanned_at": row[0] if row else None
+        }
+
+## Indexes shared per directory (the SQLite database is safe to use from several threads and processes)
+
+_file_indexes = {}
+_file_indexes_lock = threading.Lock()
+
+def get_file_index(directory):
+    key = os.path.realpath(directory)
+    with _file_indexes_lock:
+        if key not in _file_indexes:
+            _file_indexes[key] = FileIndex(key)
+        return _file_indexes[key]
+
+## ====================================================================================
+
+if __name__ == "__main__":
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(source_dir, "..", "data")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["rebuild", "stats"])
+    parser.add_argument("-d", "--directories", type=str, nargs="*", default=None,
+                        help="Experiment data directories (default: every directory in the data folder).")
+    args = parser.parse_args()
+
+    directories = args.directories or sorted(
+        os.path.join(data_dir, d) for d in os.listdir(data_dir)
+        if os.path.isdir(os.path.join(data_dir, d)) and not d.startswith(".")
+    )
+    for directory in directories:
+        index = get_file_index(directory)
+        if args.command == "rebuild":
+            n_files = index.rebuild()
+            print(f"{index.directory}: {n_files} files indexed")
+        else:
+            print(index.stats())
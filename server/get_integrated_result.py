@@ -1,14 +1,12 @@
 #!/usr/bin/env python
 
-import os
-import json
-
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, HTTPException
 from pydantic import BaseModel
 
 from server import Config, setup_logger, authenticate_gitlab
+from feature_store import FeatureNotFoundError, make_feature_store
 from uvicorn_config import LOGGING_CONFIG
 
 class SubjectDownloadRequest(BaseModel):
@@ -19,20 +17,18 @@ class SubjectDownloadRequest(BaseModel):
 load_dotenv()
 config = Config()
 logger = setup_logger()
+feature_store = make_feature_store(config)
 app = FastAPI(docs_url=None)
 
 @app.post("/get_integrated_result")
 async def get_integrated_result(request: SubjectDownloadRequest, token: str = Depends(authenticate_gitlab)):
     subject_id = request.subject_id
     logger.info(f"Received request to get integrated result for subject ID: {subject_id}")
-    json_file_path = os.path.join(config.integrated_results_dir, f"{subject_id}_integrated_result.json")
-
-    if not os.path.exists(json_file_path):
-        raise HTTPException(status_code=404, detail=f"Integrated result file not found for subject ID: {subject_id}")
-    else:
-        with open(json_file_path, "r") as f:
-            integrated_result = json.load(f)
-        return {"status": "ok", "integrated_result": integrated_result}
+    try:
+        integrated_result = feature_store.get(subject_id)
+    except FeatureNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"status": "ok", "integrated_result": integrated_result}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=7777, log_config=LOGGING_CONFIG)
\ No newline at end of file
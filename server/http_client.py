@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Shared HTTP client for all outbound calls (QOCA API, GitLab, Pavlovia and the local endpoints).
+# - One keep-alive requests.Session (with its own connection pool) per host, shared across threads.
+# - Every request has a timeout: HTTP_CONNECT_TIMEOUT (default: 5 s) and HTTP_TIMEOUT (read, default: 30 s);
+#   long-running local endpoints pass their own timeout.
+# - Connection errors and 5xx responses are retried HTTP_RETRIES times (default: 3) with exponential backoff
+#   (HTTP_BACKOFF * 2^n seconds, default factor: 0.5). POST requests are only retried when the connection
+#   could not be established, since e.g. uploading an exam twice would create two exams.
+# - Latency and error counters are kept per endpoint (method + host + path with ID-like segments replaced by "*").
+#
+# Usage: import http_client; res = http_client.get(url, ...) (same arguments and return value as requests.get)
+
+import os
+import re
+import time
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class HttpClient:
+    def __init__(self, timeout=None, connect_timeout=None, retries=None, backoff=None, pool_size=None):
+        self.timeout = timeout if timeout is not None else float(os.getenv("HTTP_TIMEOUT", 30))
+        self.connect_timeout = connect_timeout if connect_timeout is not None else float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+        self.retries = retries if retries is not None else int(os.getenv("HTTP_RETRIES", 3))
+        self.backoff = backoff if backoff is not None else float(os.getenv("HTTP_BACKOFF", 0.5))
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv("HTTP_POOL_SIZE", 10))
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._stats = {}
+
+    def _make_session(self):
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}), # read/status retries; not POST
+            raise_on_status=False # return the last 5xx response instead of raising
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=self.pool_size)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = self._make_session()
+            return self._sessions[host]
+
+    @staticmethod
+    def endpoint_name(method, url):
+        parts = urlsplit(url)
+        path = "/".join(
+            "*" if re.search(r"\d", segment) else segment for segment in parts.path.split("/")
+        )
+        return f"{method} {parts.netloc}{path}"
+
+    def _record(self, endpoint, seconds, error):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        '''
+        Same as requests.request(), through the pooled session of the URL's host.
+        Responses with status >= 500 and raised exceptions are counted as errors.
+        '''
+        method = method.upper()
+        endpoint = endpoint or self.endpoint_name(method, url)
+        if "timeout" not in kwargs:
+            kwargs["timeout"] = (self.connect_timeout, self.timeout)
+
+        start = time.perf_counter()
+        try:
+            res = self.session(url).request(method, url, **kwargs)
+        except requests.RequestException:
+            self._record(endpoint, time.perf_counter() - start, error=True)
+            raise
+        self._record(endpoint, time.perf_counter() - start, error=res.status_code >= 500)
+        return res
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    "calls": s["calls"],
+                    "errors": s["errors"],
+                    "mean_ms": round(s["total_seconds"] / s["calls"] * 1000, 1),
+                    "max_ms": round(s["max_seconds"] * 1000, 1)
+                }
+                for endpoint, s in sorted(self._stats.items())
+            }
+
+    def format_stats(self):
+        return "\n".join(
+            f"{endpoint}: {s['calls']} calls, {s['errors']} errors, mean {s['mean_ms']} ms, max {s['max_ms']} ms"
+            for endpoint, s in self.stats().items()
+        )
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+## Module-level client shared by all scripts (created on first use, so that .env is loaded by then)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+def request(method, url, **kwargs):
+    return get_client().request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+def post(url, **kwargs):
+    return get_client().post(url, **kwargs)
+
+def put(url, **kwargs):
+    return get_client().put(url, **kwargs)
+
+def stats():
+    return get_client().stats()
+
+def format_stats():
+    return get_client().format_stats()
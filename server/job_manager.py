@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Bounded background job queue used by server.py, so that the /webhook endpoint can acknowledge
+# a commit immediately while the file is fetched, processed and (for TextReading) predicted and uploaded
+# in a worker thread. Each job gets an ID whose status can be looked up afterwards.
+
+import uuid
+import threading
+import traceback
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class JobQueueFullError(RuntimeError):
+    pass
+
+class JobManager:
+    def __init__(self, max_workers=4, max_pending=100, max_history=1000, logger=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending # queued + running jobs
+        self.max_history = max_history # finished jobs kept for status lookups
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="webhook-worker")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._n_pending = 0
+
+    @staticmethod
+    def _now():
+        return datetime.now().isoformat(timespec="seconds")
+
+    def submit(self, fn, *args, description=None, key=None, **kwargs):
+        '''
+        Queues fn(*args, **kwargs) and returns the job ID.
+        If a job with the same key is still queued or running, its ID is returned instead of queuing a new one.
+        Raises JobQueueFullError when max_pending jobs are already queued or running.
+        '''
+        with self._lock:
+            if key is not None:
+                for job in self._jobs.values():
+                    if job["key"] == key and job["status"] in ("queued", "running"):
+                        return job["job_id"]
+            if self._n_pending >= self.max_pending:
+                raise JobQueueFullError(f"Job queue is full ({self._n_pending} pending jobs)")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "description": description,
+                "key": key,
+                "status": "queued",
+                "created_at": self._now(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None
+            }
+            self._n_pending += 1
+            self._prune()
+
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        self._set(job_id, status="running", started_at=self._now())
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(f"Job {job_id} failed: {e}\n{traceback.format_exc()}")
+            self._set(job_id, status="failed", error=str(e), finished_at=self._now())
+        else:
+            self._set(job_id, status="done", result=result, finished_at=self._now())
+        finally:
+            with self._lock:
+                self._n_pending -= 1
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _prune(self):
+        ## Drops the oldest finished jobs (called with the lock held)
+        n_finished = len(self._jobs) - self._n_pending
+        for job_id in list(self._jobs):
+            if n_finished <= self.max_history:
+                break
+            if self._jobs[job_id]["status"] in ("done", "failed"):
+                del self._jobs[job_id]
+                n_finished -= 1
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def stats(self):
+        with self._lock:
+            counts = { "queued": 0, "running": 0, "done": 0, "failed": 0 }
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "jobs": counts
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# In-memory registry of the prediction artifacts (model, scaler, cognitive percentiles and
+# correction reference table) used by predict.py. Both age groups are loaded once at startup,
+# and a background watcher reloads a group whenever one of its files changes on disk.
+
+import os
+import time
+import hashlib
+import threading
+from datetime import datetime
+
+import joblib
+import pandas as pd
+
+AGE_GROUPS = {
+    "young": "y",
+    "old": "o"
+}
+
+def get_age_group(true_age):
+    return "young" if true_age < 40 else "old"
+
+class ArtifactSet:
+    def __init__(self, age_full, model, scaler, percentiles, correction_ref, versions, load_seconds):
+        self.age_full = age_full
+        self.model = model
+        self.scaler = scaler
+        self.percentiles = percentiles
+        self.correction_ref = correction_ref
+        self.versions = versions
+        self.load_seconds = load_seconds
+        self.loaded_at = datetime.now().isoformat(timespec="seconds")
+
+class ModelRegistry:
+    def __init__(self, config, watch_interval=60):
+        self.config = config
+        self.watch_interval = watch_interval
+        self._lock = threading.Lock()
+        ## One lock per age group, so that a group is loaded by one thread at a time without blocking the other group
+        self._load_locks = { age_full: threading.Lock() for age_full in AGE_GROUPS }
+        self._artifacts = {}
+        self._fingerprints = {}
+        self._reload_count = { age_full: 0 for age_full in AGE_GROUPS }
+        self._last_error = {}
+        self._stop_event = threading.Event()
+        self._watcher = None
+
+    def artifact_paths(self, age_full):
+        age_abb = AGE_GROUPS[age_full]
+        return {
+            "model": self.config.model_path_template.replace("<age_abb>", age_abb),
+            "scaler": self.config.scaler_path_template.replace("<age_full>", age_full),
+            "percentiles": self.config.percentiles_path_template.replace("<age_full>", age_full),
+            "correction_ref": self.config.correction_ref_path_template.replace("<age_abb>", age_abb)
+        }
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def load(self, age_full):
+        '''
+        Loads all artifacts of an age group and swaps them in as a whole,
+        so that a request never sees a mix of old and new files.
+        '''
+        with self._load_locks[age_full]:
+            return self._load(age_full)
+
+    def _load(self, age_full):
+        paths = self.artifact_paths(age_full)
+        loaded, versions, load_seconds, fingerprints = {}, {}, {}, {}
+
+        for name, path in paths.items():
+            fingerprints[name] = self._stat(path)
+            start = time.perf_counter()
+            if name == "correction_ref":
+                loaded[name] = pd.read_csv(path)
+            else:
+                loaded[name] = joblib.load(path)
+            load_seconds[name] = round(time.perf_counter() - start, 4)
+            versions[name] = {
+                "file": os.path.basename(path),
+                "sha256": self._sha256(path)[:12],
+                "mtime": datetime.fromtimestamp(fingerprints[name][0] / 1e9).isoformat(timespec="seconds")
+            }
+
+        artifact_set = ArtifactSet(
+            age_full, loaded["model"], loaded["scaler"], loaded["percentiles"], loaded["correction_ref"],
+            versions, load_seconds
+        )
+        with self._lock:
+            self._artifacts[age_full] = artifact_set
+            self._fingerprints[age_full] = fingerprints
+        print(f"Loaded {age_full} model artifacts in {sum(load_seconds.values()):.3f} s")
+
+        return artifact_set
+
+    def load_all(self):
+        for age_full in AGE_GROUPS:
+            self.load(age_full)
+
+    def get(self, age_full):
+        '''
+        Returns the loaded artifacts of an age group, loading them on first use:
+        concurrent first requests wait for a single load instead of each loading the files.
+        '''
+        artifact_set = self._artifacts.get(age_full)
+        if artifact_set is None:
+            with self._load_locks[age_full]:
+                artifact_set = self._artifacts.get(age_full)
+                if artifact_set is None:
+                    artifact_set = self._load(age_full)
+        return artifact_set
+
+    def _has_changed(self, age_full):
+        '''
+        A file is considered changed only if its content hash differs,
+        so touching a file (mtime only) does not trigger a reload.
+        '''
+        artifact_set = self._artifacts.get(age_full)
+        if artifact_set is None:
+            return True
+
+        for name, path in self.artifact_paths(age_full).items():
+            if self._stat(path) == self._fingerprints[age_full][name]:
+                continue
+            if self._sha256(path)[:12] != artifact_set.versions[name]["sha256"]:
+                return True
+            with self._lock:
+                self._fingerprints[age_full][name] = self._stat(path)
+
+        return False
+
+    def check_for_updates(self):
+        for age_full in AGE_GROUPS:
+            try:
+                with self._load_locks[age_full]:
+                    if self._has_changed(age_full):
+                        print(f"Artifacts of the {age_full} group changed on disk, reloading ...")
+                        self._load(age_full)
+                        self._reload_count[age_full] += 1
+                        self._last_error.pop(age_full, None)
+            except Exception as e: # keep serving the previous artifacts
+                self._last_error[age_full] = str(e)
+                print(f"Failed to reload {age_full} model artifacts: {e}")
+
+    def _watch(self):
+        while not self._stop_event.wait(self.watch_interval):
+            self.check_for_updates()
+
+    def start_watching(self):
+        if self.watch_interval <= 0 or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="model-registry-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop_event.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def status(self):
+        groups = {}
+        for age_full in AGE_GROUPS:
+            artifact_set = self._artifacts.get(age_full)
+            if artifact_set is None:
+                groups[age_full] = {"loaded": False}
+                continue
+            groups[age_full] = {
+                "loaded": True,
+                "loaded_at": artifact_set.loaded_at,
+                "load_seconds": artifact_set.load_seconds,
+                "versions": artifact_set.versions,
+                "reload_count": self._reload_count[age_full],
+                "last_error": self._last_error.get(age_full)
+            }
+        return {
+            "watch_interval": self.watch_interval,
+            "watching": self._watcher is not None,
+            "groups": groups
+        }
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 
-# This script is used to re-process text reading files and was called by the tidy_predicted_results.py
-# Usage: python patches.py <subject_id>
+# This script is used to re-process text reading files and re-generate the predicted results of participants
+# patch_subjects() is called by tidy_predicted_results.py to patch many participants concurrently
+# Usage: python patches.py <subject_id1> [<subject_id2> ...] [-w <N_WORKERS>]
 
 import os
 import sys
-import glob
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
@@ -15,6 +17,8 @@ import util
 from server import setup_logger, predict, upload_exam
 from download_textreading_files import update_is_file_ready
 from process_tasks import execute_process_textreading
+from file_index import get_file_index
+from download_state import make_download_state
 
 class Config:
     def __init__(self):
@@ -23,6 +27,7 @@ class Config:
         self.integrated_results_dir = os.path.join(self.source_dir, "integrated_results")
         self.exp_textreading_name = os.getenv("EXPERIMENT_TEXTREADING_NAME")
         self.process_textreading_url = os.getenv("PROCESS_TEXTREADING_URL")
+        self.process_textreading_timeout = float(os.getenv("PROCESS_TEXTREADING_TIMEOUT", 1800)) # seconds; transcription is slow
         self.predict_url = os.getenv("PREDICT_URL")
         self.local_headers = {
             "X-GitLab-Token": "tcnl-project",
@@ -35,50 +40,109 @@ class Config:
         self.missing_marker = -999
 
 def get_aud_csv_files(subject_id, config):
-    aud_csv_files = list(
-        glob.glob(os.path.join(config.data_dir, config.exp_textreading_name, f"{subject_id}_*_ds.wav.words.csv"))
+    aud_csv_files = get_file_index(os.path.join(config.data_dir, config.exp_textreading_name)).glob(
+        f"{subject_id}_*_ds.wav.words.csv"
     )
     aud_csv_files = [ f for f in aud_csv_files if "practice_loop" not in f ]  # exclude practice files
     return aud_csv_files
 
-if __name__ == "__main__":
-    load_dotenv()
-    config = Config()
-    logger = setup_logger()
+def patch_subject(subject_id, config, logger):
+    '''
+    Re-processes the text reading files of a participant (if not done yet), re-generates the predicted result 
+    and uploads it. Returns { "subject_id", "status", "exam_id", "message" }, where status is one of 
+    "uploaded", "no_textreading_files", "no_audio_files", "predict_failed" and "error".
+    '''
+    result = { "subject_id": subject_id, "status": "error", "exam_id": None, "message": "" }
+    try:
+        ## Check if text_reading files exist (the CSV file recorded by the downloader, if any):
+        textreading_dir = os.path.join(config.data_dir, config.exp_textreading_name)
+        download_state = make_download_state(textreading_dir)
+        known_state = download_state.get(subject_id)
+        if known_state is not None and known_state["csv_path"] and os.path.exists(known_state["csv_path"]):
+            main_csv_files = [ known_state["csv_path"] ]
+        else:
+            main_csv_files = get_file_index(textreading_dir).glob(f"{subject_id}_*Z.csv")
+        if not main_csv_files:
+            logger.warning(f"No text_reading files found for {subject_id}")
+            result["status"] = "no_textreading_files"
+            return result
 
-    subject_id = sys.argv[1]
-    print(f"\n---  {subject_id} ---\n")
+        ## In case is_file_ready has not been marked as 1:
+        csv_filename = os.path.basename(main_csv_files[0])
+        if update_is_file_ready(csv_filename, logger):
+            download_state.update(subject_id, is_file_ready=1)
 
-    ## Check if text_reading files exist:
-    main_csv_files = glob.glob(os.path.join(config.data_dir, config.exp_textreading_name, f"{subject_id}_*Z.csv"))
-    if not main_csv_files:
-        logger.warning("No text_reading files found. Goodbye :-O")
-        sys.exit(1)
+        ## Process text_reading files if needed:
+        aud_csv_files = get_aud_csv_files(subject_id, config)
 
-    ## In case is_file_ready has not been marked as 1:
-    csv_filename = os.path.basename(main_csv_files[0])
-    update_is_file_ready(csv_filename, logger)
+        if not aud_csv_files:
+            logger.info(f"Processing text_reading files of {subject_id} ...")
+            execute_process_textreading(subject_id, csv_filename, config, logger)
+            aud_csv_files = get_aud_csv_files(subject_id, config)
+        
+        if not aud_csv_files: # should not happen
+            logger.warning(f"Something went wrong with {subject_id}. " + 
+                           "You may check whether the audio files have been downloaded for the participant.")
+            result["status"] = "no_audio_files"
+            return result
 
-    ## Process text_reading files if needed:
-    aud_csv_files = get_aud_csv_files(subject_id, config)
+        ## Re-generate predict result:
+        predict_result = predict(subject_id, config, logger)
 
-    if not aud_csv_files:
-        logger.info("Processing text_reading files ...")
-        execute_process_textreading(subject_id, csv_filename, config, logger)
-        aud_csv_files = get_aud_csv_files(subject_id, config)
-    
-    if not aud_csv_files: # should not happen
-        logger.warning("Something went wrong." + 
-                       "\nYou may check whether the audio files have been downloaded for the participant." + 
-                       "\nGoodbye :-(")
-        sys.exit(1)
+        if predict_result is not None:
+            result["exam_id"] = upload_exam(predict_result, config, logger)
+            result["status"] = "uploaded"
+        else:
+            logger.warning(f"Failed to produce predict_result for {subject_id}")
+            result["status"] = "predict_failed"
+
+    except Exception as e:
+        logger.error(f"Failed to patch {subject_id}: {e}")
+        result["message"] = str(e)
+
+    return result
 
-    ## Re-generate predict result:
-    predict_result = predict(subject_id, config, logger)
+def patch_subjects(subject_ids, config, logger, max_workers=4):
+    '''
+    Patches the participants in a pool of max_workers threads (the work is mostly waiting for 
+    the process_textreading, predict and QOCA services), printing the progress as they complete.
+    Returns the results of patch_subject() in the order of subject_ids.
+    '''
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = { executor.submit(patch_subject, subject_id, config, logger): subject_id for subject_id in subject_ids }
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            results[futures[future]] = result
+            print(f"[{n_done}/{len(futures)}] {result['subject_id']}: {result['status']}" + 
+                  (f" (exam_id={result['exam_id']})" if result["exam_id"] is not None else "") + 
+                  (f" ({result['message']})" if result["message"] else ""))
 
-    if predict_result is not None:
-        exam_id = upload_exam(predict_result, config, logger)
-        logger.info("Goodbye :-)")
-    else:
-        logger.warning("Failed to produce predict_result. Goodbye :-(")
+    return [ results[subject_id] for subject_id in subject_ids ]
+
+def summarize_patches(results):
+    '''
+    Returns a one-line count of the patch results per status.
+    '''
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return ", ".join(f"{status}: {n}" for status, n in sorted(counts.items()))
+
+if __name__ == "__main__":
+    load_dotenv()
+    config = Config()
+    logger = setup_logger()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("subjects", nargs="+", 
+                        help="Subject IDs to patch.")
+    parser.add_argument("-w", "--workers", type=int, default=4, 
+                        help="Number of participants patched concurrently.")
+    args = parser.parse_args()
+
+    results = patch_subjects(list(dict.fromkeys(args.subjects)), config, logger, max_workers=args.workers)
+    print(f"\nPatched {len(results)} subjects ({summarize_patches(results)})\n")
+    if any(result["status"] != "uploaded" for result in results):
+        sys.exit(1)
 
@@ -5,9 +5,9 @@ import os
 import json
 import logging
 import warnings
+import threading
 from datetime import datetime
 
-import joblib
 import requests
 import numpy as np  
 import pandas as pd
@@ -16,18 +16,26 @@ from flask import Flask, request, jsonify
 from sklearn.exceptions import InconsistentVersionWarning
 
 import util
+import http_client
 from uvicorn_config import LOGGING_CONFIG
+from model_registry import ModelRegistry, get_age_group
+from feature_store import FeatureNotFoundError, HttpFeatureStore, make_feature_store
 # from server import setup_logger
 
 class Config:
     def __init__(self):
         self.get_integrated_result_url = os.getenv("GET_INTEGRATED_RESULT_URL")
         self.process_textreading_url = os.getenv("PROCESS_TEXTREADING_URL")
+        self.process_textreading_timeout = float(os.getenv("PROCESS_TEXTREADING_TIMEOUT", 1800)) # seconds; transcription is slow
         self.local_headers = {
             "X-GitLab-Token": "tcnl-project",
             "Content-Type": "application/json"
         }
         self.source_dir = os.path.dirname(os.path.abspath(__file__))
+        self.integrated_results_dir = os.path.join(self.source_dir, "integrated_results")
+        self.feature_db_path = os.path.join(self.integrated_results_dir, "integrated_results.db")
+        self.feature_store_backend = os.getenv("FEATURE_STORE_BACKEND", "sqlite") # "sqlite" or "json"
+        self.feature_lookup = os.getenv("FEATURE_LOOKUP", "local") # "local" (read the feature store directly) or "http"
         self.predicted_result_template = os.path.join(
             self.source_dir, "predicted_results", "<id_card>_predicted_result.json"
         )
@@ -43,6 +51,7 @@ class Config:
         self.correction_ref_path_template = os.path.join(
             self.source_dir, "prediction", "model", f"<age_abb>_ref.csv"
         )
+        self.model_watch_interval = float(os.getenv("MODEL_WATCH_INTERVAL", 60)) # seconds; <= 0 disables hot-swapping
         self.cognitive_domains = {
             "工作記憶": ["MEMORY_OSPAN_BEH_LETTER_ACCURACY"],
             "情節記憶": [
@@ -64,19 +73,28 @@ class Config:
         }
         self.using_percentile_prediction = True
         self.max_adjustment = 20 # years
-        self.brainage_prediction = True
         self.missing_marker = -999 # marked using update_json_result() in server.py
         self.replace_missing_with = 0.5 # since min-max scaler is used
         self.missing_threshold = 0.2
         self.min_percentile = 10
         self.metadata = 412
+
+class PredictionContext:
+    '''
+    Holds the state of a single prediction request, 
+    so that concurrent requests never share (or overwrite) each other's data.
+    The module-level Config only holds read-only settings.
+    '''
+    def __init__(self, data):
+        self.brainage_prediction = True
         self.data = {
             "age": -1,
             "features": {},
             "id_card": "",
             "name": "", 
             "test_date": ""
-        }        
+        }
+        self.data.update(data)
 
 def setup_logger():
     logger = logging.getLogger("werkzeug")
@@ -128,9 +146,7 @@ def correct_age_with_percentile(config, true_age, domain_score_list):
 
     return corrected_pad, corrected_age
 
-def correct_age_with_table(config, true_age, prediction):
-    age_abb = 'y' if true_age < 40 else 'o'
-    correction_ref = pd.read_csv(config.correction_ref_path_template.replace("<age_abb>", age_abb))
+def correct_age_with_table(config, true_age, prediction, correction_ref):
     df = (
         pd.DataFrame({
             'real_age': [true_age],
@@ -153,175 +169,212 @@ def correct_age_with_table(config, true_age, prediction):
 
     return corrected_pad, corrected_age
 
+def get_platform_features(model):
+    if hasattr(model, 'feature_names_in_'):
+        return model.feature_names_in_
+    elif hasattr(model, 'feature_name_'):
+        return model.feature_name_
+    else:
+        return util.init_platform_features()
+
+def is_valid_subject(data):
+    return isinstance(data, dict) and all(key in data for key in ['age', 'id_card', 'name', 'test_date'])
+
+def score_subjects(config, artifacts, true_ages, features_list, verbose=False):
+    '''
+    Scores subjects of the same age group at once: 
+    scaling, missing-mask handling, domain percentiles and model.predict() 
+    are all computed on the N x F feature matrix.
+    Returns one dict per subject with its domain scores and (uncorrected) predicted age.
+    '''
+    model = artifacts.model
+    scaler = artifacts.scaler
+    platform_features = get_platform_features(model)
+    n_subjects = len(features_list)
+
+    ## Prepare dataframe for prediction (fields not listed in the json file are left empty)
+    DF = pd.DataFrame(list(features_list), index=range(n_subjects)).reindex(columns=scaler.feature_names_in_)
+
+    ## Identify the positions of custom missing marker (-999; to ignore fields not listed in the json file)
+    data_is_missing = DF == config.missing_marker
+
+    ## Replace missing values with 0 before scaling
+    DF = DF.astype(float) 
+    DF = DF.replace(config.missing_marker, np.nan)
+    DF = DF.fillna(0)
+
+    ## Apply stored MinMaxScaler() to scales the dataset between 0 and 1
+    DF_scaled = pd.DataFrame(scaler.transform(DF), columns=scaler.feature_names_in_)
+
+    ## Fill missing entries with a specified value (0.5)
+    DF_scaled[data_is_missing] = config.replace_missing_with
+
+    ## If age is missing, do not predict brain age
+    brainage_prediction = np.array(true_ages) != -1
+
+    ## Calculate the average scores for each cognitive domain
+    domain_scores = {}
+    for cog_domain, features in config.cognitive_domains.items(): 
+
+        ## Find where the features are missing and calculate the missing ratio 
+        missing_ratio = data_is_missing[features].sum(axis=1).to_numpy() / len(features)
+        too_many_missing = missing_ratio > config.missing_threshold
+        brainage_prediction &= ~too_many_missing
+
+        ## Interpolate the average score from (0, 1) to (0, 100)
+        avg_score = DF_scaled[features].mean(axis=1).to_numpy()
+        percentile = np.interp(x=avg_score, xp=[0, 1], fp=[0, 100])
+
+        ## Reverse the percentile if the cognitive domain is "動作"
+        if cog_domain == "動作":
+            percentile = 100 - percentile
+
+        ## Avoid showing too low a score
+        too_low = percentile < config.min_percentile
+        percentile = np.where(too_low, config.min_percentile, percentile)
+
+        domain_scores[cog_domain] = np.where(too_many_missing, -1, np.round(percentile)).astype(int)
+
+        if verbose:
+            for i in range(n_subjects):
+                if too_many_missing[i]:
+                    print(f"Missing data in cognitive domain {cog_domain}")
+                    print("Prediction is not possible for this participant.")
+                else:
+                    if too_low[i]:
+                        print(f"Too low a score in cognitive domain {cog_domain}, reset to {config.min_percentile}")
+                    print(f"{cog_domain} percentile: {domain_scores[cog_domain][i]}")
+
+    ## Predict brain-age for all subjects that allow it
+    predictions = np.full(n_subjects, -1.0)
+    if brainage_prediction.any():
+        predictions[brainage_prediction] = model.predict(
+            DF_scaled.loc[brainage_prediction, platform_features]
+        )
+
+    return [
+        {
+            "brainage_prediction": bool(brainage_prediction[i]), 
+            "prediction": float(predictions[i]), 
+            "domain_score_list": [
+                { "name": cog_domain, "score": int(scores[i]) } for cog_domain, scores in domain_scores.items()
+            ]
+        }
+        for i in range(n_subjects)
+    ]
+
+def build_response(config, data, scored, correction_ref):
+    true_age = data["age"]
+    domain_score_list = scored["domain_score_list"]
+
+    if scored["brainage_prediction"]:
+        prediction = scored["prediction"]
+        original_pad = prediction - true_age
+
+        ## Perform brain-age correction 
+        if config.using_percentile_prediction:
+            corrected_pad, corrected_age = correct_age_with_percentile(
+                config, true_age, domain_score_list
+            )
+        else:
+            corrected_pad, corrected_age = correct_age_with_table(
+                config, true_age, prediction, correction_ref
+            )
+    else:
+        original_pad = -1
+        corrected_pad = -1
+        corrected_age = -1   
+
+    return {
+        "id_card": data["id_card"],
+        "name": data["name"], 
+        "testDate": data["test_date"], 
+        "results": {
+            "brainAge": "{:.2f}".format(corrected_age),
+            "chronologicalAge": true_age,
+            "originalPAD": "{:.2f}".format(original_pad),
+            "ageCorrectedPAD": "{:.2f}".format(corrected_pad)
+        },
+        "cognitiveFunctions": domain_score_list,
+        "meta": {
+            "totalParticipants": config.metadata
+        }
+    }
+
+def save_predicted_result(config, response):
+    '''
+    Writes to a temporary file first and then renames it, 
+    so that concurrent requests for the same subject never leave a half-written file.
+    '''
+    out_path = config.predicted_result_template.replace("<id_card>", response["id_card"])
+    tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(response, f, ensure_ascii=False)
+    os.replace(tmp_path, out_path)
+
 ## ====================================================================================
 
 load_dotenv()
 config = Config()
 logger = setup_logger()
 ignore_warnings()
+registry = ModelRegistry(config, watch_interval=config.model_watch_interval)
+registry.load_all()
+registry.start_watching()
+if config.feature_lookup == "http":
+    feature_store = HttpFeatureStore(config.get_integrated_result_url, config.local_headers)
+else:
+    feature_store = make_feature_store(config)
 app = Flask(__name__)
 
 @app.route('/predict', methods=['POST'])
 def predict():  
     try:
-        config.brainage_prediction = True # initialize to True
-
         ## Receive request from server.py 
         data = request.get_json(force=True)
 
-        if (not data) or ('age' not in data) or ('id_card' not in data) or ('name' not in data) or ('test_date' not in data):
+        if not is_valid_subject(data):
             return jsonify({"error": "Invalid input data"}), 400
         
         else:
-            config.data.update(data)
+            ctx = PredictionContext(data)
             now = datetime.now()
             print(f"\n{now.strftime('%Y-%m-%d %H:%M:%S')} Received predict request for subject ID: {data['id_card']}")
                  
             try:
-                ## Post request to get integrated_result.json via get_integrated_result.py   
-                feats = requests.post(
-                    url=config.get_integrated_result_url, 
-                    headers=config.local_headers, 
-                    json={
-                        "subject_id": data['id_card']
-                    }                    
-                )
-                print(f"\nPost request to /get_integrated_result ...")
-
-                if feats.status_code != 200:
-                    return jsonify({"error": "Failed to get integrated result"}), feats.status_code
-                
+                ## Get integrated result from the feature store (SQLite/JSON or get_integrated_result.py)
+                try:
+                    ctx.data["features"] = feature_store.get(data['id_card'])
+                except FeatureNotFoundError as e:
+                    print(f"Error: {e}")
+                    return jsonify({"error": "Failed to get integrated result"}), 404
+                print("Successfully got integrated result.")
+
+                ## Get preloaded objects according to participant's true age
+                true_age = ctx.data["age"]
+                age_full = get_age_group(true_age)
+                artifacts = registry.get(age_full)
+
+                print(f"\n受試者真實年齡: {true_age} --> {age_full}\n")
+
+                scored = score_subjects(
+                    config, artifacts, [true_age], [ctx.data["features"]], verbose=True
+                )[0]
+                ctx.brainage_prediction = scored["brainage_prediction"]
+                if ctx.brainage_prediction:
+                    print("\nPredicting brain age ...")
                 else:
-                    print("Successfully got integrated result.")
-                    result = feats.json()                
-                    config.data["features"] = result.get("integrated_result", {})
-                
-                    ## Get participant's true age
-                    true_age = config.data["age"]
-                    if true_age == -1: # if age is missing, do not predict brain age
-                        config.brainage_prediction = False                    
-
-                    ## Load stored objects according to participant's true age
-                    age_abb = 'y' if true_age < 40 else 'o'
-                    age_full = 'young' if true_age < 40 else 'old'
-                    model = joblib.load(config.model_path_template.replace("<age_abb>", age_abb))
-                    scaler = joblib.load(config.scaler_path_template.replace("<age_full>", age_full))             
-                    percentiles = joblib.load(config.percentiles_path_template.replace("<age_full>", age_full))
-
-                    print(f"\n受試者真實年齡: {true_age} --> {age_full}\n")
-
-                    ## Define platform features 
-                    if hasattr(model, 'feature_names_in_'):
-                        platform_features = model.feature_names_in_
-                    elif hasattr(model, 'feature_name_'):
-                        platform_features = model.feature_name_
-                    else:
-                        platform_features = util.init_platform_features()
-
-                    ## Prepare dataframe for prediction
-                    DF = pd.DataFrame(index=range(1), columns=scaler.feature_names_in_)
-                    DF.update(pd.DataFrame([config.data["features"]])) 
-
-                    ## Identify the positions of custom missing marker (-999; to ignore fields not listed in the json file)
-                    data_is_missing = DF == config.missing_marker
-
-                    ## Replace missing values with 0 before scaling
-                    DF = DF.astype(float) 
-                    DF = DF.replace(config.missing_marker, np.nan)
-                    DF = DF.fillna(0)
-
-                    ## Apply stored MinMaxScaler() to scales the dataset between 0 and 1
-                    DF_scaled = pd.DataFrame(scaler.transform(DF), columns=scaler.feature_names_in_)
-
-                    ## Fill missing entries with a specified value (0.5)
-                    DF_scaled[data_is_missing] = config.replace_missing_with
-
-                    ## Calculate the average scores for each cognitive domain
-                    domain_score_list = []
-                    for cog_domain, features in config.cognitive_domains.items(): 
-
-                        ## Find where the features are missing and calculate the missing ratio 
-                        feature_is_missing = data_is_missing[features] 
-                        missing_ratio = feature_is_missing.sum(axis=1) / len(features)
-
-                        ## Calculate the average score of the features
-                        if missing_ratio.iloc[0] > config.missing_threshold:                             
-                            config.brainage_prediction = False 
-                            domain_score_list.append({
-                                "name": cog_domain,
-                                "score": -1
-                            })
-                            print(f"Missing data in cognitive domain {cog_domain}")
-                            print("Prediction is not possible for this participant.")
-                        else:
-                            avg_score = DF_scaled[features].mean(axis=1).iloc[0]                            
-
-                            ## Interpolate the average score from (0, 1) to (0, 100)
-                            percentile = np.interp(
-                                x=avg_score, xp=[0, 1], fp=[0, 100] 
-                            )
-
-                            ## Reverse the percentile if the cognitive domain is "動作"
-                            if cog_domain == "動作":
-                                percentile = 100 - percentile
-                                
-                            ## Avoid showing too low a score
-                            if percentile < config.min_percentile:
-                                print(f"Too low a score in cognitive domain {cog_domain}, reset to {config.min_percentile}")
-                                percentile = config.min_percentile 
-                            
-                            domain_score_list.append({
-                                "name": cog_domain, 
-                                "score": int(round(percentile))
-                            })
-                            print(f"{cog_domain} percentile: {domain_score_list[-1]['score']}")
-
-                    ## Predict brain-age
-                    if config.brainage_prediction:
-                        print("\nPredicting brain age ...")
-                        prediction = float(model.predict(DF_scaled[platform_features])[0])
-                        original_pad = prediction - true_age
-
-                        ## Perform brain-age correction 
-                        if config.using_percentile_prediction:
-                            corrected_pad, corrected_age = correct_age_with_percentile(
-                                config, true_age, domain_score_list
-                            )
-                        else:
-                            corrected_pad, corrected_age = correct_age_with_table(
-                                config, true_age, prediction
-                            )
-                    else:
-                        print("\nPrediction is not possible for this participant.")
-                        prediction = -1
-                        original_pad = -1
-                        corrected_pad = -1
-                        corrected_age = -1   
-
-                    response = {
-                        "id_card": config.data["id_card"],
-                        "name": config.data["name"], 
-                        "testDate": config.data["test_date"], 
-                        "results": {
-                            "brainAge": "{:.2f}".format(corrected_age),
-                            "chronologicalAge": true_age,
-                            "originalPAD": "{:.2f}".format(original_pad),
-                            "ageCorrectedPAD": "{:.2f}".format(corrected_pad)
-                        },
-                        "cognitiveFunctions": domain_score_list,
-                        "meta": {
-                            "totalParticipants": config.metadata
-                        }
-                    }
-                    print(f"腦齡預測結果: {response['results']['brainAge']}")
-                    print(r"‧★,:*:‧\(^o^)/‧:*‧°★*")
-                    print()
+                    print("\nPrediction is not possible for this participant.")
 
-                    with open(config.predicted_result_template.replace("<id_card>", config.data["id_card"]), 'w', encoding='utf-8') as f:
-                        json.dump(response, f, ensure_ascii=False)
+                response = build_response(config, ctx.data, scored, artifacts.correction_ref)
+                print(f"腦齡預測結果: {response['results']['brainAge']}")
+                print(r"‧★,:*:‧\(^o^)/‧:*‧°★*")
+                print()
+
+                save_predicted_result(config, response)
+
+                return jsonify(response), 200
 
-                    return jsonify(response), 200
-        
             except requests.RequestException as e:
                 print(f"Error: {e}")
                 return jsonify({"error": f"\nRequest to get_integrated_result failed: {str(e)}"}), 500
@@ -331,7 +384,86 @@ def predict():
         print("\nUnexpected error during prediction:", str(e))        
         print("Traceback:", traceback.format_exc())
         return jsonify({"error": str(e)}), 500
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    '''
+    Predicts many subjects in one request: {"subjects": [{"age", "id_card", "name", "test_date", ["features"]}, ...]}.
+    Subjects are grouped by age group and each group is scored as a single feature matrix.
+    Subjects without "features" are looked up in the feature store, all in one get_many() call.
+    Results are returned in input order; a subject that cannot be processed gets an "error" entry.
+    '''
+    try:
+        data = request.get_json(force=True)
+
+        if (not isinstance(data, dict)) or (not isinstance(data.get('subjects'), list)):
+            return jsonify({"error": "Invalid input data"}), 400
+
+        subjects = data['subjects']
+        save = data.get('save', True)
+        now = datetime.now()
+        print(f"\n{now.strftime('%Y-%m-%d %H:%M:%S')} Received batch predict request for {len(subjects)} subjects")
+
+        responses = [None] * len(subjects)
+        valid_subjects = []
+        for idx, subject in enumerate(subjects):
+            if not is_valid_subject(subject):
+                responses[idx] = {
+                    "id_card": subject.get('id_card') if isinstance(subject, dict) else None, 
+                    "error": "Invalid input data"
+                }
+                continue
+            valid_subjects.append((idx, subject))
+
+        ## Look up the features of all subjects sent without them at once
+        lookup_ids = [ subject['id_card'] for _, subject in valid_subjects if subject.get('features') is None ]
+        stored_features, lookup_error = {}, None
+        if lookup_ids:
+            try:
+                stored_features = feature_store.get_many(lookup_ids)
+            except requests.RequestException as e:
+                lookup_error = str(e)
+
+        groups = {}
+        for idx, subject in valid_subjects:
+            features = subject.get('features')
+            if features is None:
+                features = stored_features.get(subject['id_card'])
+                if features is None:
+                    responses[idx] = {
+                        "id_card": subject['id_card'], 
+                        "error": lookup_error or f"Integrated result not found for subject ID: {subject['id_card']}"
+                    }
+                    continue
+
+            groups.setdefault(get_age_group(subject['age']), []).append((idx, subject, features))
+
+        for age_full, members in groups.items():
+            artifacts = registry.get(age_full)
+            scored_list = score_subjects(
+                config, artifacts, [ subject['age'] for _, subject, _ in members ], [ features for _, _, features in members ]
+            )
+            for (idx, subject, _), scored in zip(members, scored_list):
+                response = build_response(config, subject, scored, artifacts.correction_ref)
+                if save:
+                    save_predicted_result(config, response)
+                responses[idx] = response
+
+        n_failed = sum(1 for r in responses if "error" in r)
+        print(f"Batch prediction done: {len(responses) - n_failed} succeeded, {n_failed} failed.")
+
+        return jsonify({"results": responses}), 200
+
+    except Exception as e:
+        import traceback
+        print("\nUnexpected error during batch prediction:", str(e))        
+        print("Traceback:", traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
     
+@app.route('/status', methods=['GET'])
+def status():
+    return jsonify({"status": "ok", "models": registry.status()}), 200
+
 @app.route('/process_textreading', methods=['POST'])
 def process_textreading_proxy(): 
     config = Config()
@@ -343,10 +475,11 @@ def process_textreading_proxy():
         
         else:
             print(f"\nReceived input data at /process_textreading: {data}")
-            resp = requests.post(
+            resp = http_client.post(
                 url=config.process_textreading_url, 
                 headers=config.local_headers, 
-                json=data
+                json=data, 
+                timeout=config.process_textreading_timeout
             )      
             if resp.status_code == 200:
                 return jsonify({
@@ -379,4 +512,4 @@ def not_found(e):
     return jsonify({"error": {"type": "not_found", "path": request.path}}), 404
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8888)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8888, threaded=True)
\ No newline at end of file
@@ -4,15 +4,19 @@ import os
 import logging
 from datetime import datetime
 
-import requests
 from dotenv import load_dotenv
 
+import http_client
+from download_state import make_download_state
+
 class Config:
     def __init__(self):
         self.source_dir = os.path.dirname(os.path.abspath(__file__))
         self.log_dir = os.path.join(self.source_dir, "..", "logs")
         self.log_fn_format = "processTasks_%Y-%m-%d.log"
+        self.textreading_data_dir = os.path.join(self.source_dir, "..", "data", os.getenv("EXPERIMENT_TEXTREADING_NAME", "TextReading"))
         self.process_textreading_url = os.getenv("PROCESS_TEXTREADING_URL")
+        self.process_textreading_timeout = float(os.getenv("PROCESS_TEXTREADING_TIMEOUT", 1800)) # seconds; transcription is slow
         self.predict_url = os.getenv("PREDICT_URL")
         self.local_headers = {
             "X-GitLab-Token": "tcnl-project",
@@ -30,13 +34,14 @@ def setup_logger():
     return logger
 
 def execute_process_textreading(subject_id, csv_filename, config, logger): 
-    res = requests.post(
+    res = http_client.post(
         url=config.process_textreading_url, 
         headers=config.local_headers, 
         json={
             "subject_id": subject_id,
             "csv_filename": csv_filename
-        }
+        }, 
+        timeout=config.process_textreading_timeout
     )
     if res.status_code == 200:
         logger.info(f"Successfully sent process_textreading request for {subject_id}")
@@ -44,7 +49,7 @@ def execute_process_textreading(subject_id, csv_filename, config, logger):
         raise Exception(f"Failed to send process_textreading request for {subject_id}: {res.status_code}")
 
 def get_user_info(subject_id, logger):
-    res = requests.get(
+    res = http_client.get(
         url=f'https://qoca-api.chih-he.dev/user/{subject_id}'
     )
     if res.status_code == 200:
@@ -54,7 +59,7 @@ def get_user_info(subject_id, logger):
         raise Exception(f"Failed to retrieve user info for {subject_id}: {res.status_code}")
 
 def get_predict_result(age, subject_id, name, test_date, config, logger):
-    res = requests.post(
+    res = http_client.post(
         url=config.predict_url, 
         headers=config.local_headers, 
         json={
@@ -71,7 +76,7 @@ def get_predict_result(age, subject_id, name, test_date, config, logger):
         raise Exception(f"Failed to retrieve predict_result for {subject_id}: {res.status_code}")
 
 def update_report_status(task_id, status, logger):
-    res = requests.put(
+    res = http_client.put(
         url=f"https://qoca-api.chih-he.dev/tasks/{task_id}", 
         json={
             "status": status
@@ -83,7 +88,7 @@ def update_report_status(task_id, status, logger):
         raise Exception(f"Failed to update report status for task #{task_id}: {res.status_code}")
 
 def update_predict_result(exam_id, predict_result, logger):
-    res = requests.put(
+    res = http_client.put(
         url=f"https://qoca-api.chih-he.dev/exams/{exam_id}", 
         json=predict_result
     )
@@ -100,7 +105,7 @@ if __name__ == "__main__":
     logger = setup_logger()
     
     ## Search for tasks that need to be processed (is_file_ready=1 & status=0)
-    res = requests.get(
+    res = http_client.get(
         url="https://qoca-api.chih-he.dev/tasks?is_file_ready=1&status=0"
     )
     if res.status_code == 200:
@@ -111,6 +116,7 @@ if __name__ == "__main__":
             logger.info("No tasks to process")
         else:
             logger.info(f"Retrieved {len(tasks)} tasks to process")
+            download_state = make_download_state(config.textreading_data_dir)
 
             for task in tasks:
                 task_id = task['id']
@@ -119,6 +125,14 @@ if __name__ == "__main__":
                 subject_id = csv_filename.split('_')[0]
                 test_date = os.path.splitext(csv_filename)[0].split('_')[-1]
 
+                ## Media files still missing according to the downloader (e.g., is_file_ready was set by hand):
+                known_state = download_state.get(subject_id)
+                if known_state is not None and known_state["expected_media"] is not None \
+                        and known_state["downloaded_media"] < known_state["expected_media"]:
+                    logger.warning(
+                        f"Only {known_state['downloaded_media']} of {known_state['expected_media']} media files of {subject_id} are downloaded"
+                    )
+
                 execute_process_textreading(
                     subject_id, csv_filename, config, logger
                 )
@@ -135,4 +149,6 @@ if __name__ == "__main__":
                     predict_result['testDate'] = datetime.strptime(
                         predict_result['testDate'], "%Y-%m-%dT%H%M%S.%fZ"
                     ).isoformat()
-                    update_predict_result(exam_id, predict_result, logger)
\ No newline at end of file
+                    update_predict_result(exam_id, predict_result, logger)
+
+    logger.info(f"HTTP calls:\n{http_client.format_stats()}")
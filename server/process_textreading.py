@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import os
-import glob
 
 import uvicorn
 import pandas as pd
@@ -12,15 +11,25 @@ from pydantic import BaseModel
 from uvicorn_config import LOGGING_CONFIG
 from server import Config, setup_logger, authenticate_gitlab, update_json_result
 from data_processors.textreading_processor import TextReadingProcessor
+from transcription_cache import TranscriptionCache
+from file_index import get_file_index
 
 class SubjectReprocessRequest(BaseModel):
     subject_id: str
     csv_filename: str 
 
-def process_text_reading(subject_id: str, csv_filename: str, config, logger) -> dict:
-    text_reading_processor = TextReadingProcessor(
-        data_dir=os.path.join(config.data_dir, config.exp_textreading_name)
+def make_text_reading_processor(config):
+    return TextReadingProcessor(
+        data_dir=os.path.join(config.data_dir, config.exp_textreading_name), 
+        model_name=config.whisper_model, 
+        device=config.whisper_device, 
+        streaming=config.textreading_streaming, 
+        keep_intermediate=config.textreading_keep_intermediate, 
+        cache=transcription_cache
     )
+
+def process_text_reading(subject_id: str, csv_filename: str, config, logger) -> dict:
+    text_reading_processor = make_text_reading_processor(config)
     result = {
         "status": "error",
         "message": "",
@@ -41,7 +50,7 @@ def process_text_reading(subject_id: str, csv_filename: str, config, logger) ->
             logger.info(f"Test date from CSV: {test_date}")
             
             pattern = f"{subject_id}_TextReading_{test_date}_recording_mic_*.webm"
-            audio_files = list(glob.glob(os.path.join(config.data_dir, config.exp_textreading_name, pattern)))
+            audio_files = get_file_index(os.path.join(config.data_dir, config.exp_textreading_name)).glob(pattern)
             audio_files = [ f for f in audio_files if "practice_loop" not in f ]  # exclude practice files
 
             if not audio_files:
@@ -51,15 +60,14 @@ def process_text_reading(subject_id: str, csv_filename: str, config, logger) ->
                 logger.info(f"Found {len(audio_files)} audio files for subject {subject_id} on date {test_date}")
                 result["files_processed"] = [ os.path.basename(f) for f in audio_files ]
 
-                csv_files = []
-                for audio_file in audio_files:
-                    logger.info(f"\nProcessing audio file: {audio_file}")
-                    try:
-                        csv_file = text_reading_processor.generate_csv(audio_file)
-                        if csv_file:
-                            csv_files.append(csv_file)
-                    except Exception as e:
-                        logger.error(f"\nError processing audio file {audio_file}: {str(e)}")
+                ## Conversion and silence removal of the next files overlap with the transcription of the current one
+                csv_files = text_reading_processor.generate_csvs(
+                    audio_files, prep_workers=config.textreading_prep_workers
+                )
+                for audio_file, csv_file in zip(audio_files, csv_files):
+                    if csv_file is None:
+                        logger.error(f"\nError processing audio file {audio_file}")
+                csv_files = [ csv_file for csv_file in csv_files if csv_file ]
 
                 if csv_files:
                     try:
@@ -76,7 +84,7 @@ def process_text_reading(subject_id: str, csv_filename: str, config, logger) ->
                                 'ID': [subject_id],
                                 'LANGUAGE_READING_BEH_NULL_MeanSR': [mean_speech_rate]
                             })
-                            update_json_result(subject_id, result_df, config, logger)
+                            update_json_result(subject_id, result_df, config, logger, source=config.exp_textreading_name)
                             logger.info(f"\nDone processing for subject {subject_id}!\n")
                             
                             result.update({
@@ -102,6 +110,9 @@ def process_text_reading(subject_id: str, csv_filename: str, config, logger) ->
 load_dotenv()
 config = Config()
 logger = setup_logger()
+transcription_cache = TranscriptionCache(
+    config.transcription_cache_dir, max_bytes=config.transcription_cache_max_mb * 1024 ** 2
+) if config.transcription_cache_enabled else None
 app = FastAPI(docs_url=None)
 
 @app.post("/process_textreading")
@@ -113,4 +124,6 @@ async def reprocess_subject(request: SubjectReprocessRequest, token: str = Depen
     return result
 
 if __name__ == "__main__":
+    if config.whisper_warm_up:
+        make_text_reading_processor(config).warm_up()
     uvicorn.run(app, host="0.0.0.0", port=6666, log_config=LOGGING_CONFIG)
\ No newline at end of file
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# This script re-processes the raw task data of many participants (e.g., after a change to a data processor)
+# and writes their integrated results to the feature store in batches.
+# The (task, chunk of participants) units are processed in a pool of processes, one per CPU core by default.
+# TextReading is left out unless it is listed in --tasks, since it runs Whisper.
+
+# Usage: python rebuild_integrated_results.py (--all | -fd <YYYY-MM-DD> [-td <YYYY-MM-DD>] | -s <subject_id1> ...)
+#                                             [-t <TASK> ...] [-w <N_WORKERS>] [-c <CHUNK_SIZE>] [-b <BATCH_SIZE>]
+
+import os
+import re
+import time
+import argparse
+from dotenv import load_dotenv
+
+from server import Config, setup_logger, update_json_results
+from task_integrator import TaskIntegrator
+from file_index import get_file_index
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all", action="store_true",
+                        help="Re-process all participants in the data directories.")
+    parser.add_argument("-fd", "--from_date", type=str, default=None,
+                        help="Re-process the participants tested on or after this date (YYYY-MM-DD).")
+    parser.add_argument("-td", "--to_date", type=str, default=None,
+                        help="Re-process the participants tested on or before this date (YYYY-MM-DD).")
+    parser.add_argument("-s", "--subjects", nargs="*", default=[],
+                        help="Subject IDs to re-process.")
+    parser.add_argument("-t", "--tasks", nargs="*", default=None,
+                        help="Experiment names of the tasks to re-process (default: all but TextReading).")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes.")
+    parser.add_argument("-c", "--chunk_size", type=int, default=20,
+                        help="Number of participants per unit of work.")
+    parser.add_argument("-b", "--batch_size", type=int, default=100,
+                        help="Number of participants per feature store write.")
+    args = parser.parse_args()
+    if not (args.all or args.from_date or args.to_date or args.subjects):
+        parser.error("specify --all, a date range (-fd/-td) or subjects (-s)")
+    return args
+
+def find_subject_ids(tasks, from_date, to_date, config):
+    '''
+    Lists the participants having a data file of any of the tasks (named "<subject_id>_<task>_<YYYY-MM-DD>...")
+    tested within the date range (both ends included; None for no bound).
+    '''
+    subject_ids = set()
+    for task in tasks:
+        for fp in get_file_index(os.path.join(config.data_dir, task)).glob("*_*_*.csv"):
+            subject_id, _, test_date = os.path.basename(fp).split("_")[:3]
+            test_date = test_date[:10]
+            if not re.match(r"\d{4}-\d{2}-\d{2}$", test_date):
+                continue
+            if from_date and test_date < from_date:
+                continue
+            if to_date and test_date > to_date:
+                continue
+            subject_ids.add(subject_id)
+
+    return sorted(subject_ids)
+
+def main():
+    load_dotenv()
+    config = Config()
+    logger = setup_logger()
+    args = parse_args()
+
+    tasks = args.tasks or [ task for task in config.exp_name_list if task != config.exp_textreading_name ]
+    if args.subjects:
+        subject_ids = args.subjects
+    else:
+        subject_ids = find_subject_ids(tasks, args.from_date, args.to_date, config)
+    logger.info(f"Re-processing {', '.join(tasks)} for {len(subject_ids)} subjects with {args.workers} workers ...")
+
+    ## The results are written as soon as a batch of participants is complete
+    pending = {}
+    n_updated = 0
+    def _on_subject_done(subject_id, result_df):
+        nonlocal n_updated
+        if result_df is not None:
+            pending[subject_id] = result_df
+        if len(pending) >= args.batch_size:
+            update_json_results(pending, config, logger, source="rebuild")
+            n_updated += len(pending)
+            pending.clear()
+
+    start_time = time.time()
+    results = TaskIntegrator().process_subjects_parallel(
+        subject_ids, tasks_to_process=tasks,
+        max_workers=args.workers, chunk_size=args.chunk_size, on_subject_done=_on_subject_done
+    )
+    if pending:
+        update_json_results(pending, config, logger, source="rebuild")
+        n_updated += len(pending)
+
+    n_failed = sum(result is None for result in results.values())
+    logger.info(f"Updated {n_updated} subjects ({n_failed} without results) in {time.time() - start_time:.1f} s")
+
+if __name__ == "__main__":
+    main()
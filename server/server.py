@@ -1,20 +1,23 @@
 #!/usr/bin/env python
 
 import os
-import json
 import logging
 from datetime import datetime, timezone
 
 import numpy as np
 import pandas as pd
-import requests
 import uvicorn
-from fastapi import BackgroundTasks, Depends, FastAPI, Header, HTTPException, Request
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 
 import util
+import http_client
 from uvicorn_config import LOGGING_CONFIG
 from task_integrator import TaskIntegrator, process_and_format_result
+from feature_store import make_feature_store
+from job_manager import JobManager, JobQueueFullError
+from file_index import get_file_index
 
 class Config:
     def __init__(self):
@@ -26,9 +29,14 @@ class Config:
         self.source_dir = os.path.dirname(os.path.abspath(__file__))
         self.data_dir = os.path.join(self.source_dir, "..", "data")
         self.integrated_results_dir = os.path.join(self.source_dir, "integrated_results")
+        self.transcription_cache_dir = os.path.join(self.source_dir, "transcription_cache")
+        self.feature_db_path = os.path.join(self.integrated_results_dir, "integrated_results.db")
+        self.feature_store_backend = os.getenv("FEATURE_STORE_BACKEND", "sqlite") # "sqlite" or "json"
         self.fetch_file_url = "https://gitlab.pavlovia.org/api/v4/projects/{}/repository/files/data%2F{}/raw?ref=master"
         self.discord_webhook_url = os.getenv("DISCORD_WEBHOOK_URL")
         self.predict_url = os.getenv("PREDICT_URL")
+        self.predict_batch_url = os.getenv("PREDICT_BATCH_URL") or f"{self.predict_url}_batch"
+        self.predict_batch_timeout = float(os.getenv("PREDICT_BATCH_TIMEOUT", 600)) # seconds
         self.qoca_url = os.getenv("QOCA_URL")
 
     def setup_auths(self):
@@ -54,6 +62,16 @@ class Config:
         self.platform_features = util.init_platform_features()
         self.missing_marker = -999
         self.discord_role_id = int(os.getenv("DISCORD_ROLE_ID"))
+        self.whisper_model = os.getenv("WHISPER_MODEL", "base")
+        self.whisper_device = os.getenv("WHISPER_DEVICE") or None # e.g., "cpu" or "cuda"; None: CUDA if available
+        self.whisper_warm_up = os.getenv("WHISPER_WARM_UP", "1") == "1"
+        self.textreading_streaming = os.getenv("TEXTREADING_STREAMING", "0") == "1" # decode audio in memory, without intermediate .wav files
+        self.textreading_keep_intermediate = os.getenv("TEXTREADING_KEEP_INTERMEDIATE", "0") == "1"
+        self.transcription_cache_enabled = os.getenv("TRANSCRIPTION_CACHE", "1") == "1"
+        self.transcription_cache_max_mb = float(os.getenv("TRANSCRIPTION_CACHE_MAX_MB", 500))
+        self.textreading_prep_workers = int(os.getenv("TEXTREADING_PREP_WORKERS", 4)) # threads for audio conversion and silence removal
+        self.webhook_max_workers = int(os.getenv("WEBHOOK_MAX_WORKERS", 4))
+        self.webhook_max_pending = int(os.getenv("WEBHOOK_MAX_PENDING", 100)) # queued + running jobs; 503 beyond this
 
 def setup_logger():
     logger = logging.getLogger(__name__)
@@ -75,7 +93,7 @@ def authenticate_gitlab(x_gitlab_token: str = Header(...)):
     return x_gitlab_token
 
 def send_msg_to_discord(msg, config, logger):
-    res = requests.post(
+    res = http_client.post(
         url=config.discord_webhook_url, 
         json={"content": msg}
     )
@@ -96,13 +114,14 @@ def fetch_file(project_name, project_id, filename, config, logger):
         return file_path
     else:
         logger.info(f"Fetching file {filename} from project {project_name}.")
-        resp = requests.get(
+        resp = http_client.get(
             url=config.fetch_file_url.format(project_id, filename), 
             headers=config.gitlab_headers
         )
         if resp.status_code == 200:
             with open(file_path, "wb") as f:
                 f.write(resp.content)
+            get_file_index(project_dir).add(file_path)
             logger.info(f"Successfully fetched file from project {project_name}.")
             return file_path
         else:
@@ -126,57 +145,83 @@ def convert_np_types(obj):
     else:
         return obj
 
-def update_json_result(subject_id, result_df, config, logger):
-    json_file_path = os.path.join(
-        config.integrated_results_dir, f"{subject_id}_integrated_result.json"
-    )
-    if os.path.exists(json_file_path):
-        with open(json_file_path, 'r') as json_file:
-            existing_data = json.load(json_file)
-    else:
-        existing_data = { 
-            feature: config.missing_marker for feature in config.platform_features 
-        }
+def format_json_result(result_df, config):
     result_df = result_df.replace([pd.NA, pd.NaT, float('inf'), float('-inf')], config.missing_marker)
     result_df = result_df.fillna(config.missing_marker)
-    formatted_result = process_and_format_result(
+    return process_and_format_result(
         result_df, config.platform_features
     )
-    for key, value in formatted_result.items():
-        if value != config.missing_marker:
-            existing_data[key] = value
-        elif key not in existing_data:
-            existing_data[key] = config.missing_marker
 
-    with open(json_file_path, 'w') as f:
-        json.dump(existing_data, f, indent=2, default=convert_np_types)
-    logger.info(f"Successfully updated {json_file_path}")
+def update_json_result(subject_id, result_df, config, logger, source=None):
+    formatted_result = format_json_result(result_df, config)
+    make_feature_store(config).update(
+        subject_id, formatted_result, config.missing_marker, source=source
+    )
+    logger.info(f"Successfully updated the integrated result of {subject_id} ({config.feature_store_backend})")
+
+def update_json_results(result_dfs, config, logger, source=None):
+    '''
+    Batch version of update_json_result(): writes { subject_id: result_df } in a single feature store call
+    (a single transaction with the SQLite backend).
+    '''
+    formatted_results = {
+        subject_id: format_json_result(result_df, config) 
+        for subject_id, result_df in result_dfs.items()
+    }
+    make_feature_store(config).update_many(
+        formatted_results, config.missing_marker, source=source
+    )
+    logger.info(f"Successfully updated the integrated results of {len(formatted_results)} subjects ({config.feature_store_backend})")
 
 def process_file(project_name, filepath, config, logger): 
     subject_id = os.path.basename(filepath).split('_')[0]
     
     if project_name == config.exp_gofitt_name:
-        result_df = TaskIntegrator().process_subject(subject_id, tasks_to_process=[config.exp_gofitt_name])
+        result_df = task_integrator.process_subject(subject_id, tasks_to_process=[config.exp_gofitt_name])
     elif project_name == config.exp_ospan_name:
-        result_df = TaskIntegrator().process_subject(subject_id, tasks_to_process=[config.exp_ospan_name])
+        result_df = task_integrator.process_subject(subject_id, tasks_to_process=[config.exp_ospan_name])
     elif project_name == config.exp_speechcomp_name:
-        result_df = TaskIntegrator().process_subject(subject_id, tasks_to_process=[config.exp_speechcomp_name])
+        result_df = task_integrator.process_subject(subject_id, tasks_to_process=[config.exp_speechcomp_name])
     elif project_name == config.exp_exclusion_name:
-        result_df = TaskIntegrator().process_subject(subject_id, tasks_to_process=[config.exp_exclusion_name])
+        result_df = task_integrator.process_subject(subject_id, tasks_to_process=[config.exp_exclusion_name])
     elif project_name == config.exp_textreading_name:
         logger.info(f"Skipping data processing for TextReading")
         result_df = None
 
     if result_df is not None:
         logger.info(f"Successfully processed data from {project_name}")
-        update_json_result(subject_id, result_df, config, logger)
+        update_json_result(subject_id, result_df, config, logger, source=project_name)
     elif project_name == config.exp_textreading_name:
         logger.info(f"No results for TextReading")
     else:
         logger.warning(f"No results found for {project_name}")
 
+def handle_commit(project_name, project_id, filename, config, logger):
+    '''
+    Fetches and processes a CSV file uploaded to a Pavlovia project;
+    for TextReading, also predicts brain age, uploads the exam and creates the report-generating task.
+    Runs in a worker thread of the JobManager, so it does not block the event loop.
+    '''
+    subject_id = filename.split('_')[0]
+    result = {"fetched_file": filename}
+
+    logger.info(f"Fetching file: {filename}")
+    filepath = fetch_file(project_name, project_id, filename, config, logger)    
+    process_file(project_name, filepath, config, logger)
+
+    if project_name == config.exp_textreading_name:
+        predict_result = predict(subject_id, config, logger)
+
+        if predict_result:
+            exam_id = upload_exam(predict_result, config, logger)
+            if exam_id:
+                create_task(exam_id, filename, config, logger)
+            result["exam_id"] = exam_id
+
+    return result
+
 def predict(id_card, config, logger, test_date=None):
-    res = requests.get(
+    res = http_client.get(
         url=f"https://qoca-api.chih-he.dev/user/{id_card}"
     )
     if res.status_code == 200:
@@ -187,7 +232,7 @@ def predict(id_card, config, logger, test_date=None):
             now = datetime.now(timezone.utc)
             test_date = now.strftime('%Y-%m-%dT%H%M%S.') + f"{int(now.microsecond / 1000):03d}Z"
 
-        res = requests.post(
+        res = http_client.post(
             url=config.predict_url, 
             headers=config.local_headers, 
             json={
@@ -209,6 +254,57 @@ def predict(id_card, config, logger, test_date=None):
         return None
         # raise Exception(f"{res.text}: {res.status_code}")
 
+def predict_batch(subject_test_dates, config, logger):
+    '''
+    Predicts many subjects with a single request to the local /predict_batch endpoint.
+    Takes a dict of {subject_id: test_date} and returns a dict of {subject_id: predict_result or None}.
+    '''
+    subjects = []
+    for id_card, test_date in subject_test_dates.items():
+        res = http_client.get(
+            url=f"https://qoca-api.chih-he.dev/user/{id_card}"
+        )
+        if res.status_code != 200:
+            logger.error(f"Failed to retrieve user info for {id_card}")
+            continue
+        user_info = res.json()
+
+        if test_date is None:
+            now = datetime.now(timezone.utc)
+            test_date = now.strftime('%Y-%m-%dT%H%M%S.') + f"{int(now.microsecond / 1000):03d}Z"
+
+        subjects.append({
+            "age": user_info['age'],
+            "id_card": id_card,
+            "name": user_info['name'],
+            "test_date": test_date
+        })
+    logger.info(f"Successfully retrieved user info for {len(subjects)}/{len(subject_test_dates)} subjects")
+
+    predict_results = { id_card: None for id_card in subject_test_dates }
+    if not subjects:
+        return predict_results
+
+    res = http_client.post(
+        url=config.predict_batch_url, 
+        headers=config.local_headers, 
+        json={
+            "subjects": subjects
+        }, 
+        timeout=config.predict_batch_timeout
+    )
+    if res.status_code == 200:
+        for result in res.json()["results"]:
+            if "error" in result:
+                logger.warning(f"Failed to predict {result['id_card']}: {result['error']}")
+            else:
+                predict_results[result['id_card']] = result
+        logger.info("Successfully retrieved batch prediction results")
+    else:
+        logger.error(f"Failed to retrieve batch prediction results: {res.status_code}")
+
+    return predict_results
+
 def parse_iso_date(s: str) -> str:
     formats = [
         "%Y-%m-%dT%H:%M:%S.%fZ", 
@@ -224,7 +320,7 @@ def parse_iso_date(s: str) -> str:
 
 def upload_exam(exam, config, logger):
     exam['testDate'] = parse_iso_date(exam['testDate'])
-    res = requests.post(
+    res = http_client.post(
         url='https://qoca-api.chih-he.dev/exams', 
         headers=config.qoca_headers, 
         json=exam
@@ -239,7 +335,7 @@ def upload_exam(exam, config, logger):
         raise Exception(f"{res.text}: {res.status_code}")
 
 def create_task(exam_id, csv_filename, config, logger):
-    res = requests.post(
+    res = http_client.post(
         url='https://qoca-api.chih-he.dev/tasks', 
         headers=config.qoca_headers, 
         json={
@@ -258,6 +354,10 @@ def create_task(exam_id, csv_filename, config, logger):
 load_dotenv()
 config = Config()
 logger = setup_logger()  
+task_integrator = TaskIntegrator()
+job_manager = JobManager(
+    max_workers=config.webhook_max_workers, max_pending=config.webhook_max_pending, logger=logger
+)
 app = FastAPI(docs_url=None)
 
 @app.get("/")
@@ -266,7 +366,7 @@ def read_root():
     return {"status": "ok"}
 
 @app.post("/webhook")
-async def receive_webhook(request: Request, background_tasks: BackgroundTasks, token: str = Depends(authenticate_gitlab)):
+async def receive_webhook(request: Request, token: str = Depends(authenticate_gitlab)):
     body = await request.json()
     commits = body.get("commits", [])
     
@@ -274,49 +374,85 @@ async def receive_webhook(request: Request, background_tasks: BackgroundTasks, t
     project_id = body["project"]["id"]
     logger.info(f"Received {len(commits)} commits from project {project_name} ({project_id})")
 
+    ## Every added CSV file of every commit is queued once (deduplicated by filename);
+    ## the files are fetched and processed concurrently by the JobManager workers
+    file_statuses = []
+    queued_filenames = set()
     for commit in commits:
         commiter = commit["author"]["name"]
-        filetype = commit["title"].split('.')[-1]
 
         if commiter not in ["Pavlovia Committer", "Local Committer"]:
-            logger.warning("Ignoring commit from non-Pavlovia Committer.")
-            return {"status": "ignored", "reason": "non-Pavlovia Committer"}
-        
-        elif filetype != "csv":
-            logger.warning("Ignoring non-CSV file commit.")
-            return {"status": "ignored", "reason": "non-CSV file"}
-        
-        else:
-            filename = os.path.basename(commit["added"][0])
-            subject_id = filename.split('_')[0]
+            logger.warning(f"Ignoring commit from non-Pavlovia Committer: {commiter}")
+            file_statuses += [
+                {"filename": os.path.basename(fp), "status": "ignored", "reason": "non-Pavlovia Committer"}
+                for fp in commit.get("added", [])
+            ]
+            continue
+
+        for fp in commit.get("added", []):
+            filename = os.path.basename(fp)
+
+            if filename.split('.')[-1] != "csv":
+                logger.warning(f"Ignoring non-CSV file: {filename}")
+                file_statuses.append({"filename": filename, "status": "ignored", "reason": "non-CSV file"})
+                continue
+
+            if filename in queued_filenames:
+                continue
+            queued_filenames.add(filename)
 
             # if commiter == "Pavlovia Committer":
+            #     subject_id = filename.split('_')[0]
             #     msg = f"<@{config.discord_role_id}> Data from {project_name} has been uploaded for subject {subject_id}"
             #     send_msg_to_discord(msg, config, logger)
 
-            logger.info(f"Fetching file: {filename}")
-            filepath = fetch_file(project_name, project_id, filename, config, logger)    
-            process_file(project_name, filepath, config, logger)
+            try:
+                job_id = job_manager.submit(
+                    handle_commit, project_name, project_id, filename, config, logger, 
+                    description=f"{project_name}/{filename}", key=(project_name, filename)
+                )
+            except JobQueueFullError as e:
+                logger.error(f"Rejected {filename}: {e}")
+                file_statuses.append({"filename": filename, "status": "rejected", "reason": str(e)})
+                continue
+
+            logger.info(f"Queued {filename} (job_id={job_id})")
+            file_statuses.append({"filename": filename, "status": "queued", "job_id": job_id})
+
+    n_queued = sum(1 for fs in file_statuses if fs["status"] == "queued")
+    n_rejected = sum(1 for fs in file_statuses if fs["status"] == "rejected")
+    logger.info(f"Queued {n_queued} of {len(file_statuses)} files from project {project_name}")
+
+    ## Let GitLab retry the delivery if nothing could be queued because of a full queue
+    if n_rejected and not n_queued:
+        raise HTTPException(status_code=503, detail=file_statuses)
+
+    return {"status": "ok" if n_queued else "ignored", "files": file_statuses}
 
-            if project_name == config.exp_textreading_name:
-                predict_result = predict(subject_id, config, logger)
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, token: str = Depends(authenticate_gitlab)):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
-                if predict_result:
-                    exam_id = upload_exam(predict_result, config, logger)
-                    if exam_id:
-                        create_task(exam_id, filename, config, logger)
+@app.get("/jobs")
+async def get_job_stats(token: str = Depends(authenticate_gitlab)):
+    return job_manager.stats()
 
-            return {"status": "ok", "fetched_file": filename}
+@app.get("/http_stats")
+async def get_http_stats(token: str = Depends(authenticate_gitlab)):
+    return http_client.stats()
 
 @app.post('/report')
 async def create_report(request: Request):
     body = await request.json()
     subject_id = body.get("subject_id")
 
-    predict_result = predict(subject_id, config, logger)
+    predict_result = await run_in_threadpool(predict, subject_id, config, logger)
     # print(predict_result)
     if predict_result:
-        exam_id = upload_exam(predict_result, config, logger)
+        exam_id = await run_in_threadpool(upload_exam, predict_result, config, logger)
         return {"status": "ok", 'exam_id': exam_id}
     else:
         raise HTTPException(status_code=422, detail="Failed to produce predict_result")
@@ -2,14 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import os
-import glob
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from data_processors.gofitts_processor import GoFittsProcessor
 from data_processors.exclusion_processor import ExclusionProcessor
 from data_processors.ospan_processor import OspanProcessor
 from data_processors.speechcomp_processor import SpeechcompProcessor
 from data_processors.textreading_processor import TextReadingProcessor
+from file_index import get_file_index
 
 class TaskIntegrator:
     def __init__(self):
@@ -21,11 +22,22 @@ class TaskIntegrator:
         self.exp_exclusion_name = os.getenv("EXPERIMENT_EXCLUSION_NAME")
         self.exp_textreading_name = os.getenv("EXPERIMENT_TEXTREADING_NAME")
         self.exp_name_list = [self.exp_gofitt_name, self.exp_ospan_name, self.exp_speechcomp_name, self.exp_exclusion_name, self.exp_textreading_name]
+        self.gofitts_use_jar = os.getenv("GOFITTS_USE_JAR", "1") == "1"
+        ## Processors are stateless, so they are created once and shared by all calls (and threads)
+        self.processors = {
+            self.exp_gofitt_name: GoFittsProcessor(data_dir=os.path.join(self.data_dir, self.exp_gofitt_name), use_jar=self.gofitts_use_jar), 
+            self.exp_ospan_name: OspanProcessor(data_dir=os.path.join(self.data_dir, self.exp_ospan_name)),
+            self.exp_speechcomp_name: SpeechcompProcessor(data_dir=os.path.join(self.data_dir, self.exp_speechcomp_name)),
+            self.exp_exclusion_name: ExclusionProcessor(data_dir=os.path.join(self.data_dir, self.exp_exclusion_name)),
+            self.exp_textreading_name: TextReadingProcessor(data_dir=os.path.join(self.data_dir, self.exp_textreading_name))
+        }
         
     def find_file(self, directory, subject_id, task_name):
+        ## Looked up in the subject -> files index of the directory instead of scanning it
+        file_index = get_file_index(directory)
         if task_name == self.exp_textreading_name:
             pattern = f"{subject_id}_TextReading_*.webm"
-            files = glob.glob(os.path.join(directory, pattern))
+            files = file_index.glob(pattern)
         else:
             patterns = [
                 f"{subject_id}_{task_name}_*.csv",
@@ -36,7 +48,7 @@ class TaskIntegrator:
             ]
             files = []
             for pattern in patterns:
-                matched_files = glob.glob(os.path.join(directory, pattern))
+                matched_files = file_index.glob(pattern)
                 files.extend(matched_files)        
         if files:
             return files[0]
@@ -50,13 +62,7 @@ class TaskIntegrator:
             tasks_to_process = self.exp_name_list  
 
         for task in tasks_to_process:
-            processor = {
-                self.exp_gofitt_name: GoFittsProcessor(data_dir=os.path.join(self.data_dir, self.exp_gofitt_name)), 
-                self.exp_ospan_name: OspanProcessor(data_dir=os.path.join(self.data_dir, self.exp_ospan_name)),
-                self.exp_speechcomp_name: SpeechcompProcessor(data_dir=os.path.join(self.data_dir, self.exp_speechcomp_name)),
-                self.exp_exclusion_name: ExclusionProcessor(data_dir=os.path.join(self.data_dir, self.exp_exclusion_name)),
-                self.exp_textreading_name: TextReadingProcessor(data_dir=os.path.join(self.data_dir, self.exp_textreading_name))
-            }.get(task)
+            processor = self.processors.get(task)
             
             if processor is None:
                 print(f"No processor found for task: {task}")
@@ -80,6 +86,135 @@ class TaskIntegrator:
         
         return combined_result
 
+    def process_subjects(self, subject_ids, tasks_to_process=None, max_workers=8):
+        '''
+        Batch version of process_subject(): makes one process_many() call per task for all subjects
+        and returns { subject_id: combined one-row result or None }.
+        Processors without process_many() (i.e., TextReading) are called once per subject.
+        '''
+        subject_results = { subject_id: [] for subject_id in subject_ids }
+
+        if tasks_to_process is None:
+            tasks_to_process = self.exp_name_list
+
+        for task in tasks_to_process:
+            processor = self.processors.get(task)
+            if processor is None:
+                print(f"No processor found for task: {task}")
+                continue
+
+            file_paths = {}
+            for subject_id in subject_results:
+                file_path = self.find_file(processor.data_dir, subject_id, task)
+                if file_path:
+                    file_paths[subject_id] = file_path
+                else:
+                    print(f"No file found for {task} and subject {subject_id}")
+            if not file_paths:
+                continue
+
+            print(f"Processing {task} for {len(file_paths)} subjects")
+            if hasattr(processor, "process_many"):
+                ## One row per subject; the subjects whose file failed are left out (the failures are printed)
+                result = processor.process_many(list(file_paths.values()), max_workers=max_workers)
+                for subject_id in file_paths:
+                    if subject_id in result.index:
+                        row = result.loc[[subject_id]].reset_index(drop=True)
+                        row.attrs = {}
+                        subject_results[subject_id].append(row)
+            else:
+                for subject_id, file_path in file_paths.items():
+                    result = processor.process_subject(file_path)
+                    if result is not None:
+                        subject_results[subject_id].append(result)
+
+        combined_results = {}
+        for subject_id, results in subject_results.items():
+            if not results:
+                print(f"No results processed for subject {subject_id}")
+                combined_results[subject_id] = None
+                continue
+            combined_result = pd.concat(results, axis=1)
+            combined_results[subject_id] = combined_result.loc[:, ~combined_result.columns.duplicated()]
+
+        return combined_results
+
+    def process_subjects_parallel(self, subject_ids, tasks_to_process=None, max_workers=None, chunk_size=20, on_subject_done=None):
+        '''
+        Parallel version of process_subjects(): the (task, chunk of chunk_size subjects) units are processed
+        in a pool of max_workers processes (default: one per CPU core), and the results are merged per subject
+        in the task order. on_subject_done(subject_id, combined_result) is called as soon as all units of a subject
+        are done; the { subject_id: combined result or None } of all subjects is returned at the end.
+        '''
+        subject_ids = list(dict.fromkeys(subject_ids))
+        if tasks_to_process is None:
+            tasks_to_process = self.exp_name_list
+
+        units = [
+            (task, subject_ids[i:i + chunk_size])
+            for task in tasks_to_process
+            for i in range(0, len(subject_ids), chunk_size)
+        ]
+        if not units:
+            return { subject_id: None for subject_id in subject_ids }
+        task_results = { subject_id: {} for subject_id in subject_ids }
+        remaining_units = { subject_id: len(tasks_to_process) for subject_id in subject_ids }
+        combined_results = {}
+
+        def _subject_done(subject_id):
+            results = [ task_results[subject_id][task] for task in tasks_to_process if task_results[subject_id].get(task) is not None ]
+            if results:
+                combined_result = pd.concat(results, axis=1)
+                combined_result = combined_result.loc[:, ~combined_result.columns.duplicated()]
+            else:
+                print(f"No results processed for subject {subject_id}")
+                combined_result = None
+            combined_results[subject_id] = combined_result
+            del task_results[subject_id]
+            if on_subject_done is not None:
+                on_subject_done(subject_id, combined_result)
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+            futures = { executor.submit(_process_unit, task, chunk): (task, chunk) for task, chunk in units }
+            for future in as_completed(futures):
+                task, chunk = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e: # e.g., a worker process died
+                    print(f"Failed to process {task} for {len(chunk)} subjects: {e}")
+                    results = {}
+                for subject_id in chunk:
+                    task_results[subject_id][task] = results.get(subject_id)
+                    remaining_units[subject_id] -= 1
+                    if remaining_units[subject_id] == 0:
+                        _subject_done(subject_id)
+
+        return { subject_id: combined_results[subject_id] for subject_id in subject_ids }
+
+## Worker side of TaskIntegrator.process_subjects_parallel(): each process builds its own TaskIntegrator once
+
+_worker_integrator = None
+
+def _init_worker():
+    global _worker_integrator
+    _worker_integrator = TaskIntegrator()
+
+def _process_unit(task, subject_ids):
+    try:
+        return _worker_integrator.process_subjects(subject_ids, tasks_to_process=[task], max_workers=1)
+    except Exception as e:
+        ## The processors already leave out the subjects of bad files; this only catches a failure of the whole call
+        ## (e.g., of a processor without process_many()), falling back to processing the subjects one by one
+        print(f"Failed to process {task} for {len(subject_ids)} subjects at once ({e}), retrying one by one")
+        results = {}
+        for subject_id in subject_ids:
+            try:
+                results[subject_id] = _worker_integrator.process_subject(subject_id, tasks_to_process=[task])
+            except Exception as e:
+                print(f"Failed to process {task} for subject {subject_id}: {e}")
+                results[subject_id] = None
+        return results
+
 def process_and_format_result(result_df, platform_features):
     missing_marker = -999
     formatted_result = { feature: missing_marker for feature in platform_features }
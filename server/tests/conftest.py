@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+## The scripts of the server directory import each other as top-level modules (they are run from that directory)
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+## Settings normally read from .env
+for name, value in {
+    "EXPERIMENT_GOFITT_NAME": "GoFitts",
+    "EXPERIMENT_OSPAN_NAME": "OspanTask",
+    "EXPERIMENT_SPEECHCOMP_NAME": "SpeechComp",
+    "EXPERIMENT_EXCLUSION_NAME": "ExclusionTask",
+    "EXPERIMENT_TEXTREADING_NAME": "TextReading",
+    "DISCORD_ROLE_ID": "0",
+}.items():
+    os.environ.setdefault(name, value)
+
+@pytest.fixture
+def stub_server():
+    from http_stub import StubServer
+    server = StubServer().start()
+    yield server
+    server.stop()
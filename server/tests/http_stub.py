@@ -0,0 +1,72 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+## A local HTTP server for the tests of the outbound calls: server.routes maps a path to the list of the responders
+## of its successive requests (the last one answers all remaining requests), and server.received records the
+## (method, path, headers, body) of every request
+
+def reply(status, body=b"", headers=None):
+    def respond(handler):
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+    return respond
+
+def truncated(status, body, sent, headers=None):
+    ## Announces the whole body but only sends its first `sent` bytes before closing the connection
+    def respond(handler):
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body[:sent])
+        handler.wfile.flush()
+        drop_connection(handler)
+    return respond
+
+def drop_connection(handler):
+    ## The request was received, but the connection is closed without a response
+    handler.close_connection = True
+    handler.connection.shutdown(socket.SHUT_RDWR)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.received.append((self.command, self.path, dict(self.headers), body))
+        responders = self.server.routes.get(self.path) or [reply(404)]
+        respond = responders.pop(0) if len(responders) > 1 else responders[0]
+        respond(self)
+
+    do_GET = do_POST = do_PUT = handle_request
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.routes = {}
+        self.received = []
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def requests_to(self, path):
+        return [ request for request in self.received if request[1] == path ]
@@ -0,0 +1,87 @@
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processors.ospan_processor import OspanProcessor
+from data_processors.speechcomp_processor import SpeechcompProcessor
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+PROCESSORS = {
+    "OspanTask": OspanProcessor,
+    "SpeechComp": SpeechcompProcessor
+}
+
+def fixture_files(task):
+    return sorted(glob.glob(os.path.join(FIXTURES_DIR, task, "*.csv")))
+
+def subject_id(file_path):
+    return os.path.basename(file_path).split("_")[0]
+
+def readable(processor, file_paths):
+    ## The files process_subject() returns a row for
+    rows = {}
+    for file_path in file_paths:
+        try:
+            row = processor.process_subject(file_path)
+        except Exception:
+            continue
+        if row is not None:
+            rows[subject_id(file_path)] = row
+    return rows
+
+@pytest.mark.parametrize("task", PROCESSORS)
+def test_process_many_matches_process_subject(task):
+    processor = PROCESSORS[task](data_dir=os.path.join(FIXTURES_DIR, task))
+    file_paths = fixture_files(task)
+    expected = readable(processor, file_paths)
+    assert len(expected) >= 3
+
+    output = processor.process_many(file_paths, max_workers=4)
+    assert list(output.index) == list(expected)
+    assert output.index.name == "subject_id"
+    for sid, row in expected.items():
+        pd.testing.assert_frame_equal(output.loc[[sid]].reset_index(drop=True), row, check_exact=False, rtol=1e-12)
+
+@pytest.mark.parametrize("task", PROCESSORS)
+def test_bad_file_only_leaves_out_its_subject(task, tmp_path):
+    processor = PROCESSORS[task](data_dir=os.path.join(FIXTURES_DIR, task))
+    file_paths = fixture_files(task)
+    bad_file = tmp_path / "S999_bad_2024-03-09.csv"
+    bad_file.write_bytes(b"\x00\x01 not a csv \xff\n\"unterminated")
+
+    output = processor.process_many(file_paths + [str(bad_file)], max_workers=4)
+    assert "S999" not in output.index
+    assert list(output.index) == list(readable(processor, file_paths))
+    assert str(bad_file) in output.attrs["failures"]
+
+def test_header_only_file_is_a_failure():
+    processor = OspanProcessor(data_dir=os.path.join(FIXTURES_DIR, "OspanTask"))
+    header_only = os.path.join(FIXTURES_DIR, "OspanTask", "S004_ospan_2024-03-04_10h00.00.000.csv")
+    output = processor.process_many([header_only])
+    assert output.empty and header_only in output.attrs["failures"]
+    with pytest.raises(Exception):
+        processor.process_subject(header_only)
+
+def test_all_files_failing_returns_an_empty_frame(tmp_path):
+    processor = SpeechcompProcessor(data_dir=str(tmp_path))
+    file_paths = []
+    for sid in ["S001", "S002"]:
+        path = tmp_path / f"{sid}_SpeechComp_2024.csv"
+        path.write_text("condition,stim_resp.corr,duration\npassive_1,1\n\"unterminated\n", encoding="utf-8")
+        file_paths.append(str(path))
+    output = processor.process_many(file_paths)
+    assert output.empty
+    assert sorted(output.attrs["failures"]) == sorted(file_paths)
+
+def test_missing_file_is_skipped():
+    processor = OspanProcessor(data_dir=FIXTURES_DIR)
+    assert processor.process_subject(os.path.join(FIXTURES_DIR, "S000_ospan_missing.csv")) is None
+
+def test_speechcomp_without_passive_trials():
+    processor = SpeechcompProcessor(data_dir=os.path.join(FIXTURES_DIR, "SpeechComp"))
+    row = processor.process_subject(fixture_files("SpeechComp")[2])
+    assert np.isnan(row["SPEECHCOMP_PASSIVE_ACCURACY"].iloc[0])
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processors import csv_loader
+from data_processors.csv_loader import load_csv
+
+COLUMNS = { "指定代號": None, "MathResult": "float64", "LetterResult": "float64", "missing": "float64" }
+
+@pytest.fixture(params=["pyarrow", "c"])
+def engine(request, monkeypatch):
+    if request.param == "pyarrow":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setattr(csv_loader, "CSV_ENGINE", request.param)
+    return request.param
+
+def test_reads_declared_columns_in_order(tmp_path, engine):
+    path = tmp_path / "A_ospan_2024.csv"
+    path.write_text("LetterResult,other,指定代號,MathResult\n1,x,A,0\n0,y,A,1\n", encoding="utf-8")
+    df = load_csv(path, COLUMNS)
+    assert list(df.columns) == ["指定代號", "MathResult", "LetterResult"]
+    assert df["MathResult"].dtype == np.float64
+    assert df["MathResult"].tolist() == [0.0, 1.0]
+
+def test_non_numeric_values_become_nan(tmp_path, engine):
+    path = tmp_path / "A_ospan_2024.csv"
+    path.write_text("指定代號,MathResult,LetterResult\nA,1,None\nA,None,\nA,,abc\nA,0.5,1\n", encoding="utf-8")
+    df = load_csv(path, COLUMNS)
+    assert df["MathResult"].dtype == np.float64 and df["LetterResult"].dtype == np.float64
+    pd.testing.assert_series_equal(df["MathResult"], pd.Series([1.0, np.nan, np.nan, 0.5], name="MathResult"))
+    pd.testing.assert_series_equal(df["LetterResult"], pd.Series([np.nan, np.nan, np.nan, 1.0], name="LetterResult"))
+
+def test_header_only_file(tmp_path, engine):
+    path = tmp_path / "A_ospan_2024.csv"
+    path.write_text("指定代號,MathResult,LetterResult\n", encoding="utf-8")
+    df = load_csv(path, COLUMNS)
+    assert df.empty and list(df.columns) == ["指定代號", "MathResult", "LetterResult"]
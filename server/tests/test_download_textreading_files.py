@@ -0,0 +1,116 @@
+import os
+import re
+import base64
+import hashlib
+import logging
+import types
+
+import pytest
+
+import http_client
+from http_client import HttpClient
+from http_stub import reply, truncated
+from file_index import get_file_index
+from download_textreading_files import download_file
+
+CONTENT = bytes(range(256)) * 20 # 5120 bytes
+MD5 = hashlib.md5(CONTENT).hexdigest()
+
+def ranged(content, headers=None):
+    ## Answers a "Range: bytes=<offset>-" request with 206 and the rest of the content (200 and all of it otherwise)
+    def respond(handler):
+        match = re.fullmatch(r"bytes=(\d+)-", handler.headers.get("Range", ""))
+        if match is None:
+            return reply(200, content, headers)(handler)
+        offset = int(match.group(1))
+        content_range = { "Content-Range": f"bytes {offset}-{len(content) - 1}/{len(content)}" }
+        reply(206, content[offset:], { **(headers or {}), **content_range })(handler)
+    return respond
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    ## No retries: each download_file() call makes exactly one request
+    monkeypatch.setattr(http_client, "_client", HttpClient(retries=0, timeout=5, connect_timeout=1))
+    data_dir = tmp_path / "TextReading"
+    data_dir.mkdir()
+    return types.SimpleNamespace(data_dir=str(data_dir), download_chunk_size=1024)
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test_download_textreading_files")
+
+def test_interrupted_download_is_resumed(stub_server, config, logger):
+    url = f"{stub_server.url}/media/S001_0.webm"
+    file_path = os.path.join(config.data_dir, "S001_0.webm")
+    stub_server.routes["/media/S001_0.webm"] = [truncated(200, CONTENT, 3000, {"ETag": f'"{MD5}"'}), ranged(CONTENT, {"ETag": f'"{MD5}"'})]
+
+    assert download_file(url, config, logger) is None
+    assert not os.path.exists(file_path)
+    offset = os.path.getsize(f"{file_path}.part")
+    assert 0 < offset < len(CONTENT)
+
+    assert download_file(url, config, logger) == file_path
+    with open(file_path, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(f"{file_path}.part")
+    assert stub_server.received[-1][2]["Range"] == f"bytes={offset}-"
+    assert get_file_index(config.data_dir).glob("*.webm") == [file_path]
+
+    ## Already downloaded: no request
+    assert download_file(url, config, logger) == file_path
+    assert len(stub_server.received) == 2
+
+def test_range_ignored_by_the_server(stub_server, config, logger):
+    url = f"{stub_server.url}/media/S002_0.webm"
+    file_path = os.path.join(config.data_dir, "S002_0.webm")
+    with open(f"{file_path}.part", "wb") as f:
+        f.write(CONTENT[:1000])
+    stub_server.routes["/media/S002_0.webm"] = [reply(200, CONTENT)]
+
+    assert download_file(url, config, logger) == file_path
+    assert stub_server.received[-1][2]["Range"] == "bytes=1000-"
+    with open(file_path, "rb") as f:
+        assert f.read() == CONTENT
+
+def test_range_not_satisfiable_starts_over(stub_server, config, logger):
+    url = f"{stub_server.url}/media/S003_0.webm"
+    file_path = os.path.join(config.data_dir, "S003_0.webm")
+    with open(f"{file_path}.part", "wb") as f: # e.g., longer than the file uploaded again since
+        f.write(CONTENT + b"stale")
+    stub_server.routes["/media/S003_0.webm"] = [reply(416), ranged(CONTENT)]
+
+    assert download_file(url, config, logger) is None
+    assert not os.path.exists(f"{file_path}.part")
+
+    assert download_file(url, config, logger) == file_path
+    assert "Range" not in stub_server.received[-1][2]
+    with open(file_path, "rb") as f:
+        assert f.read() == CONTENT
+
+def test_unexpected_content_range_starts_over(stub_server, config, logger):
+    url = f"{stub_server.url}/media/S004_0.webm"
+    file_path = os.path.join(config.data_dir, "S004_0.webm")
+    with open(f"{file_path}.part", "wb") as f:
+        f.write(CONTENT[:1000])
+    stub_server.routes["/media/S004_0.webm"] = [reply(206, CONTENT[500:], {"Content-Range": f"bytes 500-{len(CONTENT) - 1}/{len(CONTENT)}"})]
+
+    assert download_file(url, config, logger) is None
+    assert not os.path.exists(f"{file_path}.part")
+    assert not os.path.exists(file_path)
+
+@pytest.mark.parametrize("checksum_header", [
+    {"Content-MD5": base64.b64encode(hashlib.md5(b"other content").digest()).decode()},
+    {"ETag": f'"{hashlib.md5(b"other content").hexdigest()}"'}
+])
+def test_checksum_mismatch(stub_server, config, logger, checksum_header):
+    url = f"{stub_server.url}/media/S005_0.webm"
+    file_path = os.path.join(config.data_dir, "S005_0.webm")
+    stub_server.routes["/media/S005_0.webm"] = [reply(200, CONTENT, checksum_header), reply(200, CONTENT)]
+
+    assert download_file(url, config, logger) is None
+    assert not os.path.exists(f"{file_path}.part")
+    assert not os.path.exists(file_path)
+
+    ## Downloaded again from the start
+    assert download_file(url, config, logger) == file_path
+    assert "Range" not in stub_server.received[-1][2]
@@ -0,0 +1,131 @@
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processors.exclusion_processor import ExclusionProcessor
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "ExclusionTask")
+
+def fixture_file(subject_id):
+    return glob.glob(os.path.join(FIXTURES_DIR, f"{subject_id}_*.csv"))[0]
+
+class LegacyExclusionProcessor:
+    '''
+    The row-loop implementation that the single groupby replaced (kept as the reference of the parity tests).
+    '''
+    trial_n = 18 * 3
+
+    def select_item(self, data, trial_n):
+        output = data.dropna(how='any')
+        index = list(output.index)[-trial_n:]
+        return output.loc[index, :]
+
+    def mean_rt_calculation(self, data):
+        output = []
+        for each in ['s', 'k']:
+            value = data[data.key_resp_keys == each][['key_resp.rt']].values.flatten()
+            mean_rt = value.sum() / data.shape[0] if data.shape[0] > 0 else 0
+            if mean_rt == 0:
+                mean_rt = -999
+            output.append(mean_rt)
+        return output
+
+    def rt_calculation_stimulus_cue(self, data):
+        return {
+            cue: { stimulus: self.mean_rt_calculation(data[(data.number_of_cue_t == cue) & (data.stimuli_t == stimulus)]) for stimulus in [1, 2, 3] }
+            for cue in [1, 2, 3]
+        }
+
+    def rate_calculation_stimulus_cue(self, input_data):
+        output = []
+        for cue in [1, 2, 3]:
+            cue_data = input_data[input_data.number_of_cue_t == cue]
+            for stimulus in [1, 2, 3]:
+                data = cue_data[cue_data.stimuli_t == stimulus]
+                output.append(data[data.key_resp_keys == 's'].shape[0] / data.shape[0])
+        return output
+
+    def process_subject(self, file_path):
+        data = pd.read_csv(file_path)
+        data.rename(columns={'key_resp.keys': 'key_resp_keys'}, inplace=True)
+        id = data.loc[0, '指定代號']
+        data = data[['number_of_cue_t', 'key_resp_keys', 'key_resp.rt', 'stimuli_t']]
+        data = self.select_item(data, self.trial_n)
+
+        rt = self.rt_calculation_stimulus_cue(data)
+        yes_rate = self.rate_calculation_stimulus_cue(data)
+        no_rate = [1 - each for each in yes_rate]
+        non_tar_fa = [yes_rate[1], yes_rate[4], yes_rate[7]]
+        recollection = [yes_rate[0] - non_tar_fa[0], yes_rate[3] - non_tar_fa[1], yes_rate[6] - non_tar_fa[2]]
+        familiarity = [non_tar_fa[i] / (1 - recollection[i]) if recollection[i] != 1 else non_tar_fa[i] / (1 - 0.999) for i in range(3)]
+
+        output = { 'ID': [id] }
+        for name, values in [('FAMILIARITY', familiarity), ('RECOLLECTION', recollection)]:
+            for cue in range(3):
+                output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}_{name}'] = [values[cue]]
+        for cue in range(3):
+            for stimulus, (yes_name, no_name) in enumerate([('TarHit', 'TarMiss'), ('NonTarFA', 'NonTarCR'), ('NewFA', 'NewCR')]):
+                output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}{yes_name}_PROPORTION'] = [yes_rate[cue * 3 + stimulus]]
+                output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}{no_name}_PROPORTION'] = [no_rate[cue * 3 + stimulus]]
+            for stimulus, (yes_name, no_name) in enumerate([('TarHit', 'TarMiss'), ('NonTarFA', 'NonTarCR'), ('NewFA', 'NewCR')]):
+                output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}{yes_name}_RT'] = [rt[cue + 1][stimulus + 1][0]]
+                output[f'MEMORY_EXCLUSION_BEH_C{cue + 1}{no_name}_RT'] = [rt[cue + 1][stimulus + 1][1]]
+        return pd.DataFrame(output)
+
+@pytest.fixture
+def processor():
+    return ExclusionProcessor(data_dir=FIXTURES_DIR)
+
+## E001: typical responses with a few missing; E002: no practice trials, more test trials than kept;
+## E003: every response wrong; E004: "yes" to every item (no "no" responses, so their RTs are -999)
+@pytest.mark.parametrize("subject_id", ["E001", "E002", "E003", "E004"])
+def test_matches_legacy_implementation(processor, subject_id):
+    expected = LegacyExclusionProcessor().process_subject(fixture_file(subject_id))
+    output = processor.process_subject(fixture_file(subject_id))
+    ## The legacy RT is the integer -999 when a cell has no response of that kind (float64 here); the values are the same
+    pd.testing.assert_frame_equal(output[expected.columns], expected, check_exact=False, check_dtype=False, rtol=1e-12, atol=1e-12)
+    assert sorted(output.columns) == sorted(expected.columns)
+
+def test_process_many_matches_legacy_implementation(processor):
+    file_paths = [fixture_file(subject_id) for subject_id in ["E001", "E002", "E003", "E004"]]
+    output = processor.process_many(file_paths, max_workers=4)
+    for subject_id, file_path in zip(["E001", "E002", "E003", "E004"], file_paths):
+        expected = LegacyExclusionProcessor().process_subject(file_path)
+        pd.testing.assert_frame_equal(
+            output.loc[[subject_id], expected.columns].reset_index(drop=True), expected, check_exact=False, check_dtype=False, rtol=1e-12, atol=1e-12
+        )
+
+def test_empty_cells(processor):
+    ## E005 has no cue 3 trials: the legacy implementation divides by zero, and so does process_subject;
+    ## in a batch the rates of the empty cells are left empty and the other subjects are not affected
+    with pytest.raises(ZeroDivisionError):
+        LegacyExclusionProcessor().process_subject(fixture_file("E005"))
+    with pytest.raises(ZeroDivisionError):
+        processor.process_subject(fixture_file("E005"))
+
+    output = processor.process_many([fixture_file("E001"), fixture_file("E005")])
+    assert list(output.index) == ["E001", "E005"]
+    assert np.isnan(output.loc["E005", "MEMORY_EXCLUSION_BEH_C3TarHit_PROPORTION"])
+    assert output.loc["E005", "MEMORY_EXCLUSION_BEH_C3TarHit_RT"] == -999
+    assert not np.isnan(output.loc["E005", "MEMORY_EXCLUSION_BEH_C1TarHit_PROPORTION"])
+    expected = LegacyExclusionProcessor().process_subject(fixture_file("E001"))
+    pd.testing.assert_frame_equal(output.loc[["E001"], expected.columns].reset_index(drop=True), expected, check_exact=False, check_dtype=False, rtol=1e-12)
+
+def test_header_only_file(processor):
+    with pytest.raises(ValueError, match="No trials"):
+        processor.process_subject(fixture_file("E006"))
+
+    file_paths = [fixture_file("E001"), fixture_file("E006"), fixture_file("E002")]
+    output = processor.process_many(file_paths)
+    assert list(output.index) == ["E001", "E002"]
+    assert list(output.attrs["failures"]) == [fixture_file("E006")]
+
+def test_all_files_failing(processor, tmp_path):
+    bad_file = tmp_path / "E007_exclusion_2024.csv"
+    bad_file.write_text("指定代號,number_of_cue_t\nE007,\"unterminated\n", encoding="utf-8")
+    output = processor.process_many([fixture_file("E006"), str(bad_file)])
+    assert output.empty
+    assert sorted(output.attrs["failures"]) == sorted([fixture_file("E006"), str(bad_file)])
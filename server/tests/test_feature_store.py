@@ -0,0 +1,24 @@
+import pytest
+
+from feature_store import FeatureNotFoundError, JsonFeatureStore, SqliteFeatureStore
+
+MISSING = -999
+
+@pytest.fixture(params=["sqlite", "json"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SqliteFeatureStore(str(tmp_path / "integrated_results.db"))
+    return JsonFeatureStore(str(tmp_path))
+
+def test_get_many_matches_get(store):
+    subject_ids = [f"S{i:04d}" for i in range(100)]
+    for i, subject_id in enumerate(subject_ids[::7]):
+        store.update(subject_id, {"B": i, "A": i / 2, "C": MISSING}, MISSING, source="test")
+
+    output = store.get_many(["NONE"] + subject_ids + subject_ids[:3])
+    assert sorted(output) == sorted(subject_ids[::7])
+    for subject_id in subject_ids[::7]:
+        assert list(output[subject_id].items()) == list(store.get(subject_id).items())
+    with pytest.raises(FeatureNotFoundError):
+        store.get("NONE")
+    assert store.get_many([]) == {}
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from file_index import FileIndex
+
+def touch(path):
+    open(path, "w").close()
+
+@pytest.fixture
+def index(tmp_path):
+    directory = tmp_path / "TextReading"
+    directory.mkdir()
+    touch(directory / "A_TextReading_2024-01-01.csv")
+    return FileIndex(str(directory))
+
+def count_rebuilds(index):
+    calls = []
+    rebuild = index.rebuild
+    def _rebuild():
+        calls.append(1)
+        return rebuild()
+    index.rebuild = _rebuild
+    return calls
+
+def test_lookup_without_changes_does_not_rescan(index):
+    assert [os.path.basename(f) for f in index.subject_files("A")] == ["A_TextReading_2024-01-01.csv"]
+    calls = count_rebuilds(index)
+    index.subject_files("A")
+    index.glob("*.csv")
+    assert calls == []
+
+def test_files_of_other_writers_are_found(index):
+    index.glob("*")
+    ## Written by this code base and added, then by another process (e.g. process_textreading.py) without add()
+    touch(os.path.join(index.directory, "A_1.webm"))
+    index.add(os.path.join(index.directory, "A_1.webm"))
+    touch(os.path.join(index.directory, "A_1_ds.wav.words.csv"))
+    assert index.glob("A_*.csv") == [
+        os.path.join(index.directory, "A_1_ds.wav.words.csv"),
+        os.path.join(index.directory, "A_TextReading_2024-01-01.csv")
+    ]
+
+def test_rescan_applies_removed_files(index):
+    touch(os.path.join(index.directory, "B_1.webm"))
+    assert index.glob("B_*") == [os.path.join(index.directory, "B_1.webm")]
+    os.remove(os.path.join(index.directory, "B_1.webm"))
+    assert index.glob("B_*") == []
+    assert index.stats()["files"] == 1
+
+def test_glob_matches_glob_module(index):
+    import glob
+    for name in ["B_GoFitts_2024.csv", "B_exclusion_2024.csv", ".hidden", "C_1.webm.part"]:
+        touch(os.path.join(index.directory, name))
+    for pattern in ["*", "B_*.csv", "*_exclusion_*.csv", "*.webm", "C_*"]:
+        assert index.glob(pattern) == sorted(glob.glob(os.path.join(index.directory, pattern)))
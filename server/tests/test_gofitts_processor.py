@@ -0,0 +1,71 @@
+import os
+import glob
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processors.gofitts_processor import GoFittsProcessor
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "GoFitts")
+SUBJECT_IDS = ["G001", "G002", "G003"]
+
+## For each subject, the fixture directory holds the task CSV export, the .sd3 file written by convert_file()
+## and the GoFitts-<ID>-sequence-summary.csv written by `java -jar GoFitts_modified.jar -p` on that .sd3 file
+
+def fixture_file(subject_id):
+    return glob.glob(os.path.join(FIXTURES_DIR, f"{subject_id}_*.csv"))[0]
+
+def jar_sequence_summary(subject_id):
+    return pd.read_csv(os.path.join(FIXTURES_DIR, f"GoFitts-{subject_id}-sequence-summary.csv"))
+
+@pytest.fixture
+def processor():
+    return GoFittsProcessor(data_dir=FIXTURES_DIR, use_jar=False)
+
+@pytest.fixture
+def data_dir(tmp_path):
+    ## The processor writes its outputs next to the input files: work on a copy of the task CSV exports
+    for subject_id in SUBJECT_IDS:
+        shutil.copy(fixture_file(subject_id), tmp_path)
+    return tmp_path
+
+def test_use_jar_by_default():
+    assert GoFittsProcessor(data_dir=FIXTURES_DIR).use_jar
+
+@pytest.mark.parametrize("subject_id", SUBJECT_IDS)
+def test_sd3_file_matches_fixture(processor, data_dir, subject_id):
+    file_path = str(data_dir / os.path.basename(fixture_file(subject_id)))
+    _, trials, trace, _ = processor.load_trials(file_path)
+    sd3_path = processor.convert_file(file_path, subject_id, trials, trace)
+    with open(sd3_path) as output, open(os.path.join(FIXTURES_DIR, f"GoFitts-{subject_id}.sd3")) as expected:
+        assert output.read() == expected.read()
+
+@pytest.mark.parametrize("subject_id", SUBJECT_IDS)
+def test_sequence_summary_matches_jar(processor, subject_id):
+    _, trials, trace, _ = processor.load_trials(fixture_file(subject_id))
+    output = processor.sequence_summary(trials, trace)
+    expected = jar_sequence_summary(subject_id)
+    pd.testing.assert_frame_equal(output[expected.columns], expected, check_exact=False, check_dtype=False, rtol=1e-9, atol=1e-9)
+
+def test_process_many_matches_jar(processor, data_dir):
+    file_paths = [str(data_dir / os.path.basename(fixture_file(subject_id))) for subject_id in SUBJECT_IDS]
+    output = processor.process_many(file_paths, max_workers=3)
+    assert list(output.index) == SUBJECT_IDS
+    for subject_id in SUBJECT_IDS:
+        expected = jar_sequence_summary(subject_id)
+        for i, row in expected.iterrows():
+            assert output.loc[subject_id, f"GOFITTS_BEH_ID{i}_PointTime"] == pytest.approx(row["PT"], rel=1e-9)
+            assert output.loc[subject_id, f"GOFITTS_BEH_ID{i}_Throughput"] == pytest.approx(row["TP"], rel=1e-9)
+        ## G002 has one sequence more than the others
+        if len(expected) < 5:
+            assert np.isnan(output.loc[subject_id, "GOFITTS_BEH_ID4_PointTime"])
+
+@pytest.mark.skipif(shutil.which("java") is None, reason="java is not installed")
+def test_jar_matches_fixture(data_dir):
+    processor = GoFittsProcessor(data_dir=str(data_dir), use_jar=True)
+    output = processor.process_many([str(data_dir / os.path.basename(fixture_file("G001")))])
+    expected = jar_sequence_summary("G001")
+    pd.testing.assert_frame_equal(pd.read_csv(data_dir / "GoFitts-G001-sequence-summary.csv"), expected)
+    assert output.loc["G001", "GOFITTS_BEH_ID0_Throughput"] == pytest.approx(expected.loc[0, "TP"])
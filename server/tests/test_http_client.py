@@ -0,0 +1,52 @@
+import pytest
+import requests
+
+from http_client import HttpClient
+from http_stub import reply, drop_connection
+
+@pytest.fixture
+def client():
+    client = HttpClient(retries=2, backoff=0, timeout=2, connect_timeout=1)
+    yield client
+    client.close()
+
+def test_get_is_retried_on_5xx(client, stub_server):
+    stub_server.routes["/flaky"] = [reply(503), reply(502), reply(200, b"ok")]
+    res = client.get(f"{stub_server.url}/flaky")
+    assert res.status_code == 200
+    assert res.content == b"ok"
+    assert len(stub_server.requests_to("/flaky")) == 3
+
+def test_get_returns_the_last_5xx_after_the_retries(client, stub_server):
+    stub_server.routes["/down"] = [reply(503)]
+    res = client.get(f"{stub_server.url}/down")
+    assert res.status_code == 503
+    assert len(stub_server.requests_to("/down")) == 3
+    (stats,) = client.stats().values()
+    assert (stats["calls"], stats["errors"]) == (1, 1)
+
+def test_post_is_not_retried_on_5xx(client, stub_server):
+    stub_server.routes["/exams"] = [reply(503), reply(200)]
+    res = client.post(f"{stub_server.url}/exams", json={"exam": 1})
+    assert res.status_code == 503
+    assert len(stub_server.requests_to("/exams")) == 1
+
+def test_post_is_not_sent_again_after_the_connection_is_lost(client, stub_server):
+    stub_server.routes["/exams"] = [drop_connection]
+    with pytest.raises(requests.ConnectionError):
+        client.post(f"{stub_server.url}/exams", json={"exam": 1})
+    assert len(stub_server.requests_to("/exams")) == 1
+
+    with pytest.raises(requests.ConnectionError):
+        client.get(f"{stub_server.url}/exams")
+    assert [method for method, *_ in stub_server.requests_to("/exams")] == ["POST", "GET", "GET", "GET"]
+
+def test_stats_per_endpoint(client, stub_server):
+    stub_server.routes["/subjects/S001"] = [reply(200)]
+    stub_server.routes["/subjects/S002"] = [reply(500)]
+    client.get(f"{stub_server.url}/subjects/S001")
+    client.get(f"{stub_server.url}/subjects/S002")
+    stats = client.stats()
+    assert list(stats) == [f"GET 127.0.0.1:{stub_server.server_port}/subjects/*"]
+    assert stats[f"GET 127.0.0.1:{stub_server.server_port}/subjects/*"]["calls"] == 2
+    assert stats[f"GET 127.0.0.1:{stub_server.server_port}/subjects/*"]["errors"] == 1
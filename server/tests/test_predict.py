@@ -0,0 +1,211 @@
+import os
+import copy
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+pytestmark = pytest.mark.filterwarnings("ignore::sklearn.exceptions.InconsistentVersionWarning")
+
+pytest.importorskip("lightgbm") # the models in prediction/model are LightGBM regressors
+
+## Read by predict.py at import: no model watcher thread, and no feature store created in the source tree
+## (the tests use their own store)
+os.environ["MODEL_WATCH_INTERVAL"] = "0"
+os.environ["FEATURE_LOOKUP"] = "http"
+
+import predict
+from feature_store import JsonFeatureStore
+from model_registry import ModelRegistry
+
+N_SUBJECTS = 16
+
+def random_features(scaler, rng):
+    ## Values within the range seen by the scaler, with a few missing ones
+    values = rng.uniform(scaler.data_min_, scaler.data_max_)
+    values[rng.random(len(values)) < 0.05] = predict.config.missing_marker
+    return dict(zip(scaler.feature_names_in_, values.tolist()))
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    '''
+    Points predict.py at a copy of the prediction artifacts (which the tests may overwrite),
+    a registry that has not loaded anything yet and a JSON feature store holding N_SUBJECTS subjects.
+    '''
+    shutil.copytree(os.path.join(predict.config.source_dir, "prediction"), tmp_path / "prediction")
+    os.makedirs(tmp_path / "predicted_results")
+    config = copy.copy(predict.config)
+    for name in ["model_path_template", "scaler_path_template", "percentiles_path_template",
+                 "correction_ref_path_template", "predicted_result_template"]:
+        setattr(config, name, getattr(config, name).replace(config.source_dir, str(tmp_path)))
+
+    feature_store = JsonFeatureStore(str(tmp_path / "integrated_results"))
+    os.makedirs(feature_store.integrated_results_dir)
+    rng = np.random.default_rng(3)
+    scaler = ModelRegistry(config).load("young").scaler
+    subjects = []
+    for i in range(N_SUBJECTS):
+        id_card = f"A{i:03d}"
+        feature_store.update(id_card, random_features(scaler, rng), config.missing_marker)
+        subjects.append({"age": [25, 68][i % 2] + i, "id_card": id_card, "name": f"Subject {i}", "test_date": "2024-03-01"})
+
+    monkeypatch.setattr(predict, "config", config)
+    monkeypatch.setattr(predict, "feature_store", feature_store)
+    monkeypatch.setattr(predict, "registry", ModelRegistry(config, watch_interval=0))
+    return config, subjects
+
+def post_predict(subject):
+    response = predict.app.test_client().post("/predict", json=subject)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+def expected_responses(subjects):
+    ## One request at a time (the registry is reset afterwards, so that the tests start from an empty one)
+    registry = predict.registry
+    expected = { subject["id_card"]: post_predict(subject) for subject in subjects }
+    predict.registry = ModelRegistry(registry.config, watch_interval=0)
+    return expected
+
+def test_concurrent_first_requests_load_each_group_once(service, capsys):
+    config, subjects = service
+    expected = expected_responses(subjects)
+    capsys.readouterr()
+
+    requests = subjects * 2
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(executor.map(post_predict, requests))
+
+    output = capsys.readouterr().out
+    assert output.count("Loaded young model artifacts") == 1
+    assert output.count("Loaded old model artifacts") == 1
+    for subject, response in zip(requests, responses):
+        assert response == expected[subject["id_card"]]
+
+def test_concurrent_requests_while_model_is_swapped(service):
+    config, subjects = service
+    expected = expected_responses(subjects)
+    model_path = predict.registry.artifact_paths("young")["model"]
+    model = joblib.load(model_path)
+
+    stop = threading.Event()
+    def swap_model():
+        ## Rewrites the same model with a different compression level (new content, same predictions) and reloads it
+        compress = 0
+        while not stop.is_set():
+            compress = (compress + 1) % 4
+            tmp_path = f"{model_path}.tmp"
+            joblib.dump(model, tmp_path, compress=compress)
+            os.replace(tmp_path, model_path)
+            predict.registry.check_for_updates()
+
+    swapper = threading.Thread(target=swap_model)
+    swapper.start()
+    try:
+        requests = subjects * 4
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            responses = list(executor.map(post_predict, requests))
+    finally:
+        stop.set()
+        swapper.join()
+
+    assert predict.registry.status()["groups"]["young"]["reload_count"] >= 1
+    for subject, response in zip(requests, responses):
+        assert response == expected[subject["id_card"]]
+
+@pytest.mark.parametrize("body", [[], [{"age": 30}], "subjects", 3, {}, {"subjects": {}}])
+def test_predict_batch_rejects_invalid_body(service, body):
+    response = predict.app.test_client().post("/predict_batch", json=body)
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid input data"}
+
+def test_predict_batch_looks_up_features_at_once(service, monkeypatch):
+    config, subjects = service
+    expected = expected_responses(subjects)
+
+    ## One subject sent with its features, and one without features in the store
+    inline = dict(subjects[0], features=predict.feature_store.get(subjects[0]["id_card"]))
+    unknown = dict(subjects[1], id_card="Z999")
+    batch = [inline, unknown] + subjects[1:]
+
+    lookups = []
+    get_many = predict.feature_store.get_many
+    monkeypatch.setattr(predict.feature_store, "get_many", lambda subject_ids: lookups.append(list(subject_ids)) or get_many(subject_ids))
+    response = predict.app.test_client().post("/predict_batch", json={"subjects": batch, "save": False})
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+
+    assert lookups == [["Z999"] + [subject["id_card"] for subject in subjects[1:]]]
+    assert results[0] == expected[subjects[0]["id_card"]]
+    assert results[1] == {"id_card": "Z999", "error": "Integrated result not found for subject ID: Z999"}
+    for subject, result in zip(subjects[1:], results[2:]):
+        assert result == expected[subject["id_card"]]
+
+def legacy_score(config, artifacts, true_age, features):
+    '''
+    The single-subject scoring of /predict that score_subjects() replaced (kept as the reference of the parity test):
+    returns whether brain age is predicted, the uncorrected prediction and the domain scores.
+    '''
+    model, scaler = artifacts.model, artifacts.scaler
+    brainage_prediction = true_age != -1
+    platform_features = predict.get_platform_features(model)
+
+    DF = pd.DataFrame(index=range(1), columns=scaler.feature_names_in_)
+    DF.update(pd.DataFrame([features]))
+    data_is_missing = DF == config.missing_marker
+    DF = DF.astype(float)
+    DF = DF.replace(config.missing_marker, np.nan)
+    DF = DF.fillna(0)
+    DF_scaled = pd.DataFrame(scaler.transform(DF), columns=scaler.feature_names_in_)
+    DF_scaled[data_is_missing] = config.replace_missing_with
+
+    domain_score_list = []
+    for cog_domain, domain_features in config.cognitive_domains.items():
+        missing_ratio = data_is_missing[domain_features].sum(axis=1) / len(domain_features)
+        if missing_ratio.iloc[0] > config.missing_threshold:
+            brainage_prediction = False
+            domain_score_list.append({"name": cog_domain, "score": -1})
+        else:
+            avg_score = DF_scaled[domain_features].mean(axis=1).iloc[0]
+            percentile = np.interp(x=avg_score, xp=[0, 1], fp=[0, 100])
+            if cog_domain == "動作":
+                percentile = 100 - percentile
+            if percentile < config.min_percentile:
+                percentile = config.min_percentile
+            domain_score_list.append({"name": cog_domain, "score": int(round(percentile))})
+
+    prediction = float(model.predict(DF_scaled[platform_features])[0]) if brainage_prediction else -1
+    return brainage_prediction, prediction, domain_score_list
+
+@pytest.mark.parametrize("age_full", ["young", "old"])
+def test_score_subjects_matches_legacy_scoring(service, age_full):
+    config, _ = service
+    artifacts = predict.registry.get(age_full)
+    rng = np.random.default_rng(7)
+    features_list = [random_features(artifacts.scaler, rng) for _ in range(6)]
+    feature_index = { feature: i for i, feature in enumerate(artifacts.scaler.feature_names_in_) }
+    ## Subjects 0 and 5: with all domain features, so that brain age is predicted
+    for features in features_list:
+        for feature in sum(config.cognitive_domains.values(), []):
+            features[feature] = float(artifacts.scaler.data_min_[feature_index[feature]] + artifacts.scaler.data_max_[feature_index[feature]]) / 2 + rng.normal()
+    ## A subject missing a whole domain, one with a domain below the minimum percentile, one missing a feature
+    ## of the request (left out of the dict) and one without age
+    for feature in config.cognitive_domains["動作"]:
+        features_list[1][feature] = config.missing_marker
+    for feature in config.cognitive_domains["情節記憶"]:
+        features_list[2][feature] = artifacts.scaler.data_min_[feature_index[feature]]
+    del features_list[3][config.cognitive_domains["工作記憶"][0]]
+    true_ages = [30 if age_full == "young" else 65] * len(features_list)
+    true_ages[4] = -1
+
+    scored = predict.score_subjects(config, artifacts, true_ages, features_list)
+    for true_age, features, output in zip(true_ages, features_list, scored):
+        brainage_prediction, prediction, domain_score_list = legacy_score(config, artifacts, true_age, features)
+        assert output["brainage_prediction"] == brainage_prediction
+        assert output["prediction"] == pytest.approx(prediction, abs=1e-9)
+        assert output["domain_score_list"] == domain_score_list
+    assert all(scored[i]["brainage_prediction"] for i in [0, 5])
+    assert not scored[1]["brainage_prediction"] and not scored[4]["brainage_prediction"]
@@ -1,64 +1,79 @@
 #!/usr/bin/env python
 
-# This script reads the predicted_results.json and integrated_results.json files of all participants, and then organizes them into a table
-# The script also executes patches.py if any subject_id is specified as an argument
+# This script reads the predicted_results.json files and the integrated results (from the feature store) of all participants, and then organizes them into a table
+# The table is kept between runs (with the versions of its sources), so only the participants whose results changed are read again
+# The script also patches (see patches.py) the subject_ids specified as an argument, several at a time
 
-# Usage: python tidy_predicted_results.py [-rp] [-s <subject_id1> <subject_id2> ...]
+# Usage: python tidy_predicted_results.py [-rp] [--full] [-s <subject_id1> <subject_id2> ...] [-w <N_WORKERS>]
 
 import os
 import re
 import json
-import glob
+import pickle
 import argparse
-import subprocess
+from datetime import datetime
 import numpy as np
 import pandas as pd
+from dotenv import load_dotenv
 
-from server import Config, setup_logger, predict
+try:
+    import pyarrow # noqa: F401 (only needed to write Parquet files)
+    TABLE_FORMAT = "parquet"
+except ImportError:
+    TABLE_FORMAT = "pickle"
+
+from server import Config, setup_logger, predict_batch
+from feature_store import make_feature_store
+from file_index import get_file_index
+import patches
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--subjects", nargs="*", default=[],
                         help="Subject IDs that need patches to be executed.")
+    parser.add_argument("-w", "--workers", type=int, default=4, 
+                        help="Number of subjects patched concurrently.")
     parser.add_argument("-rp", "--re_predict", action="store_true", 
                         help="Reproduce predicted results for all subjects.")
+    parser.add_argument("--full", action="store_true", 
+                        help="Rebuild the table of all subjects from scratch.")
     return parser.parse_args()
 
-def get_all_subject_ids():
+def get_all_subject_ids(cohort):
     '''
-    Scans the "integrated_results" directory to find all unique subject IDs
+    Finds all unique subject IDs in the integrated results (or in a list of subject IDs)
     that match the expected pattern ("????s????-?" where each ? is a digit). 
     '''
     subject_ids = set()
-    for fp in glob.glob(os.path.join("integrated_results", "*.json")):
-        subject_id = os.path.basename(fp).split("_")[0]
+    for subject_id in cohort:
         if re.match(r"[\d]{4}s[\d]{4}-[\d]{1}", subject_id): 
             subject_ids.add(subject_id)
 
     return sorted(subject_ids)
 
-def get_prediction_results(subject_id, args, config, logger):
+def get_test_date(subject_id, config):
+    '''
+    Looks up the files of the subject ID in the index of the data directories
+    and extracts the test date from the filename.
+    
+    To get the most recent test date,
+    the files are checked in reverse order of the execution of the experiments.        
+    '''
+    for exp in config.exp_name_list[::-1]: 
+        fp = get_file_index(os.path.join(config.data_dir, exp)).glob(f"{subject_id}_*Z.csv")
+        if fp:
+            return os.path.basename(fp[0]).split("_")[2].split(".")[0]
+
+def get_prediction_results(subject_id, re_predicted, logger):
     '''
     Retrieves the prediction results for a given subject ID, 
     and extracts the necessary fields to be organized into a dictionary, 
     which will later be converted into a DataFrame.
     
-    If "re_predict" is True, it will call the predict function to get the results. 
+    If "re_predicted" is given (i.e., the "re_predict" option is set), 
+    the results are taken from it.
     Otherwise, it will read from the existing JSON file.
     '''
-    def _get_test_date(subject_id, config):
-        '''
-        Scans the data directory for files matching the subject ID 
-        and extracts the test date from the filename.
-        
-        To get the most recent test date,
-        the files are checked in reverse order of the execution of the experiments.        
-        '''
-        for exp in config.exp_name_list[::-1]: 
-            fp = glob.glob(os.path.join(config.data_dir, exp, f"{subject_id}_*Z.csv"))
-            if fp:
-                return os.path.basename(fp[0]).split("_")[2].split(".")[0]
-
     def _orginize_results(subject_id, data):
         '''
         Extracts the necessary fields from the JSON data
@@ -81,9 +96,8 @@ def get_prediction_results(subject_id, args, config, logger):
         results["Avg"] = np.mean(list(scores.values())) if not any(v == -1 for v in scores.values()) else -1
         return results
         
-    if args.re_predict:
-        test_date = _get_test_date(subject_id, config)
-        data = predict(subject_id, config, logger, test_date)
+    if re_predicted is not None:
+        data = re_predicted.get(subject_id)
     else:
         fp = os.path.join("predicted_results", f"{subject_id}_predicted_results.json")
         with open(fp, "r", encoding="utf-8") as f:
@@ -97,47 +111,140 @@ def get_prediction_results(subject_id, args, config, logger):
     else: 
         return _orginize_results(subject_id, data)
 
-def get_integrated_results(subject_id):
+def get_integrated_results(subject_id, cohort):
     '''
-    Retrieves the integrated results for a given subject ID,
+    Retrieves the integrated results for a given subject ID
+    from the cohort (read from the feature store in a single query),
     and returns a dictionary of the results, 
     where any value of -999 is replaced with NaN.
     '''
-    fp = os.path.join("integrated_results", f"{subject_id}_integrated_result.json")
-    with open(fp, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = cohort[subject_id]
 
     return {
         k: v if v != -999 else np.nan 
         for k, v in data.items()
     }
 
+def get_source_versions(subject_ids, feature_store):
+    '''
+    Returns the versions of the sources of each subject's row in the table: 
+    the modification time of its predicted_results.json file 
+    and the time of the latest update of its integrated result.
+    '''
+    last_updated = feature_store.last_updated()
+    versions = {}
+    for subject_id in subject_ids:
+        fp = os.path.join("predicted_results", f"{subject_id}_predicted_results.json")
+        versions[subject_id] = {
+            "predicted": os.stat(fp).st_mtime_ns if os.path.exists(fp) else None,
+            "integrated": last_updated.get(subject_id)
+        }
+    return versions
+
+def load_cohort_table(table_dir):
+    '''
+    Loads the table (indexed by subject ID) and the manifest (the source versions of its rows) saved by the last run.
+    Returns (None, {}) if there is none.
+    '''
+    manifest_path = os.path.join(table_dir, "tidy_predicted_results.manifest.json")
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        table_path = os.path.join(table_dir, manifest["table"])
+        if manifest["table"].endswith(".parquet"):
+            table = pd.read_parquet(table_path)
+        else:
+            with open(table_path, "rb") as f:
+                table = pickle.load(f)
+    except (FileNotFoundError, KeyError, ValueError, pickle.UnpicklingError):
+        return None, {}
+    return table, manifest["subjects"]
+
+def save_cohort_table(table, versions, table_dir):
+    '''
+    Saves the table as Parquet (if pyarrow is installed; pickle otherwise), then the manifest.
+    '''
+    table_fn = None
+    if TABLE_FORMAT == "parquet":
+        try:
+            table.to_parquet(os.path.join(table_dir, "tidy_predicted_results.parquet.tmp"))
+            table_fn = "tidy_predicted_results.parquet"
+        except (ValueError, TypeError): # e.g., a column mixing numbers and strings, which Parquet cannot store
+            pass
+    if table_fn is None:
+        table_fn = "tidy_predicted_results.pkl"
+        with open(os.path.join(table_dir, f"{table_fn}.tmp"), "wb") as f:
+            pickle.dump(table, f)
+    os.replace(os.path.join(table_dir, f"{table_fn}.tmp"), os.path.join(table_dir, table_fn))
+
+    manifest_path = os.path.join(table_dir, "tidy_predicted_results.manifest.json")
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({ "table": table_fn, "subjects": versions }, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
 def main():
+    load_dotenv()
     config = Config()
     logger = setup_logger()  
     args = parse_args()
+    table_dir = "predicted_results"
 
-    subject_ids = get_all_subject_ids()
-    data_rows = []
+    feature_store = make_feature_store(config)
+    subject_ids = get_all_subject_ids(feature_store.subject_ids())
 
-    for subject_id in subject_ids:
-        ## Executing patches.py if specified:
-        if subject_id in args.subjects:
-            subprocess.run(["python", "patches.py", subject_id])
+    ## Executing patches if specified:
+    patch_ids = [ subject_id for subject_id in subject_ids if subject_id in args.subjects ]
+    if patch_ids:
+        patch_results = patches.patch_subjects(patch_ids, patches.Config(), logger, max_workers=args.workers)
+        print(f"\nPatched {len(patch_results)} subjects ({patches.summarize_patches(patch_results)})\n")
 
-        results = get_prediction_results(subject_id, args, config, logger)
-        platform_features = get_integrated_results(subject_id)    
+    ## Re-predicting all subjects with a single batch request if specified:
+    if args.re_predict:
+        re_predicted = predict_batch(
+            { subject_id: get_test_date(subject_id, config) for subject_id in subject_ids }, config, logger
+        )
+    else:
+        re_predicted = None
+
+    ## Only the subjects whose sources changed since the last run are read again 
+    ## (all of them with --full, or when all predictions have just been reproduced):
+    build_start = datetime.now().isoformat(timespec="seconds")
+    versions = get_source_versions(subject_ids, feature_store)
+    if args.full or args.re_predict:
+        table, manifest = None, {}
+    else:
+        table, manifest = load_cohort_table(table_dir)
+    changed_ids = [ 
+        subject_id for subject_id in subject_ids 
+        if table is None or subject_id not in table.index or manifest.get(subject_id) != versions[subject_id] 
+    ]
+    cohort = feature_store.get_many(changed_ids)
+
+    data_rows = []
+    for subject_id in changed_ids:
+        results = get_prediction_results(subject_id, re_predicted, logger)
+        platform_features = get_integrated_results(subject_id, cohort)    
         results.update(platform_features)    
-        data_row = pd.DataFrame(results, index=[0])
+        data_row = pd.DataFrame(results, index=[subject_id])
         data_rows.append(data_row)
 
-    df = pd.concat(data_rows, ignore_index=True)
+    changed = set(changed_ids)
+    kept_ids = [ subject_id for subject_id in subject_ids if subject_id not in changed ]
+    if table is not None and kept_ids:
+        data_rows.insert(0, table.loc[kept_ids])
+    df = pd.concat(data_rows)
+
+    ## A result updated within the current second could be updated again unnoticed, so it is read again next time:
+    for subject_id in changed_ids:
+        if (versions[subject_id]["integrated"] or "") >= build_start:
+            versions[subject_id] = None
+    save_cohort_table(df, versions, table_dir)
 
-    ## Saving the DataFrame to a CSV file:
-    out_path = os.path.join("predicted_results", "tidy_predicted_results.csv")
+    ## Exporting the table to a CSV file:
+    out_path = os.path.join(table_dir, "tidy_predicted_results.csv")
     df = df.sort_values(by="Date")
     df.to_csv(out_path, index=False, encoding="utf-8-sig")
-    print(f"\n{len(data_rows)} results are organized into a table and saved to:\n{out_path}\n")
+    print(f"\n{len(df)} results ({len(changed_ids)} read again) are organized into a table and saved to:\n{out_path}\n")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Content-addressed cache of the TextReading transcriptions (the word-level timestamp tables, *.words.csv).
+# An entry is keyed by the SHA-256 of the recording plus a fingerprint of everything that affects
+# the transcription (Whisper model, transcription options, silence removal parameters, ...),
+# so re-processing a subject whose recordings have not changed skips decoding and Whisper entirely.
+# The least recently used entries are evicted once the cache grows beyond its size limit.
+#
+# Usage: python transcription_cache.py {list,stats,purge} [--all] [-k <KEY> ...] [--older_than <DAYS>]
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+
+def fingerprint(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class TranscriptionCache:
+    def __init__(self, cache_dir, max_bytes=500 * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, audio_file, params):
+        return f"{file_sha256(audio_file)[:32]}-{fingerprint(params)}"
+
+    def _csv_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.words.csv")
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key, out_file):
+        '''
+        Copies the cached table of key to out_file and returns True on a hit.
+        '''
+        csv_path = self._csv_path(key)
+        try:
+            with open(csv_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        os.utime(csv_path) # mark as recently used
+
+        tmp_path = f"{out_file}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, out_file)
+        return True
+
+    def put(self, key, csv_file, source=None, params=None):
+        csv_path = self._csv_path(key)
+        tmp_path = f"{csv_path}.{threading.get_ident()}.tmp"
+        with open(csv_file, "rb") as src, open(tmp_path, "wb") as dst:
+            dst.write(src.read())
+        with open(self._meta_path(key), "w", encoding="utf-8") as f:
+            json.dump({
+                "source": os.path.basename(source) if source else None,
+                "params": params,
+                "created_at": datetime.now().isoformat(timespec="seconds")
+            }, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, csv_path)
+        self.evict()
+
+    def entries(self):
+        '''
+        Returns the entries sorted from the least to the most recently used.
+        '''
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(".words.csv"):
+                continue
+            key = fn[:-len(".words.csv")]
+            try:
+                st = os.stat(self._csv_path(key))
+            except FileNotFoundError: # evicted meanwhile
+                continue
+            try:
+                with open(self._meta_path(key), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                meta = {}
+            entries.append({
+                "key": key,
+                "source": meta.get("source"),
+                "created_at": meta.get("created_at"),
+                "last_used": st.st_mtime,
+                "size": st.st_size
+            })
+        return sorted(entries, key=lambda e: e["last_used"])
+
+    def remove(self, key):
+        for path in [self._csv_path(key), self._meta_path(key)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes.
+        '''
+        with self._lock:
+            entries = self.entries()
+            total = sum(e["size"] for e in entries)
+            n_removed = 0
+            for e in entries:
+                if total <= self.max_bytes:
+                    break
+                self.remove(e["key"])
+                total -= e["size"]
+                n_removed += 1
+        return n_removed
+
+    def purge(self, keys=None, older_than=None):
+        '''
+        Removes the given keys, the entries not used for older_than seconds, or (by default) everything.
+        '''
+        n_removed = 0
+        for e in self.entries():
+            if keys is not None and e["key"] not in keys:
+                continue
+            if older_than is not None and time.time() - e["last_used"] < older_than:
+                continue
+            self.remove(e["key"])
+            n_removed += 1
+        return n_removed
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "size_mb": round(sum(e["size"] for e in entries) / 1024 ** 2, 2),
+            "max_mb": round(self.max_bytes / 1024 ** 2, 2)
+        }
+
+## ====================================================================================
+
+if __name__ == "__main__":
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["list", "stats", "purge"])
+    parser.add_argument("-d", "--cache_dir", type=str, default=os.path.join(source_dir, "transcription_cache"),
+                        help="Folder of the cache.")
+    parser.add_argument("-k", "--keys", type=str, nargs="*", default=None,
+                        help="purge: keys of the entries to remove.")
+    parser.add_argument("--older_than", type=float, default=None,
+                        help="purge: remove the entries not used for this many days.")
+    parser.add_argument("--all", action="store_true",
+                        help="purge: remove all entries.")
+    args = parser.parse_args()
+
+    cache = TranscriptionCache(args.cache_dir, max_bytes=float(os.getenv("TRANSCRIPTION_CACHE_MAX_MB", 500)) * 1024 ** 2)
+
+    if args.command == "list":
+        for e in cache.entries():
+            last_used = datetime.fromtimestamp(e["last_used"]).isoformat(timespec="seconds")
+            print(f"{e['key']}  {e['size'] / 1024:8.1f} KB  last used {last_used}  {e['source']}")
+
+    elif args.command == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+
+    elif args.command == "purge":
+        if args.keys is None and args.older_than is None and not args.all:
+            parser.error("purge needs --all, -k <KEY> ... or --older_than <DAYS>")
+        n_removed = cache.purge(
+            keys=set(args.keys) if args.keys is not None else None,
+            older_than=args.older_than * 86400 if args.older_than is not None else None
+        )
+        print(f"Removed {n_removed} entries")
@@ -4,20 +4,25 @@
 # To be more specific, this script reads the ~400 participants data matrix, predict their brain age, and save the results to a CSV table.
 
 import os
-import json
-import requests
 import pandas as pd
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import util
+import http_client
+from feature_store import make_feature_store
 
 class Config:
     def __init__(self):
         self.source_dir = os.path.dirname(os.path.abspath(__file__))
         self.data_path = os.path.join(self.source_dir, "..", "data", "DATA_ses-01_2024-12-05.csv")
-        self.json_path = os.path.join(self.source_dir, "integrated_results", "{}_integrated_result.json")
+        self.integrated_results_dir = os.path.join(self.source_dir, "integrated_results")
+        self.feature_db_path = os.path.join(self.integrated_results_dir, "integrated_results.db")
+        self.feature_store_backend = os.getenv("FEATURE_STORE_BACKEND", "sqlite") # "sqlite" or "json"
         self.table_path = os.path.join(self.source_dir, "predicted_results", "background_predicted_results.csv")
         self.predict_url = os.getenv("PREDICT_URL") 
+        self.predict_batch_url = os.getenv("PREDICT_BATCH_URL") or f"{self.predict_url}_batch"
+        self.batch_size = 200
+        self.predict_batch_timeout = float(os.getenv("PREDICT_BATCH_TIMEOUT", 600)) # seconds
         self.local_headers = {
             "X-GitLab-Token": "tcnl-project",
             "Content-Type": "application/json"
@@ -28,7 +33,7 @@ def pseudo_predict(config, sid, age, test_date=None):
         now = datetime.now(timezone.utc)
         test_date = now.strftime('%Y-%m-%dT%H%M%S.') + f"{int(now.microsecond / 1000):03d}Z"
 
-    res = requests.post(
+    res = http_client.post(
         url=config.predict_url, 
         headers=config.local_headers, 
         json={
@@ -43,6 +48,33 @@ def pseudo_predict(config, sid, age, test_date=None):
     else:
         raise Exception(f"Error {res.status_code}: {res.text}")
 
+def pseudo_predict_batch(config, subjects, test_date=None):
+    if test_date is None:
+        now = datetime.now(timezone.utc)
+        test_date = now.strftime('%Y-%m-%dT%H%M%S.') + f"{int(now.microsecond / 1000):03d}Z"
+
+    res = http_client.post(
+        url=config.predict_batch_url, 
+        headers=config.local_headers, 
+        json={
+            "subjects": [
+                {
+                    "age": age,
+                    "id_card": sid,
+                    "name": sid,
+                    "test_date": test_date, 
+                    "features": features
+                }
+                for sid, age, features in subjects
+            ]
+        }, 
+        timeout=config.predict_batch_timeout
+    )
+    if res.status_code == 200:
+        return res.json()["results"]
+    else:
+        raise Exception(f"Error {res.status_code}: {res.text}")
+
 if __name__ == "__main__":
     load_dotenv()
     config = Config()
@@ -54,33 +86,41 @@ if __name__ == "__main__":
     data = data.loc[:, ["BASIC_INFO_ID", "BASIC_INFO_AGE"] + platform_features]
     data = data.fillna(-999)
 
-    out_rows = []
+    subjects = []
     for idx, row in data.iterrows():
         sid = row["BASIC_INFO_ID"]
         age = row["BASIC_INFO_AGE"]
         features = row[platform_features].to_dict()
+        subjects.append((sid, age, features))
 
-        with open(config.json_path.format(sid), "w", encoding="utf-8") as f:
-            json.dump(features, f, indent=2)
+    ## Saving the integrated results of all subjects in a single transaction:
+    make_feature_store(config).update_many(
+        { sid: features for sid, _, features in subjects }, -999, source="background_csv"
+    )
+    print(f"Integrated results saved: {len(subjects)} subjects ({config.feature_store_backend})")
 
-        print(F"JSON file saved: {sid}_integrated_result.json")
+    out_rows = []
+    for start in range(0, len(subjects), config.batch_size):
+        predict_outs = pseudo_predict_batch(config, subjects[start:start + config.batch_size])
+        print(f"Predicted {min(start + config.batch_size, len(subjects))}/{len(subjects)} subjects")
 
-        predict_out = pseudo_predict(config, sid, age)
-        formatted_out = {
-            "SID": predict_out["id_card"], 
-            "Chronological Age": predict_out["results"]["chronologicalAge"],
-            "Brain Age": predict_out["results"]["brainAge"],
-            "PAD": predict_out["results"]["originalPAD"],
-            "Corrected PAD": predict_out["results"]["ageCorrectedPAD"]
-        }
-        formatted_out.update({ 
-            item["name"]: item["score"] for item in predict_out["cognitiveFunctions"] 
-        })
+        for predict_out in predict_outs:
+            if "error" in predict_out:
+                raise Exception(f"Error predicting {predict_out['id_card']}: {predict_out['error']}")
 
-        out_row = pd.DataFrame(formatted_out, index=[0])
-        out_rows.append(out_row)
+            formatted_out = {
+                "SID": predict_out["id_card"], 
+                "Chronological Age": predict_out["results"]["chronologicalAge"],
+                "Brain Age": predict_out["results"]["brainAge"],
+                "PAD": predict_out["results"]["originalPAD"],
+                "Corrected PAD": predict_out["results"]["ageCorrectedPAD"]
+            }
+            formatted_out.update({ 
+                item["name"]: item["score"] for item in predict_out["cognitiveFunctions"] 
+            })
+            out_rows.append(formatted_out)
 
-    out_table = pd.concat(out_rows, ignore_index=True)
+    out_table = pd.DataFrame(out_rows)
     out_table.to_csv(config.table_path, index=False, encoding="utf-8-sig")
 
     print(f"Table saved: {config.table_path}")
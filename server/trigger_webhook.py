@@ -3,14 +3,15 @@
 # This script is used to create a pseudo commit from Pavlovia GitLab to local /webhook endpoint,
 # so that the server.py can be triggered to download and process the data.
 
-# Usage: python trigger_webhook.py <project_no> <csv_filename>
+# Usage: python trigger_webhook.py <project_no> <csv_filename> [<csv_filename> ...]
 
 import os
 import sys
 # import glob
-import requests
 from dotenv import load_dotenv
 
+import http_client
+
 load_dotenv()
 
 class Config:
@@ -70,9 +71,9 @@ if __name__ == "__main__":
         # ))[0]
         # csv_filename = os.path.basename(csv_filepath)
         # print(f"csv_filename: {csv_filename}")
-        csv_filename = sys.argv[2]
+        csv_filenames = sys.argv[2:]
 
-        res = requests.post(
+        res = http_client.post(
             url=config.webhook_url, 
             headers=config.local_headers, 
             json={
@@ -85,11 +86,12 @@ if __name__ == "__main__":
                     "author": {"name":"Local Committer"}, 
                     "added": [f"data/{csv_filename}"], 
                     "note": "a pseudo commit from mannual_trigger_webhook.py"
-                }]        
+                } for csv_filename in csv_filenames]        
             }
         )
         if res.status_code == 200:
-            print(f"Successfully generate pseudo {project_name} commit for {csv_filename}")
+            for file_status in res.json()["files"]:
+                print(f"Successfully generate pseudo {project_name} commit for {file_status['filename']} ({file_status['status']})")
             print(":-)")
         else:
             raise Exception(f"{res.text}: {res.status_code}")
\ No newline at end of file
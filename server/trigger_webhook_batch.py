@@ -4,9 +4,10 @@ import os
 import argparse
 import subprocess
 from datetime import datetime
-import requests
 from dotenv import load_dotenv
 
+import http_client
+
 class Config:
     def __init__(self):
         self.source_dir = os.path.dirname(os.path.abspath(__file__))
@@ -65,7 +66,7 @@ def get_commit_records(exp_id, config, args):
 
     targ_url = config.gitlab_commit_url.format(exp_id, inqury)
     print(f"Fetching commit records from:\n{targ_url}\n")
-    resp = requests.get(url=targ_url, headers=config.gitlab_headers)
+    resp = http_client.get(url=targ_url, headers=config.gitlab_headers)
 
     if resp.status_code == 200:
         csv_names = []
@@ -93,15 +94,17 @@ if __name__ == "__main__":
         for exp_no, exp_id in config.exp_id_dict.items():
             csv_names = get_commit_records(exp_id, config, args)
             
-            for csv_name in csv_names:
-                if args.subj_list is None:
-                    pass
-                elif csv_name.split("_")[0] not in args.subj_list:
-                    continue
+            if args.subj_list is not None:
+                csv_names = [ 
+                    csv_name for csv_name in csv_names if csv_name.split("_")[0] in args.subj_list 
+                ]
+            if not csv_names:
+                continue
 
-                cmd = ["python", "trigger_webhook.py", str(exp_no), csv_name]
-                subprocess.run(cmd, capture_output=True, text=True, check=True)
-                log_msg.append(" ".join(cmd) + "\n")
+            ## All files of an experiment are sent as a single webhook payload
+            cmd = ["python", "trigger_webhook.py", str(exp_no)] + csv_names
+            subprocess.run(cmd, capture_output=True, text=True, check=True)
+            log_msg.append(" ".join(cmd) + "\n")
     finally:
         with open(config.log_file, "w") as f:
             f.writelines(log_msg)
\ No newline at end of file
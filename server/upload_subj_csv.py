@@ -2,9 +2,10 @@
 
 import os
 import sys
-import requests
 
 from dotenv import load_dotenv
+
+import http_client
 load_dotenv()
 
 qoca_token = os.getenv("QOCA_TOKEN")
@@ -48,7 +49,7 @@ def upload_file(file_path):
             raise ValueError(f"Unsupported file type: {ext}")
             
         with open(file_path, 'rb') as f:
-            res = requests.post(
+            res = http_client.post(
                 url='https://qoca-api.chih-he.dev/uploadfile', 
                 headers=qoca_headers, 
                 files={'file': f},